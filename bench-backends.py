@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+"""
+Compare pdf backends on a shared image corpus: time, peak memory and output size.
+
+Usage:
+    python bench-backends.py [--pages 30] [--size 3000x2000] [--corpus DIR]
+
+Without --corpus, synthetic sets are generated: photo-like JPEGs, PNGs, PNGs with alpha and GIFs.
+Every run happens in a fresh process, so peak RSS belongs to that run only.
+Use the results to tune compiler.choose_backend.
+"""
+
+import argparse
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+from PIL import Image
+
+from compiler import BACKENDS, available_backends, build_pdf
+
+
+def make_image(path, width, height, mode, seed):
+    # noise over a gradient, compresses like a photo
+    noise = Image.effect_noise((width, height), 40 + seed % 20).convert('L')
+    gradient = Image.linear_gradient('L').resize((width, height))
+    image = Image.merge('RGB', (noise, gradient, Image.blend(noise, gradient, 0.5)))
+    if mode == 'RGBA':
+        image.putalpha(gradient)
+    elif mode == 'P':
+        image = image.convert('P')
+    image.save(path)
+
+def make_corpus(directory, pages, width, height):
+    sets = {'jpeg': ('.jpg', 'RGB'), 'png': ('.png', 'RGB'), 'png-alpha': ('.png', 'RGBA'), 'gif': ('.gif', 'P')}
+    corpus = {}
+    for name, (ext, mode) in sets.items():
+        corpus[name] = []
+        for i in range(pages):
+            path = os.path.join(directory, f'{name}-{i}{ext}')
+            make_image(path, width, height, mode, i)
+            corpus[name].append(path)
+    return corpus
+
+def run(images, filename, backend, conn):
+    t0 = time.perf_counter()
+    try:
+        build_pdf(images, filename, backend)
+        err = None
+    except Exception as e:
+        err = repr(e)
+    t = time.perf_counter() - t0
+    conn.send((t, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, err))
+
+def bench(images, filename, backend):
+    parent_conn, child_conn = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=run, args=(images, filename, backend, child_conn))
+    process.start()
+    t, maxrss_kb, err = parent_conn.recv()
+    process.join()
+    size = os.stat(filename).st_size if err is None else 0
+    return t, maxrss_kb / 1024, size, err
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pages', type=int, default=30)
+    parser.add_argument('--size', default='3000x2000', help='WxH of synthetic images')
+    parser.add_argument('--corpus', help='directory with images to use instead of synthetic sets')
+    parser.add_argument('--backends', default=','.join(available_backends()))
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        if args.corpus:
+            files = sorted(os.listdir(args.corpus))
+            corpus = {os.path.basename(args.corpus.rstrip('/')): [os.path.join(args.corpus, f) for f in files]}
+        else:
+            width, height = map(int, args.size.split('x'))
+            print(f'generating {args.pages} pages per set, {width}x{height}...')
+            corpus = make_corpus(directory, args.pages, width, height)
+
+        print(f"{'set':<12}{'backend':<10}{'time, s':>10}{'pages/s':>10}{'RSS, MB':>10}{'size, MB':>10}")
+        for name, images in corpus.items():
+            input_size = sum(os.stat(p).st_size for p in images)
+            print(f"{name:<12}{'input':<10}{'':>10}{'':>10}{'':>10}{input_size/1e6:>10.2f}")
+            for backend in args.backends.split(','):
+                assert backend in BACKENDS, backend
+                t, rss, size, err = bench(images, os.path.join(directory, f'{name}-{backend}.pdf'), backend)
+                if err:
+                    print(f"{name:<12}{backend:<10} failed: {err}")
+                    continue
+                print(f"{name:<12}{backend:<10}{t:>10.2f}{len(images)/t:>10.1f}{rss:>10.1f}{size/1e6:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
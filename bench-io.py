@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+"""
+Per-job I/O of the 'high' quality path: prepare_image for every page, then build_pdf with
+the stream backend, JPEGs copied with read/write and with sendfile (compiler.SENDFILE).
+
+Usage:
+    python bench-io.py [--pages 50] [--size 2560x1920] [--corpus DIR] [--cold] [--repeat 3]
+
+Every job runs in a fresh process, counters are its own (/proc/self/io, rusage):
+syscalls, bytes moved through read/write, bytes read from disk, user and system CPU.
+--cold evicts the images from the page cache before every job, as after a restart.
+Best of --repeat runs is reported. Linux only.
+"""
+
+import argparse
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+from PIL import Image
+
+import compiler
+
+
+def make_image(path, width, height, seed):
+    # noise over a gradient, compresses like a photo, saved like telegram photos
+    noise = Image.effect_noise((width, height), 40 + seed % 20).convert('L')
+    gradient = Image.linear_gradient('L').resize((width, height))
+    Image.merge('RGB', (noise, gradient, Image.blend(noise, gradient, 0.5))).save(path, quality=87)
+
+def evict(paths):
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fdatasync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+def proc_io():
+    with open('/proc/self/io') as f:
+        return {key: int(value) for key, value in (line.split(': ') for line in f)}
+
+def run(job, images, filename, sendfile, conn):
+    compiler.SENDFILE = sendfile
+    io0, ru0, t0 = proc_io(), resource.getrusage(resource.RUSAGE_SELF), time.perf_counter()
+    if job == 'prepare':
+        for path in images:
+            compiler.prepare_image(path, False)
+    else:
+        compiler.build_pdf(images, filename, 'stream')
+    t = time.perf_counter() - t0
+    io1, ru1 = proc_io(), resource.getrusage(resource.RUSAGE_SELF)
+    conn.send({
+        's': t,
+        'user': ru1.ru_utime - ru0.ru_utime,
+        'sys': ru1.ru_stime - ru0.ru_stime,
+        'syscalls': io1['syscr'] + io1['syscw'] - io0['syscr'] - io0['syscw'],
+        'rchar': io1['rchar'] - io0['rchar'],
+        'disk': io1['read_bytes'] - io0['read_bytes'],
+    })
+
+def bench(job, images, filename, sendfile, cold):
+    if cold:
+        evict(images)
+    parent_conn, child_conn = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=run, args=(job, images, filename, sendfile, child_conn))
+    process.start()
+    res = parent_conn.recv()
+    process.join()
+    return res
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pages', type=int, default=50)
+    parser.add_argument('--size', default='2560x1920', help='WxH of synthetic images')
+    parser.add_argument('--corpus', help='directory with JPEGs to use instead of synthetic ones')
+    parser.add_argument('--cold', action='store_true', help='evict images from the page cache before every job')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        if args.corpus:
+            images = [os.path.join(args.corpus, f) for f in sorted(os.listdir(args.corpus))]
+        else:
+            width, height = map(int, args.size.split('x'))
+            print(f'generating {args.pages} pages, {width}x{height}...')
+            images = []
+            for i in range(args.pages):
+                path = os.path.join(directory, f'{i}.jpg')
+                make_image(path, width, height, i)
+                images.append(path)
+        input_size = sum(os.stat(p).st_size for p in images)
+        print(f'{len(images)} pages, {input_size/1e6:.1f} MB' + (', cold cache' if args.cold else ''))
+
+        filename = os.path.join(directory, 'out.pdf')
+        print(f"{'job':<18}{'s':>8}{'user, s':>9}{'sys, s':>8}{'syscalls':>10}{'read(), MB':>12}{'disk, MB':>10}")
+        for job, sendfile in (('prepare', False), ('build read/write', False), ('build sendfile', True)):
+            runs = [bench(job.split()[0], images, filename, sendfile, args.cold) for _ in range(args.repeat)]
+            r = min(runs, key=lambda r: r['s'])
+            # sendfile counts in rchar as well, report bytes read into this process
+            copied = r['rchar'] - (input_size if sendfile else 0)
+            print(f"{job:<18}{r['s']:>8.3f}{r['user']:>9.3f}{r['sys']:>8.3f}{r['syscalls']:>10}{copied/1e6:>12.1f}{r['disk']/1e6:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
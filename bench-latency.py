@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+"""
+Update latency while pdfs compile: a prober sends /help and times the reply, while
+N synthetic users compile at once. The bot runs against the stub Bot API of loadtest.py.
+
+Usage:
+    python bench-latency.py [--compiles 0,1,2,4] [--pages 40] [--files 0.5] [--workers N]
+
+Only probes sent while a compile holds a scheduler slot count, except for N=0 (idle bot).
+If compiling blocked the event loop, latency would grow to the length of a compile.
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+import loadtest
+from loadtest import SimUser, make_corpus, percentile, run_session
+
+PROBER = 999
+
+
+async def probe(stub, interval, compiling, samples, stop):
+    user = SimUser(stub, PROBER, {})
+    while not stop.is_set():
+        busy = compiling()
+        t0 = time.perf_counter()
+        user.text('/help')
+        await user.expect(lambda method, text: method == 'sendMessage', t0 + 60)
+        if busy:
+            samples.append(time.perf_counter() - t0)
+        await asyncio.sleep(interval)
+
+async def run(args, main):
+    rng = random.Random(args.seed)
+    corpus = make_corpus(args.corpus, rng)
+    stub, stop_bot = await loadtest.start_bot(main)
+    print(f"{'compiles':>9}{'probes':>8}{'p50, ms':>9}{'p99, ms':>9}{'max, ms':>9}{'compile, s':>12}")
+    for phase, n in enumerate(int(n) for n in args.compiles.split(',')):
+        samples, stop = [], asyncio.Event()
+        compiling = (lambda: True) if n == 0 else (lambda: main.scheduler.running > 0)
+        prober = asyncio.create_task(probe(stub, args.interval, compiling, samples, stop))
+        if n == 0:
+            await asyncio.sleep(args.idle)
+            results = []
+        else:
+            results = await asyncio.gather(*(
+                run_session(stub, 1000 * (phase + 1) + i, args.pages, corpus, main.STRINGS, random.Random(rng.random()), args.timeout, args.files)
+                for i in range(n)
+            ), return_exceptions=True)
+        stop.set()
+        await prober
+        samples.sort()
+        ok = sorted(r['compile'] for r in results if isinstance(r, dict))
+        failed = len(results) - len(ok)
+        compile_s = f'{percentile(ok, 50):.2f}' if ok else '-'
+        if not samples:
+            print(f"{n:>9}{0:>8}  compiles too short to probe, try more --pages")
+            continue
+        print(
+            f"{n:>9}{len(samples):>8}{percentile(samples, 50)*1000:>9.1f}{percentile(samples, 99)*1000:>9.1f}{samples[-1]*1000:>9.1f}{compile_s:>12}"
+            + (f'  {failed} failed' if failed else '')
+        )
+    await stop_bot()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--compiles', default='0,1,2,4', help='concurrent compiles of every phase')
+    parser.add_argument('--pages', type=int, default=40, help='pages per pdf')
+    parser.add_argument('--files', type=float, default=0.5, help='fraction of pages sent as uncompressed files')
+    parser.add_argument('--corpus', type=int, default=12, help='base images')
+    parser.add_argument('--workers', type=int, help='POOL_WORKERS')
+    parser.add_argument('--interval', type=float, default=0.05, help='seconds between probes')
+    parser.add_argument('--idle', type=float, default=3, help='seconds of probing the idle bot')
+    parser.add_argument('--timeout', type=float, default=600, help='seconds per session')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        settings = [('POOL_WORKERS', str(args.workers))] if args.workers else []
+        bot = loadtest.import_bot(settings)
+        asyncio.run(run(args, bot))
+        os.chdir(loadtest.REPO)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+"""
+Peak memory of compile jobs against the number of pages, per backend.
+
+Usage:
+    python bench-memory.py [--pages 10,50,200] [--size 3000x2000] [--formats jpeg,png] [--backends stream,img2pdf,pymupdf]
+
+Pages cycle through a few synthetic images, so large page counts are cheap to set up.
+Every job runs in a forked process, peak RSS is its own; 'over idle' subtracts the
+peak RSS of a job that does nothing. Streaming backends should stay flat as pages grow,
+bounded by about one decoded image, backends that build the pdf in memory grow with it.
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+from PIL import Image
+
+from compiler import available_backends, build_pdf
+
+
+def make_image(path, width, height, seed):
+    # noise over a gradient, compresses like a photo
+    noise = Image.effect_noise((width, height), 30 + seed % 20).convert('L')
+    gradient = Image.linear_gradient('L').resize((width, height))
+    Image.merge('RGB', (noise, gradient, Image.blend(noise, gradient, 0.5))).save(path)
+
+def run(fn, *args):
+    # fn(*args) in a child process, returns (seconds, peak RSS in MB)
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            fn(*args)
+        except BaseException:
+            code = 1
+        os._exit(code)
+    t0 = time.perf_counter()
+    _, status, usage = os.wait4(pid, 0)
+    t = time.perf_counter() - t0
+    if status != 0:
+        raise RuntimeError(f'job failed, status {status}')
+    return t, usage.ru_maxrss / 1024
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pages', default='10,50,200')
+    parser.add_argument('--size', default='3000x2000', help='WxH of synthetic images')
+    parser.add_argument('--distinct', type=int, default=5, help='distinct images per format')
+    parser.add_argument('--formats', default='jpeg,png')
+    parser.add_argument('--backends', default=','.join(b for b in available_backends() if b != 'magick'))
+    args = parser.parse_args()
+
+    # imports done before forking, jobs don't pay for them
+    import img2pdf, pymupdf
+    _, idle = run(lambda: None)
+    with tempfile.TemporaryDirectory() as directory:
+        width, height = map(int, args.size.split('x'))
+        print(f'{width}x{height} images, decoded {width*height*3/1e6:.0f} MB each, idle job {idle:.0f} MB')
+        print(f"{'format':<8}{'backend':<10}{'pages':>6}{'s':>8}{'RSS, MB':>9}{'over idle':>11}{'pdf, MB':>9}")
+        for fmt in args.formats.split(','):
+            sources = []
+            for i in range(args.distinct):
+                path = os.path.join(directory, f'{i}.{fmt}')
+                make_image(path, width, height, i)
+                sources.append(path)
+            for backend in args.backends.split(','):
+                for pages in (int(n) for n in args.pages.split(',')):
+                    images = [sources[i % len(sources)] for i in range(pages)]
+                    filename = os.path.join(directory, 'out.pdf')
+                    try:
+                        t, rss = run(build_pdf, images, filename, backend)
+                    except RuntimeError as e:
+                        print(f"{fmt:<8}{backend:<10}{pages:>6} {e}")
+                        continue
+                    size = os.stat(filename).st_size
+                    print(f"{fmt:<8}{backend:<10}{pages:>6}{t:>8.2f}{rss:>9.0f}{rss-idle:>11.0f}{size/1e6:>9.1f}")
+                    os.remove(filename)
+
+
+if __name__ == '__main__':
+    main()
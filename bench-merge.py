@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""
+Speed / memory / size of merging user pdfs (compiler.merge_pdf) for save options.
+
+Usage:
+    python bench-merge.py [--pages 100,300,1000] [--parts 4] [--configs 0/0,1/0,3/1]
+
+Synthetic pdfs of text pages with a photo on every page, the same logo on every page
+and the same font in every part, so deduplication has something to find.
+A config is garbage/deflate. Every merge runs in a forked process, peak RSS is its own.
+Time and peak RSS should grow linearly with the number of pages.
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+from PIL import Image
+
+from compiler import merge_pdf
+
+
+def make_pdf(path, pages, seed, logo):
+    import pymupdf
+    doc = pymupdf.open()
+    for i in range(pages):
+        page = doc.new_page()
+        page.insert_text((72, 72), f'part {seed} page {i}\n' + 'lorem ipsum dolor sit amet ' * 40, fontsize=9)
+        photo = Image.effect_noise((320, 240), 20 + (seed * pages + i) % 30).convert('RGB')
+        page.insert_image(pymupdf.Rect(72, 300, 392, 540), pixmap=pymupdf.Pixmap(pymupdf.csRGB, 320, 240, photo.tobytes(), False))
+        page.insert_image(pymupdf.Rect(500, 20, 580, 80), filename=logo)
+    # uncompressed, like many generators write them
+    doc.save(path)
+    doc.close()
+
+def run(parts, filename, garbage, deflate):
+    # merge in a child process, returns (seconds, peak RSS in MB)
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            merge_pdf(parts, filename, garbage, deflate)
+        except BaseException:
+            code = 1
+        os._exit(code)
+    t0 = time.perf_counter()
+    _, status, usage = os.wait4(pid, 0)
+    t = time.perf_counter() - t0
+    if status != 0:
+        raise RuntimeError(f'merge failed, status {status}')
+    return t, usage.ru_maxrss / 1024
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pages', default='100,300,1000', help='total pages of the merged pdf')
+    parser.add_argument('--parts', type=int, default=4)
+    parser.add_argument('--configs', default='0/0,1/0,3/1', help='garbage/deflate pairs')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        logo = os.path.join(directory, 'logo.png')
+        Image.linear_gradient('L').resize((200, 150)).convert('RGB').save(logo)
+        print(f"{'pages':>6}{'config':>8}{'s':>8}{'ms/page':>9}{'RSS, MB':>9}{'in, MB':>8}{'out, MB':>9}")
+        for total in (int(n) for n in args.pages.split(',')):
+            parts = []
+            for i in range(args.parts):
+                path = os.path.join(directory, f'{total}-{i}.pdf')
+                make_pdf(path, total // args.parts, i, logo)
+                parts.append(path)
+            input_size = sum(os.stat(p).st_size for p in parts)
+            for config in args.configs.split(','):
+                garbage, deflate = (int(x) for x in config.split('/'))
+                filename = os.path.join(directory, 'out.pdf')
+                t, rss = run(parts, filename, garbage, bool(deflate))
+                size = os.stat(filename).st_size
+                print(f"{total:>6}{config:>8}{t:>8.2f}{t/total*1000:>9.2f}{rss:>9.0f}{input_size/1e6:>8.1f}{size/1e6:>9.1f}")
+            for path in parts:
+                os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
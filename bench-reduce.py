@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+"""
+Speed / size trade-off of reduced images ('mid' quality) for normalization settings.
+
+Usage:
+    python bench-reduce.py [--pages 10] [--quality 80] [--dpis none,300,200,150] [--gray] [--corpus DIR]
+
+Without --corpus, synthetic sets are generated: phone photos with EXIF rotation,
+document scans, screenshots, PNGs with alpha and GIFs with transparency.
+--gray adds grayscale-scans variants of every setting.
+'plain' is a full resolution re-encode without normalization, for reference.
+Use the results to tune REDUCE_LADDER and JPEG_SUBSAMPLING in constants.py.
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+from PIL import Image
+
+from compiler import reduce_image
+
+
+def make_image(path, width, height, kind, seed):
+    noise = Image.effect_noise((width, height), 30 + seed % 20).convert('L')
+    gradient = Image.linear_gradient('L').resize((width, height))
+    image = Image.merge('RGB', (noise, gradient, Image.blend(noise, gradient, 0.5)))
+    if kind == 'scan':
+        # gray paper with a hint of color
+        image = Image.merge('RGB', (noise, noise, Image.blend(noise, gradient, 0.1)))
+        image.save(path, quality=92)
+    elif kind == 'photo':
+        exif = image.getexif()
+        exif[0x0112] = 6  # shot in portrait
+        image.save(path, quality=92, exif=exif, dpi=(72, 72))
+    elif kind == 'alpha':
+        image.putalpha(gradient)
+        image.save(path)
+    elif kind == 'gif':
+        image.convert('P').save(path, transparency=0)
+    else:
+        image.save(path)
+
+def make_corpus(directory, pages):
+    sets = {
+        'photo': ('.jpg', 4000, 3000),
+        'scan': ('.jpg', 2480, 3508),
+        'screenshot': ('.png', 1170, 2532),
+        'alpha': ('.png', 2000, 1500),
+        'gif': ('.gif', 800, 600),
+    }
+    corpus = {}
+    for name, (ext, width, height) in sets.items():
+        corpus[name] = []
+        for i in range(pages):
+            path = os.path.join(directory, f'{name}-{i}{ext}')
+            make_image(path, width, height, name, i)
+            corpus[name].append(path)
+    return corpus
+
+def plain_reduce(img_path, jpeg_quality):
+    small_img_path = f'{img_path}.q{jpeg_quality}.jpg'
+    Image.open(img_path).convert('RGB').save(small_img_path, 'jpeg', quality=jpeg_quality)
+    return small_img_path
+
+def bench(images, reduce):
+    t, size = 0.0, 0
+    for img_path in images:
+        t0 = time.perf_counter()
+        small_img_path = reduce(img_path)
+        t += time.perf_counter() - t0
+        size += os.stat(small_img_path).st_size
+        os.remove(small_img_path)
+    return t, size
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pages', type=int, default=10)
+    parser.add_argument('--quality', type=int, default=80)
+    parser.add_argument('--dpis', default='none,300,200,150')
+    parser.add_argument('--subsampling', default='4:2:0,4:4:4')
+    parser.add_argument('--gray', action='store_true')
+    parser.add_argument('--corpus', help='directory with images to use instead of synthetic sets')
+    args = parser.parse_args()
+
+    configs = {'plain': lambda p: plain_reduce(p, args.quality)}
+    for dpi in args.dpis.split(','):
+        for subsampling in args.subsampling.split(','):
+            for gray in (False, True) if args.gray else (False,):
+                level = (args.quality, None if dpi == 'none' else int(dpi), gray)
+                configs[f'{dpi}/{subsampling}' + ('/gray' if gray else '')] = (
+                    lambda p, l=level, s=subsampling: reduce_image(p, l, s)
+                )
+
+    with tempfile.TemporaryDirectory() as directory:
+        if args.corpus:
+            files = sorted(os.listdir(args.corpus))
+            corpus = {os.path.basename(args.corpus.rstrip('/')): [os.path.join(args.corpus, f) for f in files]}
+        else:
+            print(f'generating {args.pages} images per set...')
+            corpus = make_corpus(directory, args.pages)
+
+        print(f"{'set':<12}{'dpi/chroma':<19}{'ms/img':>10}{'size, MB':>10}{'of input':>10}")
+        for name, images in corpus.items():
+            input_size = sum(os.stat(p).st_size for p in images)
+            print(f"{name:<12}{'input':<19}{'':>10}{input_size/1e6:>10.2f}")
+            for config, reduce in configs.items():
+                try:
+                    t, size = bench(images, reduce)
+                except Exception as e:
+                    print(f"{name:<12}{config:<19} failed: {e!r}")
+                    continue
+                print(f"{name:<12}{config:<19}{t/len(images)*1000:>10.1f}{size/1e6:>10.2f}{size/input_size:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
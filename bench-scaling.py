@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""
+Scaling of reduced-quality compiles with cores: images are re-encoded as one job each
+on the worker pool, like main.reduce_images, then the pdf is assembled from them.
+
+Usage:
+    python bench-scaling.py [--pages 100] [--size 3000x2000] [--workers 1,2,4] [--level 0]
+
+Synthetic photo-like JPEGs. Reports wall time of the reduce jobs and of the whole compile,
+speedup and parallel efficiency against one worker. Scaling is close to linear while there
+are idle cores; assembly is a single job and doesn't scale.
+"""
+
+import argparse
+import asyncio
+import glob
+import os
+import tempfile
+import time
+
+from PIL import Image
+
+from compiler import build_pdf, reduce_image
+from constants import REDUCE_LADDER, WORKER_PRELOAD
+from workers import WorkerPool
+
+
+def make_image(path, width, height, seed):
+    # noise over a gradient, compresses like a photo
+    noise = Image.effect_noise((width, height), 30 + seed % 20).convert('L')
+    gradient = Image.linear_gradient('L').resize((width, height))
+    Image.merge('RGB', (noise, gradient, Image.blend(noise, gradient, 0.5))).save(path, quality=92)
+
+async def compile_reduced(pool, images, level, filename):
+    # (seconds reducing, seconds in total)
+    t0 = time.perf_counter()
+    small_images = await asyncio.gather(*(pool.run(reduce_image, img_path, level) for img_path in images))
+    t1 = time.perf_counter()
+    await pool.run(build_pdf, small_images, filename, 'stream')
+    return t1 - t0, time.perf_counter() - t0
+
+async def bench(workers, images, level, filename):
+    pool = WorkerPool(workers, preload=WORKER_PRELOAD)
+    await pool.start()
+    try:
+        # workers come up in the background
+        await asyncio.gather(*(pool.run(abs, 0) for _ in range(workers)))
+        return await compile_reduced(pool, images, level, filename)
+    finally:
+        pool.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pages', type=int, default=100)
+    parser.add_argument('--size', default='3000x2000', help='WxH of synthetic images')
+    parser.add_argument('--workers', default=','.join(str(2 ** i) for i in range((os.cpu_count() or 1).bit_length())))
+    parser.add_argument('--level', type=int, default=0, help='index in REDUCE_LADDER')
+    args = parser.parse_args()
+    level = REDUCE_LADDER[args.level]
+
+    with tempfile.TemporaryDirectory() as directory:
+        width, height = map(int, args.size.split('x'))
+        print(f'generating {args.pages} images, {width}x{height}, level {level}...')
+        images = []
+        for i in range(args.pages):
+            path = os.path.join(directory, f'{i}.jpg')
+            make_image(path, width, height, i)
+            images.append(path)
+
+        print(f"{'workers':>8}{'reduce, s':>11}{'total, s':>10}{'ms/img':>8}{'speedup':>9}{'efficiency':>12}")
+        base = None
+        for workers in (int(n) for n in args.workers.split(',')):
+            reduce_t, total = asyncio.run(bench(workers, images, level, os.path.join(directory, 'out.pdf')))
+            base = base or total
+            print(f"{workers:>8}{reduce_t:>11.2f}{total:>10.2f}{total/len(images)*1000:>8.1f}{base/total:>9.2f}{base/total/workers:>12.2f}")
+            for path in glob.glob(os.path.join(directory, '*.q*.jpg')):
+                os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
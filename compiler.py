@@ -0,0 +1,381 @@
+"""
+PDF compilation. Everything here runs inside worker processes.
+
+pymupdf and img2pdf are imported on first use: the bot process only needs
+references to the jobs and choose_backend. Workers have them preloaded
+(WORKER_PRELOAD in constants.py).
+"""
+
+import math
+import os
+import shutil
+import subprocess
+import sys
+
+from PIL import Image, ImageStat
+
+from constants import REDUCE_LADDER, MAGICK_BIN, PDF_BACKEND, PAGE_SIZE, JPEG_SUBSAMPLING, GRAYSCALE_MAX_SATURATION, MERGE_GARBAGE, MERGE_DEFLATE
+
+
+DEFAULT_DPI = 96  # of images without dpi info, same as img2pdf
+EXIF_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+
+#### Image preparation
+
+def page_pixels(dpi):
+    # (short side, long side) of the page in pixels
+    short, long = PAGE_SIZE
+    return short * dpi, long * dpi
+
+def fit_scale(width, height, dpi):
+    # scale that fits the image onto the page at `dpi` in either orientation. Never upscales
+    if dpi is None:
+        return 1.0
+    short, long = page_pixels(dpi)
+    return min(1.0, short / min(width, height), long / max(width, height))
+
+def is_scan(image):
+    # mostly colorless RGB image, e.g. a photographed or scanned document. Judged on a thumbnail
+    thumb = image.reduce(max(1, max(image.size) // 256))
+    return ImageStat.Stat(thumb.convert('HSV').getchannel('S')).mean[0] <= GRAYSCALE_MAX_SATURATION
+
+def normalize_image(image, dpi, gray=False):
+    """
+    Upright RGB or L copy of an opened image, alpha flattened onto white, resized to fit the page at `dpi`.
+    gray: scans become grayscale.
+    Returns (image, scale), scale relative to the original pixel size.
+    """
+    width = max(image.size)
+    if image.format == 'JPEG':
+        # decode at 1/2, 1/4 or 1/8 scale if the result is still large enough. Skips most of the decoding work
+        scale = fit_scale(image.width, image.height, dpi)
+        image.draft(None, (math.ceil(image.width * scale), math.ceil(image.height * scale)))
+    orientation = image.getexif().get(0x0112, 1)
+
+    if image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info:
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, 'white')
+        background.paste(image, mask=image.getchannel('A'))
+        image = background
+    elif image.mode in ('1', 'I;16'):
+        image = image.convert('L')
+    elif image.mode not in ('RGB', 'L'):
+        # P, CMYK, YCbCr
+        image = image.convert('RGB')
+
+    scale = fit_scale(image.width, image.height, dpi)
+    if scale < 1.0:
+        size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        image = image.resize(size, Image.Resampling.BICUBIC, reducing_gap=2.0)
+    if gray and image.mode == 'RGB' and is_scan(image):
+        image = image.convert('L')
+    # rotate last, it copies the whole image
+    if orientation in EXIF_TRANSPOSE:
+        image = image.transpose(EXIF_TRANSPOSE[orientation])
+    return image, max(image.size) / width
+
+def is_pdf(path):
+    # pdfs sent by users are merged page by page, never rendered or reduced
+    return path.endswith('.pdf')
+
+def variant_path(img_path, level):
+    jpeg_quality, dpi, gray = level
+    return f'{img_path}.q{jpeg_quality}' + (f'-{dpi}dpi' if dpi else '') + ('-gray' if gray else '') + '.jpg'
+
+def reduce_image(img_path, level, subsampling=JPEG_SUBSAMPLING):
+    # JPEG copy of a single image at a REDUCE_LADDER level: (jpeg quality, dpi, grayscale scans).
+    # dpi None keeps the full resolution. One job per image, so images are re-encoded in parallel.
+    jpeg_quality, dpi, gray = level
+    small_img_path = variant_path(img_path, level)
+    with Image.open(img_path) as image:
+        original_dpi = image.info.get('dpi') or (DEFAULT_DPI, DEFAULT_DPI)
+        image, scale = normalize_image(image, dpi, gray)
+        # same page size as the original
+        dpi_x, dpi_y = ((d if d and d > 0 else DEFAULT_DPI) * scale for d in original_dpi)
+        image.save(small_img_path, 'jpeg', quality=jpeg_quality, subsampling=subsampling, dpi=(dpi_x, dpi_y))
+    return small_img_path
+
+def prepare_pdf(pdf_path):
+    import pymupdf
+    # raises on broken files
+    with pymupdf.open(pdf_path) as doc:
+        if doc.needs_pass:
+            raise ValueError('encrypted pdf')
+        if doc.page_count == 0:
+            raise ValueError('empty pdf')
+        return {'size': os.stat(pdf_path).st_size, 'format': 'PDF', 'pages': doc.page_count}
+
+def prepare_image(img_path, reduce, level=REDUCE_LADDER[0]):
+    # Runs in background as soon as the image is downloaded:
+    # validate it, read its header and, in low quality mode, reduce it ahead of compilation.
+    if is_pdf(img_path):
+        return prepare_pdf(img_path)
+    with Image.open(img_path) as image:
+        info = {
+            'size': os.stat(img_path).st_size,
+            'format': image.format,
+            'mode': image.mode,
+            'width': image.width,
+            'height': image.height,
+            'alpha': image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info,
+            'interlace': bool(image.info.get('interlace')),
+        }
+        image.verify()
+    if reduce:
+        # reduced at `level`
+        info['small'] = reduce_image(img_path, level)
+        info['small_size'] = os.stat(info['small']).st_size
+    return info
+
+
+#### PDF assembly. Images are already prepared, pages follow the order of `images`
+
+def pymupdf_compile_pdf(images, filename):
+    import pymupdf
+    doc = pymupdf.open()
+    for img_path in images:
+        doc.insert_file(img_path)
+    doc.save(filename)
+    doc.close()
+
+def img2pdf_compile_pdf(images, filename):
+    import img2pdf
+    # write straight to the file, not through one big bytes object
+    with open(filename,"wb") as f:
+        img2pdf.convert(images, outputstream=f)
+
+
+#### Streaming assembly: pdf is written page by page, JPEG files are copied into it as they are.
+# Peak memory does not depend on the number of pages.
+
+JPEG_COLORSPACES = {'L': b'/DeviceGray', 'RGB': b'/DeviceRGB', 'CMYK': b'/DeviceCMYK'}
+EXIF_ROTATION = {1: 0, 3: 180, 6: 90, 8: 270}
+# Copy JPEGs into the pdf with sendfile: the kernel copies page cache to page cache, image bytes
+# never pass through the worker. File to file sendfile is Linux only, elsewhere read/write.
+SENDFILE = sys.platform.startswith('linux')
+
+def _jpeg_page(img_path):
+    # page parameters of a JPEG that can be embedded as is, None otherwise. Reads the header only.
+    with open(img_path, 'rb') as f, Image.open(f) as image:
+        if image.format != 'JPEG' or image.mode not in JPEG_COLORSPACES:
+            return None
+        rotation = EXIF_ROTATION.get(image.getexif().get(0x0112, 1))
+        if rotation is None:
+            # mirrored orientations need a transformation matrix
+            return None
+        dpi = image.info.get('dpi') or (DEFAULT_DPI, DEFAULT_DPI)
+        dpi_x, dpi_y = (d if d and d > 0 else DEFAULT_DPI for d in dpi)
+        return {
+            'path': img_path,
+            'size': os.fstat(f.fileno()).st_size,
+            'width': image.width,
+            'height': image.height,
+            'mode': image.mode,
+            'page_width': image.width * 72 / dpi_x,
+            'page_height': image.height * 72 / dpi_y,
+            'rotation': rotation,
+        }
+
+class _PdfStream:
+    """Minimal sequential pdf writer. Object 1 is the catalog, object 2 is the page tree, both written last."""
+
+    def __init__(self, f):
+        self.f = f
+        self.offsets = {}
+        self.pages = []
+        self.next_num = 3
+        f.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+
+    def _begin(self, num):
+        self.offsets[num] = self.f.tell()
+        self.f.write(b'%d 0 obj\n' % num)
+
+    def obj(self, num, body):
+        self._begin(num)
+        self.f.write(body + b'\nendobj\n')
+
+    def add_page(self, page):
+        img_num, content_num, page_num = self.next_num, self.next_num + 1, self.next_num + 2
+        self.next_num += 3
+
+        self._begin(img_num)
+        self.f.write(
+            b'<< /Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace %s /BitsPerComponent 8 /Filter /DCTDecode /Length %d'
+            % (page['width'], page['height'], JPEG_COLORSPACES[page['mode']], page['size'])
+        )
+        if page['mode'] == 'CMYK':
+            # Adobe CMYK JPEGs are stored inverted
+            self.f.write(b' /Decode [1 0 1 0 1 0 1 0]')
+        self.f.write(b' >>\nstream\n')
+        with open(page['path'], 'rb') as img:
+            self._copy(img, page['size'])
+        self.f.write(b'\nendstream\nendobj\n')
+
+        w, h = b'%.4f' % page['page_width'], b'%.4f' % page['page_height']
+        content = b'q\n%s 0 0 %s 0 0 cm\n/Im0 Do\nQ' % (w, h)
+        self.obj(content_num, b'<< /Length %d >>\nstream\n%s\nendstream' % (len(content), content))
+        self.obj(page_num,
+            b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %s %s] /Rotate %d /Resources << /XObject << /Im0 %d 0 R >> >> /Contents %d 0 R >>'
+            % (w, h, page['rotation'], img_num, content_num)
+        )
+        self.pages.append(page_num)
+
+    def _copy(self, src, size):
+        sent = 0
+        if SENDFILE:
+            self.f.flush()
+            offset = self.f.tell()
+            try:
+                while sent < size:
+                    n = os.sendfile(self.f.fileno(), src.fileno(), sent, size - sent)
+                    if n == 0:
+                        break
+                    sent += n
+            except OSError:
+                # not supported here, the rest goes through read/write
+                pass
+            # sendfile wrote behind the file object's back
+            self.f.seek(offset + sent)
+        src.seek(sent)
+        shutil.copyfileobj(src, self.f)
+
+    def close(self):
+        kids = b' '.join(b'%d 0 R' % num for num in self.pages)
+        self.obj(2, b'<< /Type /Pages /Kids [%s] /Count %d >>' % (kids, len(self.pages)))
+        self.obj(1, b'<< /Type /Catalog /Pages 2 0 R >>')
+        xref = self.f.tell()
+        self.f.write(b'xref\n0 %d\n0000000000 65535 f \n' % self.next_num)
+        for num in range(1, self.next_num):
+            self.f.write(b'%010d 00000 n \n' % self.offsets[num])
+        self.f.write(b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (self.next_num, xref))
+
+def stream_compile_pdf(images, filename):
+    # JPEGs only (telegram photos, reduced images). Anything else goes through img2pdf.
+    pages = [_jpeg_page(img_path) for img_path in images]
+    if None in pages:
+        img2pdf_compile_pdf(images, filename)
+        return
+    with open(filename, 'wb') as f:
+        pdf = _PdfStream(f)
+        for page in pages:
+            pdf.add_page(page)
+        pdf.close()
+
+
+#### Backends. Every backend takes prepared images in page order and writes the pdf to filename.
+
+def magick_compile_pdf(images, filename):
+    subprocess.run([MAGICK_BIN, *images, filename], check=True, capture_output=True)
+
+BACKENDS = {
+    'stream': stream_compile_pdf,
+    'img2pdf': img2pdf_compile_pdf,
+    'pymupdf': pymupdf_compile_pdf,
+    'magick': magick_compile_pdf,
+}
+
+def available_backends():
+    return [name for name in BACKENDS if name != 'magick' or shutil.which(MAGICK_BIN)]
+
+def choose_backend(infos):
+    """
+    Pick the fastest backend that handles all images correctly. infos as from prepare_image,
+    None for images known to be JPEG (e.g. reduced ones).
+    """
+    if PDF_BACKEND is not None:
+        return PDF_BACKEND
+    infos = [info for info in infos if info is not None and info['format'] != 'PDF']
+    if all(info['format'] == 'JPEG' for info in infos):
+        # copied as is, no decoding, any size
+        return 'stream'
+    if any(info.get('alpha') for info in infos):
+        # img2pdf computes the soft mask in python, pymupdf does it in C
+        return 'pymupdf'
+    # PNG passthrough, GIF
+    return 'img2pdf'
+
+def merge_pdf(parts, filename, garbage=MERGE_GARBAGE, deflate=MERGE_DEFLATE):
+    # Page trees of the parts are copied, page content is not re-encoded. One part is open at a time.
+    # garbage=3 also merges duplicate objects (fonts, images repeated across parts), deflate compresses uncompressed streams.
+    import pymupdf
+    doc = pymupdf.open()
+    for part in parts:
+        with pymupdf.open(part) as src:
+            doc.insert_pdf(src)
+    doc.save(filename, garbage=garbage, deflate=deflate)
+    doc.close()
+
+def build_pdf(images, filename, backend):
+    if not any(is_pdf(path) for path in images):
+        BACKENDS[backend](images, filename)
+        return
+    # pdfs sent by users: runs of images between them are compiled with `backend`, then everything is merged
+    parts, run, tmp = [], [], []
+    for path in images + [None]:
+        if path is not None and not is_pdf(path):
+            run.append(path)
+            continue
+        if run:
+            part = f'{filename}.part{len(tmp)}'
+            BACKENDS[backend](run, part)
+            parts.append(part)
+            tmp.append(part)
+            run = []
+        if path is not None:
+            parts.append(path)
+    try:
+        merge_pdf(parts, filename)
+    finally:
+        for part in tmp:
+            os.remove(part)
+
+
+def patch_pdf(filename, layout, backend):
+    """
+    Edit a compiled pdf in place. layout lists the pages of the edited pdf: page numbers of
+    the old one, or paths of new images (compiled with `backend`) and pdfs.
+    Old pages keep their encoded content. Saved incrementally if no page was removed,
+    otherwise rewritten without the removed pages' objects, streams are still copied as they are.
+    """
+    import pymupdf
+    doc = pymupdf.open(filename)
+    old = [x for x in layout if isinstance(x, int)]
+    removed = len(set(old)) < doc.page_count
+    doc.select(old)
+    pos, tmp = 0, []
+    try:
+        for x in layout:
+            if isinstance(x, int):
+                pos += 1
+                continue
+            if not is_pdf(x):
+                part = f'{filename}.part{len(tmp)}'
+                BACKENDS[backend]([x], part)
+                tmp.append(part)
+                x = part
+            with pymupdf.open(x) as src:
+                doc.insert_pdf(src, start_at=pos)
+                pos += src.page_count
+        if removed or not doc.can_save_incrementally():
+            doc.save(f'{filename}.partnew', garbage=1)
+            doc.close()
+            os.replace(f'{filename}.partnew', filename)
+        else:
+            doc.saveIncr()
+            doc.close()
+    finally:
+        for part in tmp:
+            os.remove(part)
+
+
+# Jobs workers may run by name (distributed mode, see jobqueue.py)
+JOBS = {fn.__name__: fn for fn in (prepare_image, reduce_image, build_pdf, patch_pdf)}
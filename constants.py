@@ -1,24 +1,88 @@
 
 
+import os
+
 # States
-FILENAME, CONTENT, QUICK_FILENAME, PDF_PENDING = range(4)
+FILENAME, CONTENT, QUICK_FILENAME, PDF_PENDING, EDIT = range(5)
 
 # pdf converter
 DEFAULT_QUALITY = 100
 MAGICK_BIN = 'convert'
-MAGICK, IMG2PDF = range(2)
+PDF_BACKEND = None  # force one of compiler.BACKENDS, None to choose per job
+MERGE_GARBAGE = 3  # pymupdf garbage collection when merging user pdfs: 3 also deduplicates objects, 0 to skip
+MERGE_DEFLATE = True  # compress uncompressed streams of merged pdfs. Slow on such pdfs (see bench-merge.py), free on the rest
 MAX_IMG_N = 100
 MAX_FILENAME_LEN = 60
 MAX_PDFSIZE = 18_000_000 # ~18 MB
 MAX_IMG_SIZE = 10_000_000 # ~10 MB
 MAX_TOTAL_IMG_SIZE = MAX_PDFSIZE * 4  # because compression 
 COMPILATION_TIMEOUT = 30.0  # seconds
-POOL_WORKERS = 1
+# Reduced images (jpeg quality, dpi, grayscale scans), best first. The best level that fits under MAX_PDFSIZE is used.
+# Images are downsized to fit PAGE_SIZE at dpi. Grayscale levels store mostly colorless images (document scans) as gray.
+REDUCE_LADDER = [
+    (80, 200, False),
+    (65, 200, False),
+    (65, 150, False),
+    (50, 150, False),
+    (50, 150, True),
+    (50, 110, True),
+    (35, 110, True),
+    (35, 75, True),
+]
+PAGE_SIZE = (8.27, 11.69)  # inches, A4
+GRAYSCALE_MAX_SATURATION = 40  # mean HSV saturation (0-255) of images treated as scans
+JPEG_SUBSAMPLING = '4:2:0'  # of reduced images. '4:4:4' keeps sharp colored text, files are larger
+EDIT_TTL = 10 * 60  # seconds a sent pdf can be fixed before the session is deleted. Privacy: mentioned in help
+SIZE_SAFETY_MARGIN = 0.95  # aim for this fraction of MAX_PDFSIZE when estimating
+REDUCE_SAMPLES = 3  # images reduced to estimate reduced pdf size
+POOL_WORKERS = os.cpu_count() or 1
+WORKER_PRELOAD = ['compiler', 'pymupdf', 'img2pdf']  # imported once by the forkserver, workers start warm
+WORKER_MAX_JOBS = 500  # worker process is replaced after this many jobs, caps leaked memory
+JOB_QUEUE = None  # sqlite job queue file for distributed mode (see worker.py), None for local worker processes
+MAX_QUEUED_JOBS = 50  # compile jobs waiting for a worker
+MAX_JOBS_PER_USER = 1  # compile jobs in flight per user
+MAX_CONCURRENT_DOWNLOADS = 16  # image downloads in flight, all users
+ALBUM_REPLY_DELAY = 1.0  # seconds to wait for more album images before replying
+IMAGE_CACHE_DIR = 'cache/store'  # shared content-addressed image cache
+IMAGE_CACHE_BUDGET = 2_000_000_000  # ~2 GB
+IMAGE_CACHE_TTL = 30 * 60  # seconds after last use. Privacy: mentioned in help
+IMAGE_CACHE_EXPIRY_INTERVAL = 60  # seconds
+DISK_BUDGET = 5_000_000_000  # ~5 GB, session directories and image cache together. Image cache is shrunk first
+USER_DISK_BUDGET = MAX_TOTAL_IMG_SIZE + 3 * MAX_PDFSIZE  # images, reduced images and the pdf of one session
+DISK_ADMIT_NEW = 0.8  # fraction of DISK_BUDGET above which new sessions are refused, running ones may finish
+COMPILE_DISK_RESERVE = 2 * MAX_PDFSIZE  # free space /compile needs: reduced images and the pdf
+DISK_RESCAN_INTERVAL = 60  # seconds, picks up files written by workers
+SCRATCH_DIR = None  # e.g. '/dev/shm/tgpdf', RAM-backed directory for sessions, None to keep all sessions in cache/
+SCRATCH_BUDGET = 500_000_000  # ~500 MB of SCRATCH_DIR, keep well below the tmpfs size
+SCRATCH_SESSION_RESERVE = 30_000_000  # scratch bytes reserved per session, most sessions are smaller
+UPLOAD_RETRIES = 2  # on network errors other than timeout
+UPLOAD_TIMEOUT = 30.0  # seconds, write and connect
+STATS_DB = 'stats.sqlite3'
+STATS_FLUSH_INTERVAL = 10.0  # seconds
+SESSIONS_DB = 'sessions.sqlite3'  # in-progress pdfs, survive restarts
+SESSIONS_UPDATE_INTERVAL = 5.0  # seconds, at most this much of session changes is lost on a crash
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9108  # None to disable the /metrics endpoint
+METRICS_SUMMARY_INTERVAL = 24 * 60 * 60  # seconds between summaries to ADMIN_UID, None to disable
+# Per-user rate limits: (tokens, seconds to refill all of them). Bursts up to `tokens` pass
+RATE_LIMITS = {
+    'images': (MAX_IMG_N, 60),  # images per minute, a whole pdf at once
+    'compiles': (20, 60 * 60),  # compiles per hour
+    'cpu': (30 * 60, 24 * 60 * 60),  # worker CPU seconds per day
+}
+RATE_LIMITS_FILE = 'ratelimits.json'  # buckets are saved here on shutdown, None to forget them on restart
+RATE_LIMITS_PRUNE_INTERVAL = 10 * 60  # seconds
 LIMITS = f"{MAX_IMG_N} imgs, {int(MAX_IMG_SIZE/1e6)} MB per img, {int(MAX_PDFSIZE/1e6)} MB total ({int(MAX_TOTAL_IMG_SIZE/1e6)} MB in low quality mode)"
 
 # Bot settings
 ADMIN_UID = 211399446
 BOT_USERNAME = "abstractpdf_bot"
+MAX_CONCURRENT_UPDATES = 64  # updates processed at once, one user's updates are always in order
+DROP_PENDING_UPDATES = False  # process updates sent while the bot was down
+WEBHOOK_URL = None  # e.g. "https://example.com", None for polling. Secret token from WEBHOOK_SECRET env var
+WEBHOOK_LISTEN = '127.0.0.1'  # behind a reverse proxy
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = '/tgpdf'
 
 # Show donation request after successful compilation
 REQUEST_DONATION = True
@@ -54,12 +118,12 @@ STRINGS['tg_info_pdf_success'] = (
 )
 STRINGS['tg_info_newpdf'] = "New PDF. Enter document name (/help ?)"
 STRINGS['tg_info_newpdf_name_accepted'] = (
-    'Got it. Now send the contents of your pdf: telegram photos, JPG, PNG, GIF.\n'
+    'Got it. Now send the contents of your pdf: telegram photos, JPG, PNG, GIF, PDF.\n'
     f'Current limits: {LIMITS}.\n'
     'When you are ready, send /compile. Send /cancel to cancel.'
 )
 STRINGS['tg_info_newpdf_quick'] = (
-    'You are creating a new pdf. Supported formats: telegram photos, JPG, PNG, GIF.\n'
+    'You are creating a new pdf. Supported formats: telegram photos, JPG, PNG, GIF, PDF.\n'
     f'Current limits: {LIMITS}.\n'
     'Send /compile when you are ready. Send /cancel to cancel.'
 )
@@ -73,9 +137,23 @@ STRINGS['tg_info_low_quality_mode'] = (
     f'PDF size limit reached. Entering low quality mode. This may or may not help!'
 )
 STRINGS['tg_info_img_ok'] = 'image {} added'
+STRINGS['tg_info_imgs_ok'] = '{} images added'
 STRINGS['tg_info_enter_name'] = "Enter document name"
 STRINGS['tg_info_no_imgs'] = "Send some images first"
 STRINGS['tg_info_cancel'] = "Okay, aborting."
+STRINGS['tg_info_queue_position'] = "Bot is busy. You are #{} in queue, please wait."
+STRINGS['tg_info_compiling_busy'] = "Your pdf is being compiled, please wait."
+STRINGS['tg_info_start_patching'] = 'updating your pdf...'
+STRINGS['tg_info_edit'] = (
+    f'You can fix this pdf for {EDIT_TTL // 60} minutes: /remove N, /move N M, '
+    'or edit an image message to replace its page. Then /compile again. /done when finished.'
+)
+STRINGS['tg_info_edit_done'] = 'Done. Send images or /newpdf for a new pdf.'
+STRINGS['tg_info_edit_expired'] = 'Nothing to edit, your last pdf is deleted. Send images or /newpdf for a new pdf.'
+STRINGS['tg_info_page_removed'] = 'page {} removed'
+STRINGS['tg_info_page_moved'] = 'page {} moved to {}'
+STRINGS['tg_info_page_replaced'] = 'page {} replaced'
+STRINGS['tg_info_session_recovered'] = "Bot was restarted. Your pdf in progress is kept ({} images). Send more images, /compile or /cancel."
 
 STRINGS['tg_err_no_img_format'] = "cannot recognize image format"
 STRINGS['tg_err_unsupported_img_format'] = "unsupported image format"
@@ -85,22 +163,32 @@ STRINGS['tg_err_img_error'] = 'something gone wrong saving this image, try again
 STRINGS['tg_err_too_many'] = 'Too many photos, sorry. Aborting.'
 STRINGS['tg_err_pdf_too_big'] = 'Sorry, pdf is too large for telegram. Try again with less images, using lower quality images, or sending with telegram compression'
 STRINGS['tg_err_bot'] = 'bot error, sorry. try again later, with less images, with lower quality images, or sending photos using telegram compression'
+STRINGS['tg_err_disk_full'] = 'Bot is out of space, sorry. Try again later.'
+STRINGS['tg_err_disk_full_compile'] = 'Bot is out of space, sorry. Send /compile again in a minute or /cancel.'
+STRINGS['tg_err_queue_full'] = 'Bot is overloaded, sorry. Send /compile again in a minute or /cancel.'
+STRINGS['tg_err_edit_usage'] = 'Usage: /remove N or /move N M, N and M are page numbers'
+STRINGS['tg_err_rate_limited'] = 'Too many requests, please slow down. Try again in {} min.'
 STRINGS['tg_err_unknown_cmd'] = 'Unknown command, sorry. Try /cancel or /help'
 STRINGS['tg_err_unimplemented'] = "Further development is in progress! 🚧"
 STRINGS['tg_err_timeout'] = 'pdf compilation took too long. try again with less images or lower image quality (e.g. sending as photos and not files)'
+STRINGS['tg_err_upload'] = 'failed to send pdf, sorry. try again later.'
 STRINGS['tg_err_upload_timeout_but_ok'] = 'pdf upload is taking longer than expected. if you don\'t receive the file in a minute or so, try again with smaller pdf.'
 
 STRINGS['tg_warn_unknown_error_retry'] = "Unknown error. Trying again with lower quality."
 STRINGS['tg_warn_timeout_retry'] = "PDF compilation takes too long. Trying lower quality."
 STRINGS['tg_warn_size_retry'] = "PDF is too big. Trying lower quality."
+STRINGS['tg_warn_img_broken'] = "Skipping broken images: {}"
 STRINGS['tg_warn_size_retry_n'] = "PDF is too big ({}). Trying lower quality."
 
 STRINGS['tg_help'] = (
-        'I create PDF from your images: photos (sent with telegram compression, \'as photo\') and jpg/png/gif files (sent without compression, \'as file\').\n'
+        'I create PDF from your images: photos (sent with telegram compression, \'as photo\') and jpg/png/gif files (sent without compression, \'as file\'). PDF files are added page by page.\n'
         'Just send me some images and click /compile. '
-        'You can cancel adding images using /cancel.\n\n'
+        'You can cancel adding images using /cancel.\n'
+        'Fix pages with /remove N, /move N M, or edit an image message to replace its page. '
+        f'After the pdf is sent, fixes are possible for {EDIT_TTL // 60} minutes, until /done.\n\n'
         f'<b>Current limits: {LIMITS}</b>\n'
-        'This bot collects per-user statistics, but deletes all your images and pdfs as soon as possible after success, failure, or /cancel. '
+        'This bot collects per-user statistics, but deletes all your pdfs as soon as possible after success (and the time to fix it), failure, or /cancel. '
+        f'Your images are kept for {IMAGE_CACHE_TTL // 60} minutes after last use, so that sending them again is fast. '
         'Neverthless, do not use this bot for sensitive info, and don\'t trust random software on the internet.\n\n'
         'Developed by @mkrooted with python-telegram-bot and img2pdf.\n'
         f'If you are enjoying this bot, {DONATIONS_TEXT}'
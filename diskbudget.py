@@ -0,0 +1,141 @@
+import asyncio
+import logging
+import os
+import shutil
+
+logger = logging.getLogger(__name__)
+
+
+class DiskBudget:
+    """
+    Disk use of session directories (cache/<uid>) and the image cache store against a global budget.
+
+    - bytes are counted per session by scanning its directory, on every change the bot makes
+      and periodically for changes made by workers. Files hardlinked from the image cache
+      are counted there.
+    - admission control: new sessions are refused above `admit_new` of the budget, images and
+      compilations when they don't fit. The image cache is a cache: it is shrunk first.
+      Downloads reserve their size until they are on disk, concurrent ones can't overshoot.
+    - optional RAM-backed scratch directory (tmpfs) for sessions, while reserves of all
+      scratch sessions fit in `scratch_budget`. cache/<uid> is then a symlink into it,
+      so session paths don't change. Keep `scratch_budget` well below the tmpfs size:
+      a session may outgrow its reserve.
+    """
+
+    def __init__(self, directory, budget, user_budget, admit_new, imgcache, scratch_dir=None, scratch_budget=0, scratch_reserve=0):
+        self.directory = directory
+        self.budget = budget
+        self.user_budget = user_budget
+        self.admit_new = admit_new
+        self.imgcache = imgcache
+        self.scratch_dir = scratch_dir
+        self.scratch_budget = scratch_budget
+        self.scratch_reserve = scratch_reserve
+        self.usage = {}  # uid -> bytes of session directory
+        self.reserved = {}  # uid -> bytes of writes in progress, see reserve
+        self.scratch = set()  # uids with session directory in scratch
+        if scratch_dir is not None:
+            os.makedirs(scratch_dir, exist_ok=True)
+
+    @property
+    def total(self):
+        return sum(self.usage.values()) + sum(self.reserved.values()) + self.imgcache.size
+
+    @property
+    def scratch_used(self):
+        return sum(max(self.usage.get(uid, 0), self.scratch_reserve) for uid in self.scratch)
+
+    def session_dir(self, uid):
+        return os.path.join(self.directory, str(uid))
+
+    def create_session(self, uid):
+        # session directory, in scratch if there is room. Does nothing if it exists
+        path = self.session_dir(uid)
+        if os.path.lexists(path):
+            return path
+        if self.scratch_dir is not None and self.scratch_used + self.scratch_reserve <= self.scratch_budget:
+            target = os.path.join(self.scratch_dir, str(uid))
+            os.makedirs(target, exist_ok=True)
+            os.symlink(os.path.abspath(target), path)
+            self.scratch.add(uid)
+        else:
+            os.makedirs(path)
+        self.usage[uid] = 0
+        return path
+
+    def remove_session(self, uid):
+        path = self.session_dir(uid)
+        if os.path.islink(path):
+            shutil.rmtree(os.path.realpath(path), ignore_errors=True)
+            os.remove(path)
+        elif os.path.isdir(path):
+            shutil.rmtree(path)
+        self.usage.pop(uid, None)
+        self.reserved.pop(uid, None)
+        self.scratch.discard(uid)
+
+    def scan(self, uid):
+        size = 0
+        try:
+            with os.scandir(self.session_dir(uid)) as entries:
+                for entry in entries:
+                    st = entry.stat()
+                    if st.st_nlink == 1:
+                        size += st.st_size
+        except FileNotFoundError:
+            self.usage.pop(uid, None)
+            return 0
+        self.usage[uid] = size
+        return size
+
+    def free(self, nbytes) -> bool:
+        # make room for nbytes more, shrinking the image cache if needed
+        excess = self.total + nbytes - self.budget
+        if excess > 0:
+            self.imgcache.shrink(max(0, self.imgcache.size - excess))
+        return self.total + nbytes <= self.budget
+
+    def admit_session(self) -> bool:
+        return self.free(self.budget * (1 - self.admit_new))
+
+    def admit(self, uid, nbytes) -> bool:
+        """Can session `uid` write nbytes more."""
+        if self.scan(uid) + self.reserved.get(uid, 0) + nbytes > self.user_budget:
+            return False
+        return self.free(nbytes)
+
+    def reserve(self, uid, nbytes) -> bool:
+        """admit, and count nbytes as used until release(uid, nbytes)."""
+        if not self.admit(uid, nbytes):
+            return False
+        self.reserved[uid] = self.reserved.get(uid, 0) + nbytes
+        return True
+
+    def release(self, uid, nbytes):
+        left = self.reserved.pop(uid, 0) - nbytes
+        if left > 0:
+            self.reserved[uid] = left
+
+    def recover(self, uids):
+        # on startup: register sessions of `uids`, remove directories of all other sessions
+        for name in os.listdir(self.directory):
+            if not name.isdigit():
+                continue
+            uid = int(name)
+            if uid not in uids:
+                self.remove_session(uid)
+                continue
+            if os.path.islink(self.session_dir(uid)):
+                self.scratch.add(uid)
+            self.scan(uid)
+        if self.scratch_dir is not None:
+            for name in os.listdir(self.scratch_dir):
+                if not name.isdigit() or int(name) not in self.scratch:
+                    shutil.rmtree(os.path.join(self.scratch_dir, name), ignore_errors=True)
+
+    async def rescan_periodically(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            for uid in list(self.usage):
+                self.scan(uid)
+            logger.info(f"disk: {self.total/1e6:.0f} / {self.budget/1e6:.0f} MB, {len(self.usage)} sessions, scratch {len(self.scratch)}")
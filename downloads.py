@@ -0,0 +1,65 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class DownloadManager:
+    """
+    Runs image downloads in background with bounded concurrency.
+
+    Handlers submit a download and return right away, so an album of 50 photos
+    is fetched in parallel instead of one message at a time. Downloads go through
+    the bot's own pooled http client; this class only bounds how many run at once.
+    Downloads complete in any order; callers keep page order themselves.
+    A download reserves its expected size until it ends, limits are checked against
+    pending(uid) and reserved(uid) before submitting.
+    """
+
+    def __init__(self, max_concurrent):
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self._tasks = {}  # uid -> set of tasks
+        self._reserved = {}  # uid -> bytes of downloads in progress
+
+    async def _run(self, coro):
+        async with self._semaphore:
+            await coro
+
+    def submit(self, uid, coro, size=0):
+        tasks = self._tasks.setdefault(uid, set())
+        task = asyncio.create_task(self._run(coro))
+        tasks.add(task)
+        self._reserved[uid] = self._reserved.get(uid, 0) + size
+
+        def done(task):
+            tasks.discard(task)
+            left = self._reserved.pop(uid, 0) - size
+            if left > 0:
+                self._reserved[uid] = left
+            if not tasks and self._tasks.get(uid) is tasks:
+                del self._tasks[uid]
+            if not task.cancelled() and task.exception() is not None:
+                logger.error(f"u{uid} download failed", exc_info=task.exception())
+
+        task.add_done_callback(done)
+        return task
+
+    @property
+    def in_flight(self):
+        return sum(len(tasks) for tasks in self._tasks.values())
+
+    def pending(self, uid) -> int:
+        return len(self._tasks.get(uid, ()))
+
+    def reserved(self, uid) -> int:
+        return self._reserved.get(uid, 0)
+
+    async def wait(self, uid):
+        # wait for all downloads of a user, including ones submitted meanwhile
+        # asyncio.wait, unlike gather, does not cancel the downloads if the waiter is cancelled
+        while self._tasks.get(uid):
+            await asyncio.wait(list(self._tasks[uid]))
+
+    def cancel(self, uid):
+        for task in self._tasks.pop(uid, ()):
+            task.cancel()
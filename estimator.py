@@ -0,0 +1,88 @@
+"""
+PDF size estimation. Picks compile quality up front, so that the pdf fits
+under MAX_PDFSIZE on the first pass instead of compile-then-retry.
+
+Works on image infos from compiler.prepare_image.
+"""
+
+from statistics import median
+
+from constants import MAX_PDFSIZE, REDUCE_LADDER, SIZE_SAFETY_MARGIN
+from compiler import fit_scale
+
+PAGE_OVERHEAD = 1_000  # bytes of pdf structure per page
+REENCODE_GROWTH = 2.0  # images img2pdf can't embed as is grow when re-encoded with flate
+DEFAULT_REDUCE_RATIO = 0.3  # reduced / original size at the best level, when nothing is measured yet
+
+# Reduced jpeg size relative to quality 80, typical for photos. Grayscale is not accounted for, it only saves on scans
+JPEG_QUALITY_SIZE = {95: 1.9, 90: 1.45, 80: 1.0, 65: 0.75, 50: 0.6, 35: 0.47, 20: 0.35}
+
+
+def passthrough(info) -> bool:
+    # img2pdf embeds JPEG and non-interlaced PNG without alpha as they are, pdfs are merged as they are
+    if info['format'] in ('JPEG', 'MPO', 'PDF'):
+        return True
+    return info['format'] == 'PNG' and not info.get('alpha') and not info.get('interlace')
+
+def estimate_high(infos) -> int:
+    size = 0
+    for info in infos:
+        growth = 1.0 if passthrough(info) else REENCODE_GROWTH
+        size += info['size'] * growth + PAGE_OVERHEAD
+    return int(size)
+
+def _pixel_scale(info, level):
+    # fraction of pixels kept at level's dpi
+    if not info.get('width'):
+        return 1.0
+    return fit_scale(info['width'], info['height'], level[1]) ** 2
+
+def _level_factor(info, level):
+    # reduced size relative to the original at the best level, before measuring
+    return JPEG_QUALITY_SIZE[level[0]] / JPEG_QUALITY_SIZE[REDUCE_LADDER[0][0]] * _pixel_scale(info, level) / _pixel_scale(info, REDUCE_LADDER[0])
+
+def reduce_ratio(infos) -> float:
+    # median reduced / original size ratio of already reduced images, converted to the best level
+    ratios = [
+        size / info['size'] / _level_factor(info, level)
+        for info in infos if info['size'] and info['format'] != 'PDF'
+        for level, (_, size) in info.get('variants', {}).items()
+    ]
+    return median(ratios) if ratios else DEFAULT_REDUCE_RATIO
+
+def estimate_reduced(infos, level) -> int:
+    ratio = reduce_ratio(infos)
+    size = 0
+    for info in infos:
+        variant = info.get('variants', {}).get(level)
+        if info['format'] == 'PDF':
+            # not reduced
+            size += info['size']
+        elif variant is not None:
+            # measured
+            size += variant[1]
+        else:
+            size += info['size'] * ratio * _level_factor(info, level)
+        size += PAGE_OVERHEAD
+    return int(size)
+
+def choose_level(infos, levels=None) -> int:
+    """Index of the best REDUCE_LADDER level expected to fit, of `levels` (default: all). None if none is."""
+    for i in levels if levels is not None else range(len(REDUCE_LADDER)):
+        if estimate_reduced(infos, REDUCE_LADDER[i]) <= MAX_PDFSIZE * SIZE_SAFETY_MARGIN:
+            return i
+    return None
+
+def choose_quality(infos):
+    """
+    Returns (quality, level): 'high' and None if originals fit,
+    otherwise 'mid' and the index of the best REDUCE_LADDER level expected to fit.
+    """
+    if estimate_high(infos) <= MAX_PDFSIZE * SIZE_SAFETY_MARGIN:
+        return 'high', None
+    level = choose_level(infos)
+    return 'mid', len(REDUCE_LADDER) - 1 if level is None else level
+
+def needs_samples(infos) -> bool:
+    # originals don't fit and there is nothing to base reduced size estimate on
+    return estimate_high(infos) > MAX_PDFSIZE * SIZE_SAFETY_MARGIN and not any(info.get('variants') for info in infos)
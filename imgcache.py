@@ -0,0 +1,134 @@
+import asyncio
+import hashlib
+import logging
+import os
+import shutil
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def file_hash(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def link(src, dest):
+    # hardlink into session directory, copy if the filesystem can't
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copyfile(src, dest)
+
+
+class ImageCache:
+    """
+    Content-addressed image store shared by all sessions.
+
+    Images are keyed by content hash and looked up by telegram file_unique_id,
+    so resent photos and duplicate pages skip the download. Reduced variants are
+    kept next to the original and skip the re-encode. Session directories get
+    hardlinks, deleting a session never touches the store.
+    Entries expire `ttl` seconds after last use, least recently used ones are
+    evicted when the store is over `budget` bytes.
+    """
+
+    def __init__(self, directory, budget, ttl):
+        self.directory = directory
+        self.budget = budget
+        self.ttl = ttl
+        self.size = 0
+        self._by_fuid = {}  # file_unique_id -> hash
+        self._entries = OrderedDict()  # hash -> entry, least recently used first
+        # nothing survives a restart
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+
+    def _remove(self, h):
+        entry = self._entries.pop(h)
+        for fuid in entry['fuids']:
+            self._by_fuid.pop(fuid, None)
+        for path in [entry['path'], *entry['variants'].values()]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self.size -= entry['size']
+
+    def expire(self):
+        deadline = time.monotonic() - self.ttl
+        while self._entries:
+            h, entry = next(iter(self._entries.items()))
+            if entry['used'] > deadline and self.size <= self.budget:
+                break
+            self._remove(h)
+
+    def shrink(self, size):
+        # evict least recently used entries until the store is at most `size` bytes
+        while self._entries and self.size > size:
+            self._remove(next(iter(self._entries)))
+
+    def _touch(self, h):
+        entry = self._entries[h]
+        entry['used'] = time.monotonic()
+        self._entries.move_to_end(h)
+        return entry
+
+    def lookup(self, fuid):
+        """Entry of an image with this file_unique_id or None. Link entry['path'] into the session."""
+        self.expire()
+        h = self._by_fuid.get(fuid)
+        if h is None or h not in self._entries:
+            return None
+        return self._touch(h)
+
+    async def add(self, fuid, path):
+        """Store a downloaded image, returns its entry. Image may already be stored under another fuid."""
+        h = await asyncio.to_thread(file_hash, path)
+        if h not in self._entries:
+            ext = os.path.splitext(path)[1]
+            stored = os.path.join(self.directory, h + ext)
+            if not os.path.exists(stored):
+                link(path, stored)
+            size = os.stat(stored).st_size
+            self._entries[h] = {'hash': h, 'path': stored, 'ext': ext, 'size': size, 'used': 0, 'info': None, 'variants': {}, 'fuids': set()}
+            self.size += size
+        entry = self._touch(h)
+        entry['fuids'].add(fuid)
+        self._by_fuid[fuid] = h
+        self.expire()
+        return entry
+
+    def get(self, h):
+        return self._entries.get(h)
+
+    def set_info(self, h, info):
+        # prepare_image result, without session paths
+        if h in self._entries:
+            self._entries[h]['info'] = {k: v for k, v in info.items() if k != 'variants'}
+
+    def add_variant(self, h, level, path):
+        entry = self._entries.get(h)
+        if entry is None or level in entry['variants']:
+            return
+        stored = os.path.join(self.directory, f"{h}.{'-'.join(str(x) for x in level)}.jpg")
+        link(path, stored)
+        entry['variants'][level] = stored
+        size = os.stat(stored).st_size
+        entry['size'] += size
+        self.size += size
+        self.expire()
+
+    def variant(self, h, level):
+        entry = self._entries.get(h)
+        if entry is None:
+            return None
+        return entry['variants'].get(level)
+
+    async def expire_periodically(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            self.expire()
@@ -0,0 +1,242 @@
+"""
+Distributed mode: the bot puts compile jobs into a job queue, standalone
+worker processes (worker.py, on this or other machines) take them, run
+them and put results back.
+
+Jobs reference images by paths relative to the bot's working directory
+(cache/<uid>/...), so every worker must run in a directory where cache/ is
+the bot's cache directory (shared storage), see worker.py --dir. Job payloads
+are JSON: a job name from compiler.JOBS and its arguments.
+
+JobQueue is the interface, SqliteJobQueue a single-file implementation for
+one machine or testing. A networked backend only needs the same methods.
+"""
+
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+
+from workers import JobCancelled
+
+logger = logging.getLogger(__name__)
+
+QUEUED, RUNNING, DONE, CANCELLED = 'queued', 'running', 'done', 'cancelled'
+
+
+class JobFailed(Exception):
+    """Job raised an exception on a remote worker."""
+
+
+class JobQueue:
+    def put(self, job_id, key, name, args, background=False): raise NotImplementedError
+    def promote(self, key): raise NotImplementedError  # queued background jobs of key lose the flag
+    def claim(self, worker_id): raise NotImplementedError  # -> (job_id, name, args) or None
+    def heartbeat(self, job_ids): raise NotImplementedError
+    def finish(self, job_id, ok, result): raise NotImplementedError
+    def result(self, job_id): raise NotImplementedError  # -> (ok, result) or None
+    def state(self, job_id): raise NotImplementedError  # -> QUEUED, RUNNING, ... or None
+    def cancel(self, job_id=None, key=None): raise NotImplementedError
+    def cancelled(self, job_ids): raise NotImplementedError  # -> subset of job_ids
+    def counts(self): raise NotImplementedError  # -> {state: n}
+
+
+class SqliteJobQueue(JobQueue):
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS jobs (
+        id TEXT PRIMARY KEY,
+        key TEXT,
+        name TEXT NOT NULL,
+        args TEXT NOT NULL,
+        state TEXT NOT NULL,
+        background INTEGER NOT NULL DEFAULT 0,
+        worker TEXT,
+        heartbeat REAL,
+        ok INTEGER,
+        result TEXT,
+        created REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, created);
+    """
+    INDEX = "CREATE INDEX IF NOT EXISTS jobs_claim ON jobs (state, background, created)"
+
+    def __init__(self, path, lease=10.0):
+        # a running job without heartbeat for `lease` seconds is given to another worker
+        self.lease = lease
+        # one connection used from several threads, one statement at a time
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(self.SCHEMA)
+        if 'background' not in {row[1] for row in self._db.execute("PRAGMA table_info(jobs)")}:
+            # queue file of an older version
+            self._db.execute("ALTER TABLE jobs ADD COLUMN background INTEGER NOT NULL DEFAULT 0")
+        self._db.execute(self.INDEX)
+
+    def put(self, job_id, key, name, args, background=False):
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO jobs (id, key, name, args, state, background, created) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job_id, None if key is None else str(key), name, json.dumps(args), QUEUED, int(background), time.time())
+            )
+
+    def promote(self, key):
+        with self._lock:
+            self._db.execute("UPDATE jobs SET background = 0 WHERE key = ? AND state = ?", (str(key), QUEUED))
+
+    def claim(self, worker_id):
+        with self._lock:
+            now = time.time()
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._db.execute(
+                    "SELECT id, name, args FROM jobs WHERE state = ? OR (state = ? AND heartbeat < ?) ORDER BY background, created LIMIT 1",
+                    (QUEUED, RUNNING, now - self.lease)
+                ).fetchone()
+                if row is not None:
+                    self._db.execute("UPDATE jobs SET state = ?, worker = ?, heartbeat = ? WHERE id = ?", (RUNNING, worker_id, now, row[0]))
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            if row is None:
+                return None
+            return row[0], row[1], json.loads(row[2])
+
+    def heartbeat(self, job_ids):
+        with self._lock:
+            self._db.executemany("UPDATE jobs SET heartbeat = ? WHERE id = ? AND state = ?", [(time.time(), i, RUNNING) for i in job_ids])
+
+    def finish(self, job_id, ok, result):
+        with self._lock:
+            self._db.execute(
+                "UPDATE jobs SET state = ?, ok = ?, result = ? WHERE id = ? AND state = ?",
+                (DONE, int(ok), json.dumps(result), job_id, RUNNING)
+            )
+
+    def result(self, job_id):
+        with self._lock:
+            row = self._db.execute("SELECT state, ok, result FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None or row[0] != DONE:
+                return None
+            # picked up, not needed anymore
+            self._db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+            return bool(row[1]), json.loads(row[2])
+
+    def state(self, job_id):
+        with self._lock:
+            row = self._db.execute("SELECT state FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            return None if row is None else row[0]
+
+    def cancel(self, job_id=None, key=None):
+        with self._lock:
+            if job_id is not None:
+                self._db.execute("UPDATE jobs SET state = ? WHERE id = ? AND state IN (?, ?)", (CANCELLED, job_id, QUEUED, RUNNING))
+            if key is not None:
+                self._db.execute("UPDATE jobs SET state = ? WHERE key = ? AND state IN (?, ?)", (CANCELLED, str(key), QUEUED, RUNNING))
+            # cancelled jobs are only kept while a worker may still be running them
+            self._db.execute("DELETE FROM jobs WHERE state = ? AND (heartbeat IS NULL OR heartbeat < ?)", (CANCELLED, time.time() - self.lease))
+
+    def cancelled(self, job_ids):
+        with self._lock:
+            if not job_ids:
+                return set()
+            marks = ','.join('?' * len(job_ids))
+            rows = self._db.execute(f"SELECT id FROM jobs WHERE state = ? AND id IN ({marks})", (CANCELLED, *job_ids))
+            return {row[0] for row in rows}
+
+    def counts(self):
+        with self._lock:
+            return dict(self._db.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state"))
+
+
+class RemotePool:
+    """
+    Same interface as workers.WorkerPool, but jobs run on worker.py processes behind a JobQueue.
+    account(key, seconds) gets the time from queueing to result, CPU time of remote jobs is unknown.
+    """
+
+    def __init__(self, queue, workers, poll_interval=0.05, counts_interval=1.0, account=None):
+        # workers: expected number of remote worker slots, for scheduling and metrics
+        self.queue = queue
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.counts_interval = counts_interval
+        self.account = account
+        self._keys = {}  # running job id -> key
+        self._tasks = set()  # queue updates running in the background
+        self._counts = {}  # jobs by state, refreshed by poll_counts
+
+    async def start(self):
+        # workers are separate processes
+        pass
+
+    async def poll_counts(self):
+        # queue counts for busy, metrics read them on the event loop
+        while True:
+            self._counts = await asyncio.to_thread(self.queue.counts)
+            await asyncio.sleep(self.counts_interval)
+
+    @property
+    def busy(self):
+        return min(self.workers, self._counts.get(RUNNING, 0))
+
+    async def run(self, fn, *args, timeout=None, key=None, background=False):
+        job_id = uuid.uuid4().hex
+        t0 = time.monotonic()
+        await asyncio.to_thread(self.queue.put, job_id, key, fn.__name__, list(args), background)
+        self._keys[job_id] = key
+        # timeout starts once a worker takes the job, like in WorkerPool
+        deadline = None
+        try:
+            while True:
+                if job_id not in self._keys:
+                    raise JobCancelled()
+                res = await asyncio.to_thread(self.queue.result, job_id)
+                if res is not None:
+                    break
+                if timeout is not None:
+                    if deadline is None:
+                        if await asyncio.to_thread(self.queue.state, job_id) == RUNNING:
+                            deadline = time.monotonic() + timeout
+                    elif time.monotonic() > deadline:
+                        raise asyncio.TimeoutError()
+                await asyncio.sleep(self.poll_interval)
+        except BaseException:
+            # timeout, cancellation: worker stops the job
+            await asyncio.shield(asyncio.to_thread(self.queue.cancel, job_id))
+            raise
+        finally:
+            self._keys.pop(job_id, None)
+            if self.account is not None and key is not None:
+                self.account(key, time.monotonic() - t0)
+
+        ok, result = res
+        if not ok:
+            raise JobFailed(result)
+        return result
+
+    def _in_background(self, fn, *args):
+        # queue update without blocking the caller or the event loop
+        task = asyncio.create_task(asyncio.to_thread(fn, *args))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def promote(self, key):
+        self._in_background(self.queue.promote, key)
+
+    def cancel(self, key) -> int:
+        job_ids = [job_id for job_id, k in self._keys.items() if k == key]
+        for job_id in job_ids:
+            del self._keys[job_id]
+        # run() notices the missing key, the queue may be busy with workers
+        self._in_background(self.queue.cancel, None, key)
+        return len(job_ids)
+
+    def close(self):
+        # after the event loop stopped, blocking is fine
+        for job_id in list(self._keys):
+            self.queue.cancel(job_id)
@@ -0,0 +1,633 @@
+#!/usr/bin/env python
+"""
+Load test: synthetic users make pdfs through the real bot, against a stub Bot API.
+
+Usage:
+    python loadtest.py [--users 50] [--rate 1.0] [--pages 3-20] [--files 0.2] [--workers N]
+                       [--set COMPILATION_TIMEOUT=60 ...] [--out run.json] [--record DIR]
+    python loadtest.py --replay DIR [--speed 0] [--workers N] [--out replay.json]
+    python loadtest.py --compare base.json run.json ...
+
+The bot (main.build_application) runs in this process with its worker pool, polling a
+local stub of the Bot API and its file server. Users arrive at --rate per second (Poisson),
+each sends /newpdf, a name, its pages in albums of up to 10 (a --files fraction as
+uncompressed files), /compile, waits for the pdf and sends /done.
+Every page has unique content, so nothing is served from the image cache.
+
+Reported: throughput, end-to-end latency (/newpdf to pdf), compile latency (/compile to pdf),
+failures by reply, CPU seconds and peak RSS of the bot process and its workers, sampled
+from /proc (RSS counts shared pages once per process).
+Runs in a temporary directory, sessions, stats and cache of a real bot are not touched.
+--set overrides constants in the bot process, workers use constants.py as it is.
+--out saves the report with the commit it ran on, --compare prints saved reports side by side.
+
+--record saves the updates of a run and the files they refer to. --replay pushes them to
+a fresh bot, all at once or at --speed times the recorded pace, and reports how fast the
+bot processes them: updates/s and latency from push to processed. Updates of one user are
+processed in order, so a replay of many users measures concurrent update processing.
+"""
+
+import argparse
+import asyncio
+import email
+import email.policy
+import io
+import itertools
+import json
+import logging
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from collections import defaultdict
+from statistics import quantiles
+from urllib.parse import parse_qsl, unquote
+
+from PIL import Image
+
+REPO = os.path.dirname(os.path.abspath(__file__))
+TOKEN = '1:loadtest'
+ALBUM_SIZE = 10
+SAMPLE_INTERVAL = 0.5  # seconds between /proc samples
+
+
+#### Corpus: a few base images, made unique per page without re-encoding
+
+def make_corpus(n, rng):
+    # (name, bytes, width, height, kind) of telegram-compressed photos and uncompressed files
+    corpus = []
+    for i in range(n):
+        kind = 'photo' if i % 2 == 0 else 'file'
+        width, height = (1280, 960) if kind == 'photo' else rng.choice([(4000, 3000), (1170, 2532)])
+        noise = Image.effect_noise((width, height), rng.randint(10, 40)).convert('L')
+        gradient = Image.linear_gradient('L').resize((width, height))
+        image = Image.merge('RGB', (noise, gradient, Image.blend(noise, gradient, 0.5)))
+        f = io.BytesIO()
+        if kind == 'file' and width < height:
+            # screenshot
+            image.save(f, 'png')
+        else:
+            image.save(f, 'jpeg', quality=87 if kind == 'photo' else 92)
+        corpus.append((f'{kind}{i}', f.getvalue(), width, height, kind))
+    return corpus
+
+def unique_copy(data, token):
+    # same image, different bytes: a JPEG comment or a PNG text chunk
+    if data[:2] == b'\xff\xd8':
+        return data[:2] + b'\xff\xfe' + (len(token) + 2).to_bytes(2, 'big') + token + data[2:]
+    chunk = b'tEXt' + b'load\x00' + token
+    ihdr_end = 8 + 25
+    return data[:ihdr_end] + (len(chunk) - 4).to_bytes(4, 'big') + chunk + zlib.crc32(chunk).to_bytes(4, 'big') + data[ihdr_end:]
+
+
+#### Stub Bot API
+
+class ApiError(Exception):
+    """Error reply of the stub, as telegram sends them: HTTP status and description."""
+
+    def __init__(self, status, description):
+        super().__init__(description)
+        self.status = status
+        self.description = description
+
+class StubBotApi:
+    """
+    Just enough of the Bot API for the bot: getUpdates long polling, getFile and file
+    downloads of the synthetic pages, replies collected per chat.
+    """
+
+    def __init__(self):
+        self.updates = []
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.arrived = asyncio.Event()
+        self.closing = False
+        self.files = {}  # file_id -> bytes
+        self.inboxes = defaultdict(asyncio.Queue)  # chat id -> (method, params)
+        self.bytes_sent = 0  # downloads by the bot
+        self.bytes_received = 0  # uploads by the bot
+        self.pushed = []  # (perf_counter, update) of every update, for --record and replays
+
+    def push(self, message, edited=False):
+        update = {'update_id': next(self.update_ids), 'edited_message' if edited else 'message': message}
+        self.updates.append(update)
+        self.pushed.append((time.perf_counter(), update))
+        self.arrived.set()
+
+    def add_file(self, file_id, data):
+        self.files[file_id] = data
+
+    def close(self):
+        # answer long polls now, so that no request is left open
+        self.closing = True
+        self.arrived.set()
+
+    async def file(self, file_id):
+        # contents of a file download, None if there is no such file
+        return self.files.get(file_id)
+
+    async def get_updates(self, params):
+        offset = params.get('offset') or 0
+        self.updates = [u for u in self.updates if u['update_id'] >= offset]
+        if not self.updates and not self.closing:
+            self.arrived.clear()
+            try:
+                await asyncio.wait_for(self.arrived.wait(), params.get('timeout') or 0)
+            except asyncio.TimeoutError:
+                pass
+        return self.updates[:100]
+
+    def reply(self, method, params):
+        chat_id = int(params['chat_id'])
+        message = {'message_id': next(self.message_ids), 'date': int(time.time()), 'chat': {'id': chat_id, 'type': 'private'}}
+        if method == 'sendDocument':
+            file_id = f'doc{message["message_id"]}'
+            message['document'] = {'file_id': file_id, 'file_unique_id': file_id}
+        else:
+            message['text'] = params.get('text', '')
+        self.inboxes[chat_id].put_nowait((method, params))
+        return message
+
+    async def call(self, method, params):
+        if method == 'getUpdates':
+            return await self.get_updates(params)
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'stub', 'username': 'stub_bot'}
+        if method == 'getFile':
+            file_id = params['file_id']
+            data = self.files[file_id]
+            ext = '.jpg' if data[:2] == b'\xff\xd8' else '.png'
+            return {'file_id': file_id, 'file_unique_id': file_id, 'file_size': len(data), 'file_path': f'f/{file_id}{ext}'}
+        if method in ('sendMessage', 'sendDocument'):
+            return self.reply(method, params)
+        # deleteWebhook, sendChatAction, ...
+        return True
+
+    @staticmethod
+    def parse(headers, body):
+        ctype = headers.get('content-type', '')
+        if ctype.startswith('multipart/'):
+            msg = email.message_from_bytes(b'Content-Type: ' + ctype.encode() + b'\r\n\r\n' + body, policy=email.policy.HTTP)
+            params = {}
+            for part in msg.iter_parts():
+                name = part.get_param('name', header='content-disposition')
+                payload = part.get_payload(decode=True)
+                params[name] = payload if part.get_filename() else payload.decode()
+        elif ctype.startswith('application/json'):
+            params = json.loads(body or b'{}')
+        else:
+            params = dict(parse_qsl(body.decode()))
+        for k, v in params.items():
+            # form values are JSON encoded, except plain strings
+            if isinstance(v, str):
+                try:
+                    params[k] = json.loads(v)
+                except ValueError:
+                    pass
+        return params
+
+    async def handle(self, reader, writer):
+        # HTTP/1.1 with keep-alive, bodies with Content-Length
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while (line := (await reader.readline()).strip()):
+                    k, _, v = line.decode('latin-1').partition(':')
+                    headers[k.strip().lower()] = v.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                self.bytes_received += len(body)
+                path = unquote(request_line.decode('latin-1').split()[1])
+                if path.startswith(f'/file/bot{TOKEN}/'):
+                    file_id = os.path.splitext(os.path.basename(path))[0]
+                    data, status, ctype = await self.file(file_id), b'200 OK', b'application/octet-stream'
+                    if data is None:
+                        data, status = b'', b'404 Not Found'
+                    self.bytes_sent += len(data)
+                else:
+                    method = path.rsplit('/', 1)[1]
+                    try:
+                        result = await self.call(method, self.parse(headers, body))
+                        data, status = json.dumps({'ok': True, 'result': result}).encode(), b'200 OK'
+                    except ApiError as e:
+                        data = json.dumps({'ok': False, 'error_code': e.status, 'description': e.description}).encode()
+                        status = b'%d Error' % e.status
+                    ctype = b'application/json'
+                writer.write(
+                    b'HTTP/1.1 ' + status + b'\r\nContent-Type: ' + ctype
+                    + b'\r\nContent-Length: %d\r\n\r\n' % len(data) + data
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+#### Synthetic users
+
+class Failed(Exception):
+    """Session ended without a pdf: bot error reply or timeout."""
+
+class SimUser:
+    def __init__(self, stub, uid, strings):
+        self.stub = stub
+        self.uid = uid
+        self.inbox = stub.inboxes[uid]
+        self.message_ids = itertools.count(1)
+        # replies that end the session, by string key
+        self.errors = {v.split('{')[0]: k for k, v in strings.items() if k.startswith('tg_err') or k in ('tg_info_max_imgs', 'tg_info_max_total_size')}
+
+    def _message(self, **content):
+        return {
+            'message_id': next(self.message_ids), 'date': int(time.time()),
+            'chat': {'id': self.uid, 'type': 'private'},
+            'from': {'id': self.uid, 'is_bot': False, 'first_name': 'load', 'username': f'load{self.uid}'},
+            **content,
+        }
+
+    def text(self, text):
+        entities = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}] if text.startswith('/') else []
+        self.stub.push(self._message(text=text, entities=entities))
+
+    def page(self, image, token, group):
+        name, data, width, height, kind = image
+        data = unique_copy(data, token)
+        file_id = f'u{self.uid}-{token.decode()}'
+        self.stub.add_file(file_id, data)
+        if kind == 'photo':
+            content = {'photo': [{'file_id': file_id, 'file_unique_id': file_id, 'width': width, 'height': height, 'file_size': len(data)}]}
+        else:
+            mime = 'image/jpeg' if data[:2] == b'\xff\xd8' else 'image/png'
+            content = {'document': {'file_id': file_id, 'file_unique_id': file_id, 'file_name': name, 'mime_type': mime, 'file_size': len(data)}}
+        if group is not None:
+            content['media_group_id'] = group
+        self.stub.push(self._message(**content))
+
+    async def expect(self, match, deadline):
+        # next reply that `match`es. Error replies raise Failed
+        while True:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                raise Failed('timeout')
+            try:
+                method, params = await asyncio.wait_for(self.inbox.get(), timeout)
+            except asyncio.TimeoutError:
+                raise Failed('timeout')
+            text = params.get('text', '') if method == 'sendMessage' else ''
+            for prefix, key in self.errors.items():
+                if text.startswith(prefix):
+                    raise Failed(key)
+            result = match(method, text)
+            if result:
+                return result
+
+async def run_session(stub, uid, n_pages, corpus, strings, rng, timeout, files):
+    user = SimUser(stub, uid, strings)
+    deadline = time.perf_counter() + timeout
+    is_text = lambda s: lambda method, text: method == 'sendMessage' and text.startswith(s.split('{')[0])
+    added = re.compile(r'(?:image (\d+) added|(\d+) images added)')
+
+    def n_added(method, text):
+        m = added.match(text) if method == 'sendMessage' else None
+        if m is None:
+            return 0
+        return 1 if m.group(1) else int(m.group(2))
+
+    t0 = time.perf_counter()
+    user.text('/newpdf')
+    await user.expect(is_text(strings['tg_info_newpdf']), deadline)
+    user.text(f'load {uid}')
+    await user.expect(is_text(strings['tg_info_newpdf_name_accepted']), deadline)
+    pages = list(range(n_pages))
+    for album in (pages[i:i + ALBUM_SIZE] for i in range(0, n_pages, ALBUM_SIZE)):
+        group = f'{uid}-{album[0]}' if len(album) > 1 else None
+        for i in album:
+            image = rng.choice([c for c in corpus if (c[4] == 'file') == (rng.random() < files)] or corpus)
+            user.page(image, b'%d-%d' % (uid, i), group)
+        confirmed = 0
+        while confirmed < len(album):
+            confirmed += await user.expect(n_added, deadline)
+    t1 = time.perf_counter()
+    user.text('/compile')
+    await user.expect(lambda method, text: method == 'sendDocument', deadline)
+    t2 = time.perf_counter()
+    # compile handler is done when it offers edits
+    await user.expect(is_text(strings['tg_info_edit']), deadline)
+    user.text('/done')
+    await user.expect(is_text(strings['tg_info_edit_done']), deadline)
+    return {'e2e': t2 - t0, 'compile': t2 - t1, 'pages': n_pages}
+
+
+#### Resources of the bot process and its workers
+
+def _children(pid):
+    pids = []
+    for task in os.listdir(f'/proc/{pid}/task'):
+        try:
+            with open(f'/proc/{pid}/task/{task}/children') as f:
+                pids += [int(p) for p in f.read().split()]
+        except FileNotFoundError:
+            pass
+    return pids
+
+class ResourceSampler:
+    # CPU of workers that exit between samples is partly lost, pool workers live for WORKER_MAX_JOBS jobs
+    def __init__(self):
+        self.cpu = {}  # pid -> clock ticks
+        self.peak_rss = 0
+
+    def sample(self):
+        rss, todo = 0, [os.getpid()]
+        while todo:
+            pid = todo.pop()
+            try:
+                with open(f'/proc/{pid}/stat') as f:
+                    fields = f.read().rsplit(')', 1)[1].split()
+                with open(f'/proc/{pid}/status') as f:
+                    rss += next((int(line.split()[1]) * 1024 for line in f if line.startswith('VmRSS:')), 0)
+                todo += _children(pid)
+            except (FileNotFoundError, ProcessLookupError):
+                continue
+            self.cpu[pid] = max(self.cpu.get(pid, 0), int(fields[11]) + int(fields[12]))
+        self.peak_rss = max(self.peak_rss, rss)
+
+    @property
+    def cpu_seconds(self):
+        return sum(self.cpu.values()) / os.sysconf('SC_CLK_TCK')
+
+    async def run(self):
+        while True:
+            self.sample()
+            await asyncio.sleep(SAMPLE_INTERVAL)
+
+
+#### Run
+
+def commit():
+    try:
+        rev = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=REPO, capture_output=True, text=True).stdout.strip()
+        return rev + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def override(name, value):
+    # constant in every bot module that has it
+    value = json.loads(value) if value not in ('None',) else None
+    for module in list(sys.modules.values()):
+        if getattr(module, '__file__', None) and os.path.dirname(os.path.abspath(module.__file__)) == REPO and hasattr(module, name):
+            setattr(module, name, value)
+
+def percentile(values, q):
+    if len(values) < 2:
+        return values[0] if values else None
+    return quantiles(values, n=100, method='inclusive')[q - 1]
+
+def import_bot(settings=(), verbose=False):
+    # main.py as the bot module, in the current directory. settings: (NAME, JSON value) overrides
+    os.environ['BOT_TOKEN'] = TOKEN
+    import main as bot
+    logging.getLogger().setLevel(logging.INFO if verbose else logging.WARNING)
+    # no metrics endpoint, no summaries
+    override('METRICS_PORT', 'None')
+    override('METRICS_SUMMARY_INTERVAL', 'None')
+    for name, value in settings:
+        override(name, value)
+    return bot
+
+async def start_bot(main, stub=None, on_processed=None):
+    # stub Bot API on a free port and the bot polling it, workers up. Returns (stub, stop coroutine function).
+    # on_processed(update) is called when the bot is done with an update
+    stub = stub or StubBotApi()
+    server = await asyncio.start_server(stub.handle, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+
+    application = main.build_application(f'http://127.0.0.1:{port}/bot', f'http://127.0.0.1:{port}/file/bot')
+    if on_processed is not None:
+        processor = application.update_processor
+        process = processor.do_process_update
+
+        async def do_process_update(update, coroutine):
+            await process(update, coroutine)
+            on_processed(update)
+
+        processor.do_process_update = do_process_update
+    await application.initialize()
+    await application.post_init(application)
+    await application.updater.start_polling(poll_interval=0, timeout=1)
+    await application.start()
+    # workers come up in the background
+    while main.pool.busy:
+        await asyncio.sleep(0.05)
+
+    async def stop():
+        await application.updater.stop()
+        await application.stop()
+        await application.post_stop(application)
+        await application.shutdown()
+        main.pool.close()
+        main.stats.close()
+        stub.close()
+        server.close()
+        await asyncio.sleep(0.1)
+
+    return stub, stop
+
+async def run(args, main):
+    rng = random.Random(args.seed)
+    corpus = make_corpus(args.corpus, rng)
+    stub, stop = await start_bot(main)
+
+    sampler = ResourceSampler()
+    sampling = asyncio.create_task(sampler.run())
+    lo, hi = (int(x) for x in args.pages.split('-')) if '-' in args.pages else (int(args.pages),) * 2
+    sessions = []
+    t0 = time.perf_counter()
+    for i in range(args.users):
+        sessions.append(asyncio.create_task(run_session(
+            stub, 1000 + i, rng.randint(lo, hi), corpus, main.STRINGS, random.Random(rng.random()), args.timeout, args.files
+        )))
+        if args.rate:
+            await asyncio.sleep(rng.expovariate(args.rate))
+    results = await asyncio.gather(*sessions, return_exceptions=True)
+    wall = time.perf_counter() - t0
+    sampler.sample()
+    sampling.cancel()
+    await stop()
+    if args.record:
+        save_recording(stub, args.record, t0)
+
+    ok = [r for r in results if isinstance(r, dict)]
+    failures = defaultdict(int)
+    for r in results:
+        if isinstance(r, Failed):
+            failures[str(r)] += 1
+        elif isinstance(r, BaseException):
+            failures[repr(r)] += 1
+    e2e = sorted(r['e2e'] for r in ok)
+    compile_ = sorted(r['compile'] for r in ok)
+    return {
+        'users': args.users,
+        'ok': len(ok),
+        'failed': dict(failures),
+        'pages': sum(r['pages'] for r in ok),
+        'wall_s': wall,
+        'pdfs_per_min': len(ok) / wall * 60,
+        'pages_per_s': sum(r['pages'] for r in ok) / wall,
+        'e2e_p50_s': percentile(e2e, 50),
+        'e2e_p99_s': percentile(e2e, 99),
+        'compile_p50_s': percentile(compile_, 50),
+        'compile_p99_s': percentile(compile_, 99),
+        'cpu_s': sampler.cpu_seconds,
+        'cpu_s_per_pdf': sampler.cpu_seconds / len(ok) if ok else None,
+        'peak_rss_mb': sampler.peak_rss / 1e6,
+        'downloaded_mb': stub.bytes_sent / 1e6,
+        'uploaded_mb': stub.bytes_received / 1e6,
+    }
+
+#### Replay of recorded updates
+
+def save_recording(stub, directory, t0):
+    # updates with their times, and the files they refer to
+    os.makedirs(os.path.join(directory, 'files'), exist_ok=True)
+    with open(os.path.join(directory, 'updates.jsonl'), 'w') as f:
+        for t, update in stub.pushed:
+            f.write(json.dumps({'t': t - t0, 'update': update}) + '\n')
+    for file_id, data in stub.files.items():
+        with open(os.path.join(directory, 'files', file_id), 'wb') as f:
+            f.write(data)
+
+def load_recording(stub, directory):
+    # -> [(t, edited, message)]
+    for file_id in os.listdir(os.path.join(directory, 'files')):
+        with open(os.path.join(directory, 'files', file_id), 'rb') as f:
+            stub.add_file(file_id, f.read())
+    recorded = []
+    with open(os.path.join(directory, 'updates.jsonl')) as f:
+        for line in f:
+            entry = json.loads(line)
+            edited = 'edited_message' in entry['update']
+            recorded.append((entry['t'], edited, entry['update']['edited_message' if edited else 'message']))
+    return recorded
+
+async def replay(args, main):
+    # Push recorded updates, all at once or at --speed times the recorded pace, and time
+    # how fast the bot gets through them. Background work (downloads, compiles) isn't waited for
+    stub = StubBotApi()
+    recorded = load_recording(stub, args.replay)
+    processed = {}  # update_id -> perf_counter
+    stub, stop = await start_bot(main, stub, on_processed=lambda update: processed.setdefault(update.update_id, time.perf_counter()))
+
+    sampler = ResourceSampler()
+    sampling = asyncio.create_task(sampler.run())
+    t0 = time.perf_counter()
+    for t, edited, message in recorded:
+        if args.speed:
+            await asyncio.sleep(max(0.0, t0 + t / args.speed - time.perf_counter()))
+        stub.push(message, edited)
+    deadline = time.perf_counter() + args.timeout
+    while len(processed) < len(recorded) and time.perf_counter() < deadline:
+        await asyncio.sleep(0.01)
+    wall = (max(processed.values()) if processed else time.perf_counter()) - t0
+    # let replies of background work come in before stopping
+    replies = -1
+    while replies != sum(q.qsize() for q in stub.inboxes.values()) and time.perf_counter() < deadline:
+        replies = sum(q.qsize() for q in stub.inboxes.values())
+        await asyncio.sleep(args.settle)
+    sampler.sample()
+    sampling.cancel()
+    await stop()
+
+    pushed = {update['update_id']: t for t, update in stub.pushed}
+    latency = sorted(processed[i] - pushed[i] for i in processed)
+    return {
+        'updates': len(recorded),
+        'processed': len(processed),
+        'failed': {'not processed': len(recorded) - len(processed)} if len(processed) < len(recorded) else {},
+        'wall_s': wall,
+        'updates_per_s': len(processed) / wall if wall else None,
+        'latency_p50_s': percentile(latency, 50),
+        'latency_p99_s': percentile(latency, 99),
+        'replies': replies,
+        'cpu_s': sampler.cpu_seconds,
+        'peak_rss_mb': sampler.peak_rss / 1e6,
+    }
+
+def print_reports(reports, names):
+    keys = [k for k in reports[0]['results'] if k != 'failed']
+    width = max(16, *(len(n) + 2 for n in names))
+    print(f"{'':<16}" + ''.join(f'{n:>{width}}' for n in names))
+    for row in ('commit', 'workers'):
+        print(f'{row:<16}' + ''.join(f"{str(r[row]):>{width}}" for r in reports))
+    for k in keys:
+        cells = []
+        for r in reports:
+            v = r['results'].get(k)
+            cells.append(f'{v:>{width}.2f}' if isinstance(v, float) else f'{str(v):>{width}}')
+        print(f'{k:<16}' + ''.join(cells))
+    for r, n in zip(reports, names):
+        if r['results']['failed']:
+            print(f"failed ({n}): " + ', '.join(f'{k}={v}' for k, v in r['results']['failed'].items()))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--rate', type=float, default=1.0, help='users arriving per second, 0 for all at once')
+    parser.add_argument('--pages', default='3-20', help='pages per pdf, N or MIN-MAX')
+    parser.add_argument('--files', type=float, default=0.2, help='fraction of pages sent as uncompressed files')
+    parser.add_argument('--corpus', type=int, default=12, help='base images')
+    parser.add_argument('--workers', type=int, help='POOL_WORKERS')
+    parser.add_argument('--timeout', type=float, default=600, help='seconds per session')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE', help='override a constant, VALUE in JSON')
+    parser.add_argument('--record', metavar='DIR', help='save the updates of this run and their files for --replay')
+    parser.add_argument('--replay', metavar='DIR', help='replay recorded updates instead of running users, measures updates/s')
+    parser.add_argument('--speed', type=float, default=0, help='replay at this times the recorded pace, 0 for all at once')
+    parser.add_argument('--settle', type=float, default=2, help='replay: seconds without new replies before stopping')
+    parser.add_argument('--out', help='save the report as JSON')
+    parser.add_argument('--compare', nargs='+', metavar='REPORT', help='print saved reports side by side')
+    parser.add_argument('--verbose', action='store_true', help='bot logs')
+    args = parser.parse_args()
+
+    if args.compare:
+        reports = []
+        for path in args.compare:
+            with open(path) as f:
+                reports.append(json.load(f))
+        print_reports(reports, [os.path.basename(p) for p in args.compare])
+        return
+
+    out = os.path.abspath(args.out) if args.out else None
+    for name in ('record', 'replay'):
+        if getattr(args, name):
+            setattr(args, name, os.path.abspath(getattr(args, name)))
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        settings = [setting.partition('=')[::2] for setting in args.set]
+        if args.workers:
+            settings.insert(0, ('POOL_WORKERS', str(args.workers)))
+        bot = import_bot(settings, args.verbose)
+        results = asyncio.run(replay(args, bot) if args.replay else run(args, bot))
+        os.chdir(REPO)
+
+    report = {
+        'commit': commit(),
+        'workers': bot.POOL_WORKERS,
+        'args': {k: v for k, v in vars(args).items() if k not in ('compare', 'out', 'verbose')},
+        'results': results,
+    }
+    print_reports([report], ['this run'])
+    if out:
+        with open(out, 'w') as f:
+            json.dump(report, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,25 +1,33 @@
 import subprocess
+import asyncio
 import logging
-import requests
 import os
 import re
 import time
-from datetime import datetime
-from telegram.ext import Application, Updater, CommandHandler, MessageHandler, filters as Filters, ConversationHandler, PicklePersistence
+import math
+from telegram.ext import Application, Updater, CommandHandler, MessageHandler, filters as Filters, ConversationHandler
 from telegram import Bot, ReplyKeyboardMarkup, ReplyKeyboardRemove
-from telegram.error import TimedOut, NetworkError
 from telegram.constants import ParseMode
+from telegram.error import TelegramError
 
-import shutil
-import multiprocessing
-from multiprocessing import Process
 import pathlib
-from PIL import Image, ImageOps
-
-import pymupdf
-import img2pdf
+import glob
 
 from constants import *
+from scheduler import CompileScheduler, QueueFull, UserLimit
+from workers import WorkerPool, JobCancelled, WorkerCrashed
+from jobqueue import RemotePool, SqliteJobQueue
+from downloads import DownloadManager
+from imgcache import ImageCache, link
+from diskbudget import DiskBudget
+from ratelimit import RateLimiter
+from uploads import Uploader, MAYBE_SUCCESS, FAILURE
+from stats import StatsSink
+from processor import PerUserUpdateProcessor
+from persistence import SqlitePersistence
+import metrics
+from compiler import reduce_image, prepare_image, build_pdf, patch_pdf, choose_backend, variant_path, is_pdf
+import estimator
 
 # Logging
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
@@ -29,7 +37,18 @@ logging.getLogger("httpx").setLevel(logging.WARNING)
 S = StringSupplier()
 logger = logging.getLogger(__name__)
 pool = None
-statistics_file = None
+scheduler = None
+downloads = None
+imgcache = None
+budget = None
+limiter = None
+uploader = None
+album_replies = {}  # (uid, media_group_id) -> album status reply in progress
+prepare_tasks = {}  # uid -> {img_path: asyncio.Task}, background image preparation
+edit_expiry = {}  # uid -> asyncio.Task ending the edit of a sent pdf
+background_tasks = []  # service loops started by post_init, cancelled by post_stop
+stats = None
+started = None  # perf_counter at main(), for startup time
 token = None
 
 if "BOT_TOKEN" in os.environ:
@@ -45,35 +64,6 @@ if token is None:
     exit()
 
 
-#### PDF Compilation
-
-def __pymupdf_compile_pdf(images, filename, quality):
-    doc = pymupdf.open()
-    for img_path in images:
-        if quality == 'high':
-            doc.insert_file(img_path)
-        else:
-            image = Image.open(img_path)
-            img_path = img_path + '.small.jpg'
-            image.save(img_path, 'jpeg', quality=80)
-            doc.insert_file(img_path)
-    doc.save(filename)
-    doc.close()
-    
-def __img2pdf_compile_pdf(images, filename, quality):
-    if quality == 'high':
-        with open(filename,"wb") as f:
-            f.write(img2pdf.convert(images))
-    else:
-        small_images = []
-        for img_path in images:
-            small_img_path = img_path + '.small.jpg'
-            Image.open(img_path).save(small_img_path, 'jpeg', quality=80)
-            small_images.append(small_img_path)
-        with open(filename,"wb") as f:
-            f.write(img2pdf.convert(small_images))
-
-
 #### Utility functions
 
 """
@@ -82,6 +72,10 @@ user context:
 'quick'
 'filename'
 'pdfname'
+'prepared'
+'hashes'
+'compiled' - pages of the sent pdf, while it can be edited
+Persisted, see recover_sessions.
 """
 
 def statusbar(context):
@@ -92,19 +86,337 @@ def statusbar(context):
         return f"{n} / {MAX_IMG_N} imgs, (LQ!) {size_mb:.2f} / {MAX_TOTAL_IMG_SIZE/1e6:.2f} MB"
     return f"{n} / {MAX_IMG_N} imgs, {size_mb:.2f} / {MAX_PDFSIZE/1e6:.2f} MB"
 
-def clear_user_cache(update) -> bool:
-    uid = update.message.from_user.id
+def with_variant(info, level, small_img_path):
+    # info with a reduced image added. Variants of tried levels are kept until drop_variants
+    variants = info.get('variants', {}) | {level: (small_img_path, os.stat(small_img_path).st_size)}
+    return info | {'variants': variants}
+
+def cached_variant(info, img_path, level):
+    # link reduced image from the image cache, returns its path or None
+    variant = imgcache.variant(info.get('hash'), level)
+    if variant is None:
+        return None
+    small_img_path = variant_path(img_path, level)
+    if not os.path.exists(small_img_path):
+        link(variant, small_img_path)
+    return small_img_path
+
+def schedule_prepare(uid, user_data, img_path, reduce):
+    # Prepare image in background. Result goes to user_data['prepared'][img_path],
+    # None there means the image is broken.
+    tasks = prepare_tasks.setdefault(uid, {})
+    old_task = tasks.get(img_path)
+    if old_task is not None and not old_task.done():
+        old_task.cancel()
+    prepared = user_data['prepared']
+    h = user_data['hashes'].get(img_path)
+
+    # same image was prepared before
+    entry = imgcache.get(h)
+    if entry is not None and entry['info'] is not None:
+        info = entry['info'] | {'hash': h}
+        if not reduce:
+            prepared[img_path] = info
+            return
+        small_img_path = cached_variant(info, img_path, REDUCE_LADDER[0])
+        if small_img_path is not None:
+            prepared[img_path] = with_variant(info, REDUCE_LADDER[0], small_img_path)
+            return
+
+    def done(task):
+        if task.cancelled():
+            return
+        err = task.exception()
+        if err is None:
+            info = task.result() | {'hash': h}
+            small_img_path = info.pop('small', None)
+            info.pop('small_size', None)
+            imgcache.set_info(h, info)
+            # re-prepared: keep reduced images made meanwhile
+            variants = (prepared.get(img_path) or {}).get('variants')
+            if variants:
+                info['variants'] = variants
+            if small_img_path is not None:
+                info = with_variant(info, REDUCE_LADDER[0], small_img_path)
+                imgcache.add_variant(h, REDUCE_LADDER[0], small_img_path)
+            prepared[img_path] = info
+        elif not isinstance(err, (JobCancelled, WorkerCrashed)):
+            logger.info(f"u{uid} prepare: broken image {img_path}: {err!r}")
+            prepared[img_path] = None
+
+    # compile jobs go first, compile_pdf promotes the user's own
+    task = asyncio.create_task(pool.run(prepare_image, img_path, reduce, key=uid, background=True))
+    task.add_done_callback(done)
+    tasks[img_path] = task
+
+def drop_variants(images, prepared, keep=None):
+    # Delete reduced images of levels other than `keep` (all if None) once the pdf or the chosen level
+    # supersedes them. Session copies only: the image cache keeps its own links.
+    for img_path in images:
+        info = prepared.get(img_path)
+        if not info or not info.get('variants'):
+            continue
+        for level, (path, _) in info['variants'].items():
+            if level != keep:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+        info['variants'] = {level: v for level, v in info['variants'].items() if level == keep}
+
+async def wait_prepared(uid):
+    # Exceptions are handled by schedule_prepare
+    tasks = list(prepare_tasks.get(uid, {}).values())
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+def cancel_prepare(uid):
+    for task in prepare_tasks.pop(uid, {}).values():
+        task.cancel()
+
+def cancel_edit_expiry(uid):
+    task = edit_expiry.pop(uid, None)
+    if task is not None:
+        task.cancel()
+
+def clear_user_cache(uid) -> bool:
+    cancel_edit_expiry(uid)
+    # stop background jobs writing into the directory
+    downloads.cancel(uid)
+    cancel_prepare(uid)
+    pool.cancel(uid)
     try:
         # delete whole user directory
-        dir = f'cache/{uid}'
-        if os.path.isdir(dir):
-            shutil.rmtree(dir)
+        budget.remove_session(uid)
         return True
     except OSError as err:
         logger.error(f'u{uid}: failed to delete cache. '+str(err))
         return False
 
-async def compile_pdf(update, context, starting_quality=0) -> bool:
+def remove_partial_outputs(images, pdfname, prepared):
+    # leftovers of a killed compile job. Keep finished reduced images.
+    small_images = []
+    for img_path in images:
+        keep = [path for path, _ in (prepared.get(img_path) or {}).get('variants', {}).values()]
+        small_images += [path for path in glob.glob(glob.escape(img_path) + '.q*.jpg') if path not in keep]
+    # image runs compiled before merging user pdfs
+    parts = glob.glob(glob.escape(pdfname) + '.part*') if pdfname else []
+    for path in [pdfname] + small_images + parts:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+async def gather_jobs(coros):
+    # like asyncio.gather, but a failure stops the other jobs too
+    tasks = [asyncio.ensure_future(coro) for coro in coros]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+
+async def reduce_images(images, level, uid, prepared):
+    # Use images reduced before (in background, by an earlier search step, in the image cache),
+    # re-encode the rest as separate jobs, so they are spread across workers. Every job has COMPILATION_TIMEOUT.
+    # Reduced images are recorded in `prepared` and reused later.
+    async def reduced(img_path):
+        if is_pdf(img_path):
+            # merged as is
+            return img_path
+        info = prepared.get(img_path) or {}
+        if level in info.get('variants', {}):
+            return info['variants'][level][0]
+        small_img_path = cached_variant(info, img_path, level)
+        if small_img_path is None:
+            small_img_path = await pool.run(reduce_image, img_path, level, timeout=COMPILATION_TIMEOUT, key=uid)
+            imgcache.add_variant(info.get('hash'), level, small_img_path)
+        if img_path in prepared:
+            prepared[img_path] = with_variant(info, level, small_img_path)
+        return small_img_path
+
+    return await gather_jobs(reduced(img_path) for img_path in images)
+
+async def measure_level(images, level, uid, prepared):
+    # exact pdf size at a reduced level: reduced images are embedded as they are
+    small_images = await reduce_images(images, level, uid, prepared)
+    return sum(os.stat(path).st_size for path in small_images) + estimator.PAGE_OVERHEAD * len(small_images)
+
+async def predict_quality(images, uid, prepared):
+    # Pick quality expected to fit under MAX_PDFSIZE on the first pass
+    infos = [prepared.get(img_path) or {'size': os.stat(img_path).st_size, 'format': None, 'mode': None} for img_path in images]
+    if estimator.needs_samples(infos):
+        # measure reduction on a few largest images. They are reused by the compilation.
+        sample = sorted((p for p in images if prepared.get(p) and not is_pdf(p)), key=lambda p: prepared[p]['size'], reverse=True)
+        try:
+            await reduce_images(sample[:REDUCE_SAMPLES], REDUCE_LADDER[0], uid, prepared)
+        except asyncio.TimeoutError:
+            pass
+        infos = [prepared.get(img_path) or info for img_path, info in zip(images, infos)]
+    return infos, estimator.choose_quality(infos)
+
+def log_retry(update, reason):
+    # how often quality prediction still needs a retry
+    metrics.COMPILE_FAILURES.inc(reason=reason)
+    uid = update.message.from_user.id
+    stats.log(uid, update.message.from_user.username, 'retry', reason)
+
+def cancelled(context, ustr) -> bool:
+    # /cancel came while the compile handler was awaiting. User is already notified
+    if context.user_data.get('cancelled'):
+        logger.info(f"u{ustr} compiler: cancelled.")
+        return True
+    return False
+
+async def compile_attempt(update, images, pdfname, backend, label, ustr, started=None):
+    # Assemble the pdf from prepared images. Returns 'ok', 'timeout', 'size' (too big, try lower quality)
+    # or None on cancel and errors, which abort the session. Notifies user on errors only.
+    # started: perf_counter the compile began at, if work before this attempt belongs to it (reducing images)
+    uid = update.message.from_user.id
+    try:
+        t0 = time.perf_counter()
+        # compile in worker processes without blocking the event loop: other users are served meanwhile.
+        # raises a TimeoutError if timeout, and any exception raised inside the workers.
+        # Timed out or cancelled workers are killed and replaced. Time waiting for a worker doesn't count.
+        await pool.run(build_pdf, images, pdfname, backend, timeout=COMPILATION_TIMEOUT, key=uid)
+        t = time.perf_counter() - t0
+        metrics.COMPILE_SECONDS.observe(time.perf_counter() - (started or t0), quality=label, backend=backend)
+    except JobCancelled:
+        # /cancel during compilation. User is already notified
+        logger.info(f"u{ustr} compiler: cancelled.")
+        remove_partial_outputs([], pdfname, {})
+        return None
+    except asyncio.TimeoutError:
+        t = time.perf_counter() - t0
+        logger.info(f"u{ustr} compiler: timeout, t={t:.2f}s.")
+        remove_partial_outputs([], pdfname, {})
+        log_retry(update, 'timeout')
+        return 'timeout'
+    except OSError as e:
+        # Abort and don't retry
+        logger.error(f"u{ustr} compiler: OSError:", exc_info=True)
+        metrics.COMPILE_FAILURES.inc(reason='error')
+        await update.message.reply_text(S('tg_err_bot'))
+        return None
+    except Exception as e:
+        # Abort and don't retry
+        logger.error(f"u{ustr} compiler: Fuckery:", exc_info=True)
+        metrics.COMPILE_FAILURES.inc(reason='error')
+        await update.message.reply_text(S('tg_err_bot'))
+        return None
+
+    fsize = os.stat(pdfname).st_size
+    fsize_h = fsize/1000000
+    logger.info(f'u{ustr} compiler: success, t={t:.2f}s, s={fsize_h}MB')
+    if fsize >= MAX_PDFSIZE:
+        logger.info(f"u{ustr} compiler: {pdfname} too big")
+        remove_partial_outputs([], pdfname, {})
+        log_retry(update, 'size')
+        return 'size'
+    return 'ok'
+
+async def search_level(update, context, images, infos, first, ustr):
+    """
+    Find the best REDUCE_LADDER level that fits under MAX_PDFSIZE. Returns (level index or None, timed out).
+
+    Reduced images are embedded as they are, so a level is measured by reducing the images, without
+    compiling. Next level to measure is the best one the estimator expects to fit, given the
+    measurements so far, or the middle of the remaining range if it expects none to.
+    Reduced images of every measured level are kept, the final compile and later searches reuse them.
+    """
+    uid = update.message.from_user.id
+    prepared = context.user_data['prepared']
+    lo, hi, best, timed_out = 0, len(REDUCE_LADDER) - 1, None, False
+    probe = first
+    while probe is not None:
+        if context.user_data.get('cancelled'):
+            raise JobCancelled()
+        level = REDUCE_LADDER[probe]
+        try:
+            size = await measure_level(images, level, uid, prepared)
+            logger.info(f"u{ustr} compiler: level {probe} {level}: {size/1e6:.2f}MB")
+        except asyncio.TimeoutError:
+            # higher levels are slower still
+            logger.info(f"u{ustr} compiler: level {probe} {level}: timeout")
+            remove_partial_outputs(images, context.user_data['pdfname'], prepared)
+            log_retry(update, 'timeout')
+            size, timed_out = None, True
+
+        if size is not None and size < MAX_PDFSIZE:
+            best, hi = probe, probe - 1
+        else:
+            if size is not None:
+                log_retry(update, 'size')
+            lo = probe + 1
+        if lo > hi:
+            break
+        infos = [prepared.get(img_path) or info for img_path, info in zip(images, infos)]
+        probe = estimator.choose_level(infos, range(lo, hi + 1))
+        if probe is None and best is None:
+            probe = (lo + hi) // 2
+    return best, timed_out
+
+def compiled_pages(images, prepared, level):
+    # what patch_compiled needs to know about a compiled pdf: pages of every image, quality.
+    # None if a pdf's page count is unknown (its preparation was lost), it can't be patched then
+    items = []
+    for img_path in images:
+        pages = (prepared.get(img_path) or {}).get('pages') if is_pdf(img_path) else 1
+        if pages is None:
+            return None
+        items.append((img_path, pages))
+    return {'items': items, 'level': level}
+
+async def patch_compiled(update, context, images, ustr):
+    """
+    Recompile of an edited session: pages of the sent pdf are reused, new images are compiled
+    at the same quality and put in place. Returns True on success, False on cancel,
+    None to compile from scratch (timeout, pdf got too big, errors).
+    """
+    uid = update.message.from_user.id
+    prepared = context.user_data['prepared']
+    compiled = context.user_data.pop('compiled')
+    pdfname = context.user_data['pdfname']
+    level = compiled['level']
+    old, n = {}, 0
+    for img_path, pages in compiled['items']:
+        old[img_path] = range(n, n + pages)
+        n += pages
+    new = [img_path for img_path in images if img_path not in old]
+    if len(new) == len(images):
+        # nothing to reuse
+        return None
+    logger.info(f'u{ustr} compiler: patch {pdfname}, {len(new)} new of {len(images)}, level={level}:')
+    await update.message.reply_text(S('tg_info_start_patching'), reply_markup=ReplyKeyboardRemove())
+    t0 = time.perf_counter()
+    try:
+        if level is None:
+            sources, backend = new, choose_backend([prepared.get(img_path) for img_path in new])
+        else:
+            sources, backend = await reduce_images(new, level, uid, prepared), 'stream'
+        sources = dict(zip(new, sources))
+        layout = []
+        for img_path in images:
+            layout += list(old[img_path]) if img_path in old else [sources[img_path]]
+        await pool.run(patch_pdf, pdfname, layout, backend, timeout=COMPILATION_TIMEOUT, key=uid)
+    except JobCancelled:
+        logger.info(f"u{ustr} compiler: cancelled.")
+        return False
+    except Exception:
+        logger.info(f"u{ustr} compiler: patch failed, compiling from scratch", exc_info=True)
+        return None
+    t = time.perf_counter() - t0
+    metrics.COMPILE_SECONDS.observe(t, quality='patch', backend=backend)
+    fsize = os.stat(pdfname).st_size
+    logger.info(f'u{ustr} compiler: patched, t={t:.2f}s, s={fsize/1e6}MB')
+    if fsize >= MAX_PDFSIZE:
+        log_retry(update, 'size')
+        return None
+    drop_variants(new, prepared)
+    context.user_data['compiled'] = compiled_pages(images, prepared, level)
+    return True
+
+async def compile_pdf(update, context) -> bool:
     # Returns True if compilation successful.
     # Notifies user on errors, but do not notify on success.
     # Does not clear cache.
@@ -113,68 +425,106 @@ async def compile_pdf(update, context, starting_quality=0) -> bool:
     if update.message.from_user.username:
         ustr += f"(t.me/{update.message.from_user.username})"
     
-    images = context.user_data['images']
+    # Most of the images are usually prepared by now
+    await downloads.wait(uid)
+    pool.promote(uid)
+    await wait_prepared(uid)
+    if cancelled(context, ustr):
+        return False
+    prepared = context.user_data['prepared']
+    broken = [i for i, img_path in enumerate(context.user_data['images']) if prepared.get(img_path, {}) is None]
+    if broken:
+        await update.message.reply_text(S('tg_warn_img_broken').format(', '.join(str(i+1) for i in broken)))
+    images = [img_path for img_path in context.user_data['images'] if prepared.get(img_path, {}) is not None]
+    if not images:
+        await update.message.reply_text(S('tg_err_img_error'))
+        return False
 
-    # start using original image quality. lower quality until success.
-    qs = ['high', 'mid']
-    for quality in qs[starting_quality:]:
-        lasttry = quality == qs[-1]
-        pdf_converter = 'img2pdf'
-        pdfname = f'cache/{uid}/out-{quality}.pdf'
-        context.user_data['pdfname'] = pdfname
+    if cancelled(context, ustr):
+        return False
+    if context.user_data.get('compiled') is not None:
+        patched = await patch_compiled(update, context, images, ustr)
+        if patched is not None:
+            return patched
+        remove_partial_outputs([], context.user_data['pdfname'], {})
 
-        begin = 'begin' if quality == qs[0] else 'repeat'
-        logger.info(f'u{ustr} compiler: {begin} {len(images)} photos, Q={quality}, {pdf_converter} -> {pdfname}:')
-        await update.message.reply_text(S(f'tg_info_start_compiling_{quality}'), reply_markup=ReplyKeyboardRemove())
+    try:
+        infos, (predicted, level) = await predict_quality(images, uid, prepared)
+    except JobCancelled:
+        logger.info(f"u{ustr} compiler: cancelled.")
+        return False
 
-        try:
-            t0 = time.perf_counter()
-            # .get raises a TimeoutError if timeout and any exception raised inside the worker
-            res = pool.apply_async(__img2pdf_compile_pdf, args=(images, pdfname, quality)).get(COMPILATION_TIMEOUT)
-            t = time.perf_counter() - t0
-        except multiprocessing.TimeoutError:
-            # Will retry with lower quality
-            t = time.perf_counter() - t0
-            logger.info(f"u{ustr} compiler: timeout, t={t:.2f}s.")
-            if not lasttry:
-                await update.message.reply_text(S('tg_warn_timeout_retry'))
-            else:
-                await update.message.reply_text(S('tg_err_timeout'))
-            continue
-        except OSError as e:
-            # Abort and don't retry
-            logger.error(f"u{ustr} compiler: OSError:", exc_info=True)
-            await update.message.reply_text(S('tg_err_bot'))
-            return False
-        except Exception as e:
-            # Abort and don't retry
-            logger.error(f"u{ustr} compiler: Fuckery:", exc_info=True)
-            await update.message.reply_text(S('tg_err_bot'))
-            return False
+    if cancelled(context, ustr):
+        return False
 
-        fsize = os.stat(pdfname).st_size
-        fsize_h = fsize/1000000
-        logger.info(f'u{ustr} compiler: success, t={t:.2f}s, s={fsize_h}MB')
-
-        if fsize >= MAX_PDFSIZE:
-            # too big. notify user and try lower quality
-            logger.info(f"u{ustr} compiler: {pdfname} too big")
-            if not lasttry:
-                await update.message.reply_text(S('tg_warn_size_retry'))
-            else:
-                await update.message.reply_text(S('tg_err_pdf_too_big'))
-            continue
-        
-        # all checks passed. pdf seems to be ok. proceed to pdf upload
-        return True
-    # end for quality
+    # original images, if they are expected to fit
+    if predicted == 'high':
+        pdfname = f'cache/{uid}/out-high.pdf'
+        context.user_data['pdfname'] = pdfname
+        pdf_converter = choose_backend(infos)
+        logger.info(f'u{ustr} compiler: begin {len(images)} photos, Q=high, est={estimator.estimate_high(infos)/1e6:.2f}MB, {pdf_converter} -> {pdfname}:')
+        await update.message.reply_text(S('tg_info_start_compiling_high'), reply_markup=ReplyKeyboardRemove())
+        result = await compile_attempt(update, images, pdfname, pdf_converter, 'high', ustr)
+        if result is None:
+            return False
+        if result == 'ok':
+            # all checks passed. pdf seems to be ok. proceed to pdf upload
+            drop_variants(images, prepared)
+            context.user_data['compiled'] = compiled_pages(images, prepared, None)
+            return True
+        await update.message.reply_text(S('tg_warn_timeout_retry' if result == 'timeout' else 'tg_warn_size_retry'))
+        level = estimator.choose_level(infos)
+        if level is None:
+            level = len(REDUCE_LADDER) - 1
+
+    if cancelled(context, ustr):
+        return False
 
-    # If not exited yet, then lowest quality pdf still fails. 
-    # User is already notified.
-    logger.info(f"u{ustr} compiler: final failure.")
-    return False
+    # reduced images: best level that fits
+    pdfname = f'cache/{uid}/out-mid.pdf'
+    context.user_data['pdfname'] = pdfname
+    logger.info(f'u{ustr} compiler: begin {len(images)} photos, Q=mid, level={level}, est={estimator.estimate_reduced(infos, REDUCE_LADDER[level])/1e6:.2f}MB')
+    starting = 'mid' if level < len(REDUCE_LADDER) // 2 else 'low'
+    await update.message.reply_text(S(f'tg_info_start_compiling_{starting}'), reply_markup=ReplyKeyboardRemove())
+    # the histogram counts the level search too, most of the work is reducing images
+    started = time.perf_counter()
+    try:
+        best, timed_out = await search_level(update, context, images, infos, level, ustr)
+    except JobCancelled:
+        # User is already notified
+        logger.info(f"u{ustr} compiler: cancelled.")
+        remove_partial_outputs(images, pdfname, prepared)
+        return False
+    except Exception:
+        # broken image, worker crash. Abort and don't retry
+        logger.error(f"u{ustr} compiler: Fuckery:", exc_info=True)
+        metrics.COMPILE_FAILURES.inc(reason='error')
+        await update.message.reply_text(S('tg_err_bot'))
+        return False
+    if best is None:
+        # Even the lowest level fails
+        logger.info(f"u{ustr} compiler: final failure.")
+        await update.message.reply_text(S('tg_err_timeout' if timed_out else 'tg_err_pdf_too_big'))
+        return False
 
-# This function logs successful pdf sessions. Uses context.user_data['pdfname']
+    if cancelled(context, ustr):
+        return False
+    level = REDUCE_LADDER[best]
+    # other measured levels are of no use now
+    drop_variants(images, prepared, keep=level)
+    logger.info(f'u{ustr} compiler: level {best} {level} -> {pdfname}:')
+    # all reduced images are JPEG, pdfs are merged as they are
+    small_images = [img_path if is_pdf(img_path) else variant_path(img_path, level) for img_path in images]
+    result = await compile_attempt(update, small_images, pdfname, choose_backend([None] * len(images)), f'level{best}', ustr, started)
+    if result in ('timeout', 'size'):
+        # measured to fit, should not happen
+        await update.message.reply_text(S('tg_err_timeout' if result == 'timeout' else 'tg_err_pdf_too_big'))
+    if result == 'ok':
+        drop_variants(images, prepared)
+        context.user_data['compiled'] = compiled_pages(images, prepared, level)
+    return result == 'ok'
+
+# This function logs successful pdf sessions. Uses context.user_data['pdfname']. Returns upload result
 async def upload_pdf(update, context):
     uid = update.message.from_user.id
     ustr = str(uid)
@@ -185,36 +535,25 @@ async def upload_pdf(update, context):
     number_of_images = len(images)
     pdfname = context.user_data['pdfname']
     
-    logger.info("u{ustr} upload: begin")
+    logger.info(f"u{ustr} upload: begin")
     await update.message.reply_text(S('tg_info_pdf_success'))
     
-    try:
-        t0 = time.perf_counter()
-        # This line brings me a lot of pain.
-        # reply_document always raises a TimedOut unless I specify unusually high timeouts.
-        # Moreover, pdf file is still open afterwards so i cannot delete it.
-        await update.message.reply_document(
-            document=open(pdfname, 'rb'),
-            filename=context.user_data['filename'] + '.pdf',
-            # read_timeout=15.0,
-            write_timeout=30.0,
-            connect_timeout=30.0
-        )
-        t = time.perf_counter() - t0
-        logger.info(f'u{ustr} upload: done, t={t:.2f}s')
-        statistics_file.write(f"{datetime.now().strftime("%Y-%m-%d")},{uid},{update.message.from_user.username},success,{number_of_images}\n")
-
-        if REQUEST_DONATION:
-            await update.message.reply_text(S('tg_info_donate'))
-
-    except TimedOut as err:
+    t0 = time.perf_counter()
+    result = await uploader.send(update.message, pdfname, context.user_data['filename'] + '.pdf')
+    t = time.perf_counter() - t0
+    metrics.UPLOAD_SECONDS.observe(t, result=result)
+    logger.info(f'u{ustr} upload: {result}, t={t:.2f}s')
+    if result == FAILURE:
+        await update.message.reply_text(S('tg_err_upload'))
+        return result
+    stats.log(uid, update.message.from_user.username, result, number_of_images)
+
+    if result == MAYBE_SUCCESS:
         # Telegram timeout
-        t = time.perf_counter() - t0
-        logger.warning(f'u{ustr} upload: timeout, t={t:.2f}s')
         await update.message.reply_text(S('tg_err_upload_timeout_but_ok'))
-        statistics_file.write(f"{datetime.now().strftime("%Y-%m-%d")},{uid},{update.message.from_user.username},success?,{number_of_images}\n")
-    except NetworkError as e:
-        logger.error(f'u{ustr} upload: network error', exc_info=True)
+    elif REQUEST_DONATION:
+        await update.message.reply_text(S('tg_info_donate'))
+    return result
 
 # Create user context and log the beginning of conversation
 def newpdf(update, context, quick=False):
@@ -233,16 +572,21 @@ def newpdf(update, context, quick=False):
     context.user_data['lower_quality_notified'] = False
     context.user_data['filename'] = None
     context.user_data['pdfname'] = None
+    context.user_data['prepared'] = {}
+    context.user_data['hashes'] = {}
 
     q = "quick " if quick else ""
     logger.info(f"u{ustr} New {q}pdf")
-    statistics_file.write(f"{datetime.now().strftime("%Y-%m-%d")},{uid},{update.message.from_user.username},newpdf,{quick}\n")
+    stats.log(uid, update.message.from_user.username, 'newpdf', quick)
 
 
 #### Bot handlers
 
 async def newpdf_handler(update, context):
     user = update.message.from_user
+    if not budget.admit_session():
+        await update.message.reply_text(S('tg_err_disk_full'), reply_markup=ReplyKeyboardRemove())
+        return ConversationHandler.END
     newpdf(update, context)
     await update.message.reply_text(S('tg_info_newpdf'), parse_mode=ParseMode.HTML, reply_markup=ReplyKeyboardRemove())
     return FILENAME
@@ -256,68 +600,139 @@ async def filename_input(update, context):
     
     # In quick mode. Images are provided first, then compile handler, then filename. After filename input we are ready to compile.
     if context.user_data['quick']:
-        # Reuse compile handler for consistency
-        _ = await compile_handler(update, context)
-        return ConversationHandler.END
+        # Reuse compile handler for consistency. Rejected compile: wait for /compile
+        state = await compile_handler(update, context)
+        return CONTENT if state is None else state
 
     # Otherwise, in classic mode. Filename is provided first, then images, then compile handler. No action needed.
     await update.message.reply_text(S('tg_info_newpdf_name_accepted'), parse_mode=ParseMode.HTML)
     return CONTENT
 
-async def save_img(file, update, context):
-    uid = update.message.from_user.id
-    try:
-        if not 'images' in context.user_data:
-            # This is a beginning of new conversation.
-            newpdf(update, context, quick=True)
-            await update.message.reply_text(S('tg_info_newpdf_quick'))
-        
-        if len(context.user_data['images']) >= MAX_IMG_N:
-            await update.message.reply_text(S('tg_info_max_imgs'))
-            return
-        if context.user_data['total_size'] >= MAX_TOTAL_IMG_SIZE:
-            await update.message.reply_text(S('tg_info_max_total_size'))
+def page_key(img_path):
+    # images are named by message id, which is the page order
+    return int(os.path.basename(img_path).split('.')[0])
+
+async def report_added(update, context, page_n):
+    keyboard = ReplyKeyboardMarkup([["/compile 🎉"],["/cancel ❌", "/help ℹ"]])
+    if update.message.media_group_id is None:
+        await update.message.reply_text(
+            S('tg_info_img_ok').format(page_n) + '\n' + statusbar(context)
+            , do_quote=True
+        , reply_markup=keyboard)
+        return
+
+    # Album: one reply when all its images are downloaded
+    key = (update.message.from_user.id, update.message.media_group_id)
+    album = album_replies.setdefault(key, {'message': update.message, 'added': 0, 'flush': None})
+    album['added'] += 1
+    if album['flush'] is not None:
+        album['flush'].cancel()
+
+    async def flush():
+        await asyncio.sleep(ALBUM_REPLY_DELAY)
+        await downloads.wait(key[0])
+        del album_replies[key]
+        if 'images' not in context.user_data:
+            # session ended meanwhile
             return
-        elif context.user_data['total_size'] >= MAX_PDFSIZE and not context.user_data['lower_quality_notified']:
-            context.user_data['lower_quality_notified'] = True
-            await update.message.reply_text(S('tg_info_low_quality_mode'))
+        await album['message'].reply_text(
+            S('tg_info_imgs_ok').format(album['added']) + '\n' + statusbar(context)
+        , reply_markup=keyboard)
+
+    album['flush'] = asyncio.create_task(flush())
+
+async def download(attachment, message, context, name):
+    # Image or pdf into cache/<uid>/<name><ext>. Returns (path, size), or None after telling the user why not
+    uid = message.from_user.id
+    if attachment.file_size is not None and attachment.file_size > MAX_IMG_SIZE:
+        await message.reply_text(S('tg_err_img_too_big'), do_quote=True)
+        return None
+
+    budget.create_session(uid)
+    entry = imgcache.lookup(attachment.file_unique_id)
+    # other downloads of the user run meanwhile: space is reserved until the file is counted
+    reserve = 0 if entry is not None else attachment.file_size or MAX_IMG_SIZE
+    if reserve and not budget.reserve(uid, reserve):
+        await message.reply_text(S('tg_err_disk_full'), do_quote=True)
+        return None
+    try:
+        if entry is not None:
+            # resent image or duplicate page: no download
+            filename = f'cache/{uid}/{name}{entry["ext"]}'
+            link(entry['path'], filename)
+        else:
+            file = await attachment.get_file()
 
-        images = context.user_data['images']
-        im_n = len(images)
+            # try to get file type
+            dot_index = file.file_path.rfind('.')
+            if dot_index == -1:
+                await message.reply_text(S('tg_err_no_img_format'), do_quote=True)
+                return None
+            filetype = file.file_path[dot_index:].lower()
+            if not filetype in ['.jpg', '.jpeg', '.png', '.gif', '.pdf']:
+                await message.reply_text(S('tg_err_unsupported_img_format'), do_quote=True)
+                return None
 
-        if file.file_size is not None and file.file_size > MAX_IMG_SIZE:
-            await update.message.reply_text(S('tg_err_img_too_big'), do_quote=True)
-            return
+            filename = f'cache/{uid}/{name}{filetype}'
 
-        # try to get file type
-        dot_index = file.file_path.rfind('.')
-        if dot_index == -1:
-            await update.message.reply_text(S('tg_err_no_img_format'), do_quote=True)
-            return
-        filetype = file.file_path[dot_index:].lower()
-        if not filetype in ['.jpg', '.jpeg', '.png', '.gif']:
-            await update.message.reply_text(S('tg_err_unsupported_img_format'), do_quote=True)
-            return
-        
-        os.makedirs(f'cache/{uid}', exist_ok=True)
-        filename = f'cache/{uid}/{im_n}{filetype}'
-        
-        await file.download_to_drive(filename)
+            t0 = time.perf_counter()
+            await file.download_to_drive(filename)
+            metrics.DOWNLOAD_SECONDS.observe(time.perf_counter() - t0)
+            entry = await imgcache.add(attachment.file_unique_id, filename)
+        context.user_data['hashes'][filename] = entry['hash']
 
         img_size = os.stat(filename).st_size
-        if img_size > MAX_IMG_SIZE:
-            await update.message.reply_text(S('tg_err_img_too_big'), do_quote=True)
-            os.remove(filename)
+        budget.scan(uid)
+    finally:
+        budget.release(uid, reserve)
+    metrics.IMAGE_BYTES.observe(img_size)
+    if img_size > MAX_IMG_SIZE:
+        await message.reply_text(S('tg_err_img_too_big'), do_quote=True)
+        os.remove(filename)
+        return None
+    return filename, img_size
+
+def insert_page(images, filename):
+    # Downloads finish in any order, new pages follow message order.
+    # Searched from the end: pages moved by /move stay where they are
+    i = len(images)
+    while i > 0 and page_key(images[i-1]) > page_key(filename):
+        i -= 1
+    images.insert(i, filename)
+
+def schedule_prepare_added(uid, user_data, filename, img_size):
+    # Start image processing right away, so /compile mostly assembles ready pieces
+    images = user_data['images']
+    low_quality = user_data['total_size'] >= MAX_PDFSIZE
+    if low_quality and user_data['total_size'] - img_size < MAX_PDFSIZE:
+        # just entered low quality mode: reduce previous images too
+        for img_path in images:
+            if img_path != filename:
+                schedule_prepare(uid, user_data, img_path, reduce=True)
+    schedule_prepare(uid, user_data, filename, reduce=low_quality)
+
+async def save_img(attachment, update, context):
+    # Runs in background, see add_image. Several downloads of a user may run at once.
+    uid = update.message.from_user.id
+    try:
+        if context.user_data['total_size'] >= MAX_PDFSIZE and not context.user_data['lower_quality_notified']:
+            context.user_data['lower_quality_notified'] = True
+            await update.message.reply_text(S('tg_info_low_quality_mode'))
+
+        images = context.user_data['images']
+        downloaded = await download(attachment, update.message, context, update.message.message_id)
+        if downloaded is None:
             return
+        filename, img_size = downloaded
 
         # Add image!
-        images.append(filename)
+        insert_page(images, filename)
         context.user_data['total_size'] = context.user_data['total_size'] + img_size
+        schedule_prepare_added(uid, context.user_data, filename, img_size)
+        # changed after the handler returned, persist with the next update_persistence run
+        context.application.mark_data_for_update_persistence(user_ids=uid)
 
-        await update.message.reply_text(
-            S('tg_info_img_ok').format(im_n+1) + '\n' + statusbar(context)
-            , do_quote=True
-        , reply_markup=ReplyKeyboardMarkup([["/compile 🎉"],["/cancel ❌", "/help ℹ"]]))
+        await report_added(update, context, images.index(filename) + 1)
     except Exception as err:
         ustr = str(uid)
         if update.message.from_user.username:
@@ -325,44 +740,158 @@ async def save_img(file, update, context):
         logger.error(f"u{ustr} Error saving image: " + str(err))
         await update.message.reply_text(S('tg_err_img_error'), do_quote=True)
 
+def over_limit(uid, *names):
+    # First of the rate limits `names` the user is over, None if none.
+    # Takes a token from the others, 'cpu' is charged by the worker pool after jobs
+    for name in names:
+        if not (limiter.check(uid, name) if name == 'cpu' else limiter.allow(uid, name)):
+            return name
+    return None
+
+async def reject_rate_limited(message, uid, name, once=False):
+    # once: reply to the first of many rejected messages only (album, spam)
+    metrics.RATE_LIMITED.inc(limit=name)
+    if once and not limiter.notify_once(uid, name):
+        return
+    minutes = max(1, math.ceil(limiter.retry_after(uid, name) / 60))
+    logger.info(f"u{uid} rate limit: {name}, retry in {minutes} min")
+    await message.reply_text(S('tg_err_rate_limited').format(minutes), do_quote=True)
+
+async def add_image(attachment, update, context):
+    # Returns next conversation state
+    uid = update.message.from_user.id
+    # before any download, also before a session is started
+    limit = over_limit(uid, 'cpu', 'images')
+    if limit is not None:
+        await reject_rate_limited(update.message, uid, limit, once=True)
+        return CONTENT if 'images' in context.user_data else ConversationHandler.END
+    if not 'images' in context.user_data:
+        # This is a beginning of new conversation.
+        if not budget.admit_session():
+            await update.message.reply_text(S('tg_err_disk_full'))
+            return ConversationHandler.END
+        newpdf(update, context, quick=True)
+        await update.message.reply_text(S('tg_info_newpdf_quick'))
+
+    if len(context.user_data['images']) + downloads.pending(uid) >= MAX_IMG_N:
+        await update.message.reply_text(S('tg_info_max_imgs'))
+        return CONTENT
+    # downloads in progress count with their expected size
+    if context.user_data['total_size'] + downloads.reserved(uid) >= MAX_TOTAL_IMG_SIZE:
+        await update.message.reply_text(S('tg_info_max_total_size'))
+        return CONTENT
+    # download in background, so the next images of an album are fetched meanwhile
+    downloads.submit(uid, save_img(attachment, update, context), attachment.file_size or MAX_IMG_SIZE)
+    return CONTENT
+
 async def addfile(update, context):
     """input: image file"""
-    image = await update.message.document.get_file()
-    await save_img(image, update, context)
-    return CONTENT
+    return await add_image(update.message.document, update, context)
 
 async def addphoto(update, context):
     """input: tg photo"""
-    image = await update.message.photo[-1].get_file()
-    await save_img(image, update, context)
-    return CONTENT
+    return await add_image(update.message.photo[-1], update, context)
+
+async def edit_expired(update):
+    # edit of a sent pdf expired, the session is already cleared
+    await update.message.reply_text(S('tg_info_edit_expired'), reply_markup=ReplyKeyboardRemove())
+    return ConversationHandler.END
+
+def end_session(update, context):
+    clear_user_cache(update.message.from_user.id)
+    context.user_data.clear()
+    logger.info(f"u{update.message.from_user.id} - end")
+    return ConversationHandler.END
 
 async def compile_handler(update, context):
+    state = await run_compile(update, context)
+    if state != ConversationHandler.END and context.user_data.get('cancelled'):
+        # /cancel came while waiting for downloads or replying, before the compile started
+        return end_session(update, context)
+    return state
+
+async def run_compile(update, context):
+    if 'images' not in context.user_data:
+        return await edit_expired(update)
+    await downloads.wait(update.message.from_user.id)
+    if 'images' not in context.user_data:
+        return await edit_expired(update)
+
     # default mode, filename provided, but no images
     if not (context.user_data['images']):
         await update.message.reply_text(S('tg_info_no_imgs'))
-        return CONTENT
+        return None
 
     # yes images but need filename. This happens only in quick mode.
     if context.user_data['filename'] is None:
         await update.message.reply_text(S('tg_info_enter_name'), reply_markup=ReplyKeyboardRemove())
         return FILENAME
-    
+
+    # a compile is charged once it can start: not for asking a filename or an empty session
+    limit = over_limit(update.message.from_user.id, 'cpu', 'compiles')
+    if limit is not None:
+        # keep the session and its state
+        await reject_rate_limited(update.message, update.message.from_user.id, limit)
+        return None
+
+    if not budget.admit(update.message.from_user.id, COMPILE_DISK_RESERVE):
+        # keep the session, space frees up as other sessions end
+        logger.info(f"u{update.message.from_user.id} disk: compile rejected, {budget.total/1e6:.0f}MB used")
+        # not the user's fault: give the compile back
+        limiter.charge(update.message.from_user.id, 'compiles', -1)
+        await update.message.reply_text(S('tg_err_disk_full_compile'))
+        return None
+
     # filename provided, yes images, proceed
-    pdf_success = await compile_pdf(update, context)
-    if pdf_success:
-        await upload_pdf(update, context)
-    # end session regardless of result
-    clear_user_cache(update)
-    context.user_data.clear()
-    logger.info(f"u{update.message.from_user.id} - end")
-    return ConversationHandler.END
+    async def on_queued(pos):
+        await update.message.reply_text(S('tg_info_queue_position').format(pos), reply_markup=ReplyKeyboardRemove())
+
+    try:
+        async with scheduler.slot(update.message.from_user.id, on_queued):
+            # admitted: a sent pdf stays editable until now
+            if 'images' not in context.user_data:
+                return await edit_expired(update)
+            cancel_edit_expiry(update.message.from_user.id)
+            pdf_success = await compile_pdf(update, context)
+    except JobCancelled:
+        # /cancel while waiting in queue
+        pdf_success = False
+    except (QueueFull, UserLimit) as e:
+        # keep the session, user may /compile again later
+        logger.info(f"u{update.message.from_user.id} scheduler: rejected, {type(e).__name__}")
+        limiter.charge(update.message.from_user.id, 'compiles', -1)
+        await update.message.reply_text(S('tg_err_queue_full'))
+        return None
+    # /cancel after the compile: nothing is sent
+    if pdf_success and context.user_data.get('cancelled'):
+        logger.info(f"u{update.message.from_user.id} compiler: cancelled, not sending")
+        pdf_success = False
+    if pdf_success and await upload_pdf(update, context) != FAILURE and not context.user_data.get('cancelled'):
+        # keep the session for a while, fixes are patched into the sent pdf
+        await start_editing(update, context)
+        return EDIT
+    # end session otherwise
+    return end_session(update, context)
+
+async def compiling_handler(update, context):
+    # Conversation is waiting for the non-blocking compile handler to finish. Edited messages too
+    await update.effective_message.reply_text(S('tg_info_compiling_busy'), do_quote=True)
+
+async def cancel_compile(update, context):
+    # /cancel while compile handler is running. Compile handler ends the session and clears the cache.
+    uid = update.message.from_user.id
+    context.user_data['cancelled'] = True
+    downloads.cancel(uid)
+    scheduler.cancel(uid)
+    pool.cancel(uid)
+    await update.message.reply_text(S('tg_info_cancel'), reply_markup=ReplyKeyboardRemove())
+    logger.info(f"u{uid} - cancelling compilation")
 
 async def cancel(update, context):
-    clear_user_cache(update)
+    clear_user_cache(update.message.from_user.id)
     await update.message.reply_text(S('tg_info_cancel'), reply_markup=ReplyKeyboardRemove())
     logger.info(f"u{update.message.from_user.id} - cancelled")
-    clear_user_cache(update)
+    clear_user_cache(update.message.from_user.id)
     context.user_data.clear()
     return ConversationHandler.END
 
@@ -381,80 +910,332 @@ async def unknown_handler(update, context):
 
 # -------------------------
 
-async def edit_handler(update, context):
-    await update.message.reply_text(S('tg_err_unimplemented'))
-    # TODO
+#### Editing. Pages are numbered as in 'image N added' replies, a pdf sent by the user is one page.
+
+def forget_image(uid, user_data, img_path):
+    # remove an image from the session with everything made from it
+    task = prepare_tasks.get(uid, {}).pop(img_path, None)
+    if task is not None:
+        task.cancel()
+    user_data['prepared'].pop(img_path, None)
+    user_data['hashes'].pop(img_path, None)
+    for path in [img_path] + glob.glob(glob.escape(img_path) + '.q*.jpg'):
+        try:
+            if path == img_path:
+                user_data['total_size'] -= os.stat(path).st_size
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    budget.scan(uid)
+
+def page_index(images, arg):
+    # index of page number `arg`, None if it is not one
+    if not arg.isdigit() or not 1 <= int(arg) <= len(images):
+        return None
+    return int(arg) - 1
+
+async def remove_handler(update, context):
+    # /remove N
+    if 'images' not in context.user_data:
+        await update.message.reply_text(S('tg_info_edit_expired'), reply_markup=ReplyKeyboardRemove())
+        return ConversationHandler.END
+    uid = update.message.from_user.id
+    await downloads.wait(uid)
+    images = context.user_data['images']
+    i = page_index(images, context.args[0]) if len(context.args) == 1 else None
+    if i is None:
+        await update.message.reply_text(S('tg_err_edit_usage'), do_quote=True)
+        return None
+    forget_image(uid, context.user_data, images.pop(i))
+    context.application.mark_data_for_update_persistence(user_ids=uid)
+    logger.info(f"u{uid} - removed page {i+1}")
+    await update.message.reply_text(S('tg_info_page_removed').format(i+1) + '\n' + statusbar(context))
+    return None
+
+async def move_handler(update, context):
+    # /move N M
+    if 'images' not in context.user_data:
+        await update.message.reply_text(S('tg_info_edit_expired'), reply_markup=ReplyKeyboardRemove())
+        return ConversationHandler.END
+    uid = update.message.from_user.id
+    await downloads.wait(uid)
+    images = context.user_data['images']
+    i, j = (page_index(images, arg) for arg in context.args) if len(context.args) == 2 else (None, None)
+    if i is None or j is None:
+        await update.message.reply_text(S('tg_err_edit_usage'), do_quote=True)
+        return None
+    images.insert(j, images.pop(i))
+    context.application.mark_data_for_update_persistence(user_ids=uid)
+    logger.info(f"u{uid} - moved page {i+1} to {j+1}")
+    await update.message.reply_text(S('tg_info_page_moved').format(i+1, j+1))
+    return None
+
+async def replace_img(attachment, update, context, old):
+    # Runs in background like save_img: page of an edited message gets the new image
+    message = update.edited_message
+    uid = message.from_user.id
+    try:
+        # new name: the old image stays until the new one is in place
+        downloaded = await download(attachment, message, context, f'{message.message_id}.u{update.update_id}')
+        if downloaded is None:
+            return
+        filename, img_size = downloaded
+        images = context.user_data.get('images', [])
+        if old not in images:
+            # removed meanwhile
+            os.remove(filename)
+            return
+        i = images.index(old)
+        images[i] = filename
+        context.user_data['total_size'] += img_size
+        forget_image(uid, context.user_data, old)
+        schedule_prepare_added(uid, context.user_data, filename, img_size)
+        context.application.mark_data_for_update_persistence(user_ids=uid)
+        logger.info(f"u{uid} - replaced page {i+1}")
+        await message.reply_text(S('tg_info_page_replaced').format(i+1) + '\n' + statusbar(context), do_quote=True)
+    except Exception as err:
+        logger.error(f"u{uid} Error replacing image: " + str(err))
+        await message.reply_text(S('tg_err_img_error'), do_quote=True)
+
+async def edit_content(update, context):
+    # Image message edited: its page is replaced. Other edits are ignored
+    message = update.edited_message
+    attachment = message.photo[-1] if message.photo else message.document
+    if 'images' not in context.user_data or attachment is None:
+        return None
+    uid = message.from_user.id
+    limit = over_limit(uid, 'cpu', 'images')
+    if limit is not None:
+        await reject_rate_limited(message, uid, limit, once=True)
+        return None
+    await downloads.wait(uid)
+    old = next((img_path for img_path in context.user_data['images'] if page_key(img_path) == message.message_id), None)
+    if old is not None:
+        downloads.submit(uid, replace_img(attachment, update, context, old))
+    return None
+
+async def expire_edit(uid, application):
+    await asyncio.sleep(EDIT_TTL)
+    edit_expiry.pop(uid, None)
+    clear_user_cache(uid)
+    application.user_data[uid].clear()
+    application.mark_data_for_update_persistence(user_ids=uid)
+    logger.info(f"u{uid} - edit expired")
+
+async def start_editing(update, context):
+    # pdf is sent: it can be fixed for EDIT_TTL, then the session ends
+    uid = update.message.from_user.id
+    cancel_edit_expiry(uid)
+    edit_expiry[uid] = asyncio.create_task(expire_edit(uid, context.application))
+    keyboard = ReplyKeyboardMarkup([["/done ✅"], ["/help ℹ"]])
+    await update.message.reply_text(S('tg_info_edit'), reply_markup=keyboard)
+
+async def done_handler(update, context):
+    clear_user_cache(update.message.from_user.id)
+    context.user_data.clear()
+    await update.message.reply_text(S('tg_info_edit_done'), reply_markup=ReplyKeyboardRemove())
+    logger.info(f"u{update.message.from_user.id} - end")
+    return ConversationHandler.END
 
-def edit_content(update, context):
-    # TODO
-    pass
+async def leave_edit(update, context):
+    # new images or /newpdf after the pdf was sent start a new pdf
+    clear_user_cache(update.message.from_user.id)
+    context.user_data.clear()
+    logger.info(f"u{update.message.from_user.id} - end")
+    if update.message.photo:
+        return await addphoto(update, context)
+    if update.message.document:
+        return await addfile(update, context)
+    return await newpdf_handler(update, context)
 
 # -------------------------
 
-async def post_shutdown(application:Application):
-    r = requests.post(
-        f"https://api.telegram.org/bot{token}/sendMessage", 
-        data={'chat_id': ADMIN_UID,  'text': f"!!! @{BOT_USERNAME} is down"}
-    )
+async def recover_sessions(application:Application):
+    # Sessions restored by persistence. Images are still in cache/<uid>, background preparation is lost.
+    recovered = []
+    for uid, user_data in application.user_data.items():
+        if 'images' not in user_data:
+            continue
+        # compilation was interrupted, user can /compile again
+        user_data.pop('cancelled', None)
+        images = [img_path for img_path in user_data['images'] if os.path.exists(img_path)]
+        user_data['images'] = images
+        user_data['total_size'] = sum(os.stat(img_path).st_size for img_path in images)
+        if 'compiled' in user_data:
+            # edit of a sent pdf, expires as usual
+            if not os.path.exists(user_data['pdfname']):
+                user_data['compiled'] = None
+            edit_expiry[uid] = asyncio.create_task(expire_edit(uid, application))
+        prepared = user_data['prepared']
+        for img_path in list(prepared):
+            info = prepared[img_path]
+            if img_path not in images:
+                del prepared[img_path]
+            elif info is not None and 'variants' in info:
+                info['variants'] = {level: v for level, v in info['variants'].items() if os.path.exists(v[0])}
+        for img_path in images:
+            if img_path not in prepared:
+                schedule_prepare(uid, user_data, img_path, reduce=user_data['total_size'] >= MAX_PDFSIZE)
+        application.mark_data_for_update_persistence(user_ids=uid)
+        recovered.append(uid)
+
+    # count recovered sessions, sweep directories of sessions that weren't persisted
+    budget.recover(set(recovered))
+    logger.info(f"recovered {len(recovered)} sessions")
+
+    for uid in recovered:
+        if not application.user_data[uid]['images']:
+            continue
+        try:
+            await application.bot.send_message(uid, S('tg_info_session_recovered').format(len(application.user_data[uid]['images'])))
+        except TelegramError as err:
+            logger.info(f"u{uid} failed to notify about recovered session: {err}")
+
+async def notify_admin(application:Application, text):
+    try:
+        await application.bot.send_message(ADMIN_UID, text)
+    except TelegramError as err:
+        logger.warning(f"failed to notify admin: {err}")
+
+async def post_stop(application:Application):
+    # bot is still initialized here, unlike in post_shutdown
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    if RATE_LIMITS_FILE is not None:
+        limiter.save(RATE_LIMITS_FILE)
+    await notify_admin(application, f"!!! @{BOT_USERNAME} is down")
     
 async def post_init(application:Application):
-    r = requests.post(
-        f"https://api.telegram.org/bot{token}/sendMessage", 
-        data={'chat_id': ADMIN_UID,  'text': f"@{BOT_USERNAME} is up"}
-    )
+    # runs before the application does: application.create_task would warn about every task
+    coros = [
+        # workers start in the background, first jobs wait for them
+        pool.start(),
+        metrics.monitor_loop_lag(),
+        imgcache.expire_periodically(IMAGE_CACHE_EXPIRY_INTERVAL),
+        budget.rescan_periodically(DISK_RESCAN_INTERVAL),
+        limiter.prune_periodically(RATE_LIMITS_PRUNE_INTERVAL),
+        stats.run(),
+        recover_sessions(application),
+    ]
+    if METRICS_PORT is not None:
+        await metrics.serve(METRICS_HOST, METRICS_PORT)
+    if JOB_QUEUE is not None:
+        coros.append(pool.poll_counts())
+    if METRICS_SUMMARY_INTERVAL is not None:
+        coros.append(metrics.send_summaries(application.bot, ADMIN_UID, METRICS_SUMMARY_INTERVAL))
+    background_tasks.extend(asyncio.create_task(coro) for coro in coros)
+    startup = time.perf_counter() - started
+    logger.info(f"up in {startup:.2f}s")
+    await notify_admin(application, f"@{BOT_USERNAME} is up, startup {startup:.2f}s")
 
 # TODO: register error handler for large images.
 
-def main():
+def build_application(base_url=None, base_file_url=None) -> Application:
+    """
+    The bot with its handlers and services, not started yet.
+    base_url, base_file_url: Bot API server other than telegram's, e.g. the stub of loadtest.py.
+    """
+    global started
+    started = time.perf_counter()
     if not os.path.exists("cache"):
         os.mkdir("cache")
 
-    statistics_file_name = f"stats.{round(time.time())}.txt"
-    global statistics_file
-    statistics_file = open(statistics_file_name, "w", buffering=1) 
-
-    global pool
-    pool = multiprocessing.Pool(POOL_WORKERS)
+    global stats
+    stats = StatsSink(STATS_DB, STATS_FLUSH_INTERVAL)
+
+    global pool, scheduler, downloads, imgcache, budget, limiter, uploader
+    limiter = RateLimiter(RATE_LIMITS)
+    if RATE_LIMITS_FILE is not None:
+        limiter.load(RATE_LIMITS_FILE)
+    # worker time of every job counts towards the user's CPU limit
+    account = lambda uid, seconds: limiter.charge(uid, 'cpu', seconds)
+    if JOB_QUEUE is not None:
+        # distributed mode: jobs run on worker.py processes, possibly on other machines
+        pool = RemotePool(SqliteJobQueue(JOB_QUEUE), POOL_WORKERS, account=account)
+    else:
+        # workers may import this module again, its heavy imports are preloaded too
+        pool = WorkerPool(POOL_WORKERS, preload=WORKER_PRELOAD + ['telegram.ext'], max_jobs=WORKER_MAX_JOBS, account=account)
+    downloads = DownloadManager(MAX_CONCURRENT_DOWNLOADS)
+    imgcache = ImageCache(IMAGE_CACHE_DIR, IMAGE_CACHE_BUDGET, IMAGE_CACHE_TTL)
+    budget = DiskBudget('cache', DISK_BUDGET, USER_DISK_BUDGET, DISK_ADMIT_NEW, imgcache, SCRATCH_DIR, SCRATCH_BUDGET, SCRATCH_SESSION_RESERVE)
+    uploader = Uploader(UPLOAD_RETRIES, UPLOAD_TIMEOUT, IMAGE_CACHE_TTL)
+
+    metrics.Gauge('tgpdf_queue_depth', 'Compile jobs waiting for a worker', lambda: scheduler.queued)
+    metrics.Gauge('tgpdf_compile_jobs_running', 'Compile jobs holding a scheduler slot', lambda: scheduler.running)
+    metrics.Gauge('tgpdf_worker_utilization', 'Busy worker processes / all worker processes', lambda: pool.busy / pool.workers)
+    metrics.Gauge('tgpdf_downloads_in_flight', 'Image downloads in progress', lambda: downloads.in_flight)
+    metrics.Gauge('tgpdf_disk_bytes', 'Bytes of session directories and image cache', lambda: budget.total)
+    metrics.Gauge('tgpdf_scratch_bytes', 'Bytes of scratch reserved or used by sessions', lambda: budget.scratch_used)
+    scheduler = CompileScheduler(POOL_WORKERS, MAX_QUEUED_JOBS, MAX_JOBS_PER_USER)
 
     logger.info("Starting up")
-    """Start the bot."""
 
-    application = (
+    builder = (
         Application.builder()
         .token(token)
         .post_init(post_init)
-        .post_shutdown(post_shutdown)
-        .build()
+        .post_stop(post_stop)
+        .concurrent_updates(PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        .persistence(SqlitePersistence(SESSIONS_DB, SESSIONS_UPDATE_INTERVAL))
     )
+    if base_url is not None:
+        builder = builder.base_url(base_url).base_file_url(base_file_url)
+    application = builder.build()
+
+    # pdfs are merged page by page
+    allowed_file_types_filter = Filters.Document.JPG | Filters.Document.GIF | Filters.Document.MimeType("image/png") | Filters.Document.PDF
 
-    allowed_file_types_filter = Filters.Document.JPG | Filters.Document.GIF | Filters.Document.MimeType("image/png")
+    # image message edited: replace its page
+    edited_handler = MessageHandler(Filters.UpdateType.EDITED_MESSAGE, edit_content)
 
     conv_handler = ConversationHandler(
         entry_points=[
+            edited_handler,
             CommandHandler('newpdf', newpdf_handler), # Classic way
-            # todo add pdf handling
             MessageHandler(allowed_file_types_filter, addfile), # Quick ways
             MessageHandler(Filters.PHOTO, addphoto)
         ],
         states={
             FILENAME: [
+                edited_handler,
                 # MessageHandler(Filters.regex(r'^[a-zA-Z0-9_][a-zA-Z0-9_.]*$'), filename_input),
-                MessageHandler(Filters.TEXT & ~Filters.COMMAND, filename_input),
+                # non-blocking: in quick mode this handler compiles the pdf
+                MessageHandler(Filters.TEXT & ~Filters.COMMAND, filename_input, block=False),
                 # MessageHandler(~Filters.command, invalid_filename)
             ],
             CONTENT: [
+                edited_handler,
                 MessageHandler(allowed_file_types_filter, addfile),
                 MessageHandler(Filters.PHOTO, addphoto),
-                CommandHandler('compile', compile_handler),
-                #
-                # MessageHandler(Filters.updates.edited_message, edit_content)
-                #
+                CommandHandler('compile', compile_handler, block=False),
+                CommandHandler('remove', remove_handler),
+                CommandHandler('move', move_handler),
+            ],
+            # pdf is sent, fixes are patched into it
+            EDIT: [
+                edited_handler,
+                CommandHandler('compile', compile_handler, block=False),
+                CommandHandler('remove', remove_handler),
+                CommandHandler('move', move_handler),
+                CommandHandler('done', done_handler),
+                MessageHandler(allowed_file_types_filter | Filters.PHOTO, leave_edit),
+                CommandHandler('newpdf', leave_edit),
+            ],
+            # while compile is in progress
+            ConversationHandler.WAITING: [
+                CommandHandler('cancel', cancel_compile),
+                MessageHandler(Filters.ALL, compiling_handler)
             ],
         },
         fallbacks=[
             CommandHandler('cancel', cancel),
             MessageHandler(Filters.ALL, unknown_handler)
-        ]
+        ],
+        # survives restarts together with user_data
+        name='newpdf',
+        persistent=True,
     )
 
     # dp.add_handler(CommandHandler('quality', quality))
@@ -462,11 +1243,28 @@ def main():
     application.add_handler(CommandHandler('start', help_handler))
     application.add_handler(conv_handler)
     application.add_handler(MessageHandler(Filters.ALL, unknown_handler))
+    return application
 
-    # Start the Bot
-    application.run_polling(drop_pending_updates=True)
+def main():
+    """Start the bot."""
+    application = build_application()
+
+    # Start the Bot. Updates sent while the bot was down are processed, not dropped.
+    if WEBHOOK_URL is not None:
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=WEBHOOK_URL + WEBHOOK_PATH,
+            secret_token=os.environ.get("WEBHOOK_SECRET"),
+            max_connections=MAX_CONCURRENT_UPDATES,
+            drop_pending_updates=DROP_PENDING_UPDATES,
+        )
+    else:
+        application.run_polling(drop_pending_updates=DROP_PENDING_UPDATES)
 
-    statistics_file.close()
+    pool.close()
+    stats.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,166 @@
+"""
+In-process metrics in Prometheus text format, served on a local http endpoint:
+    curl http://127.0.0.1:9108/metrics
+"""
+
+import asyncio
+import bisect
+import logging
+
+logger = logging.getLogger(__name__)
+
+REGISTRY = []
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 5)
+SIZE_BUCKETS = (50_000, 100_000, 250_000, 500_000, 1_000_000, 2_500_000, 5_000_000, 10_000_000)
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in sorted(labels.items())) + '}'
+
+
+class Counter:
+    def __init__(self, name, help):
+        self.name, self.help = name, help
+        self.values = {}  # sorted label items -> value
+        REGISTRY.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} counter'
+        for key, value in self.values.items():
+            yield f'{self.name}{_labels(dict(key))} {value}'
+
+    def summary(self):
+        return ', '.join(f'{_labels(dict(key)) or "total"}={value}' for key, value in self.values.items()) or '0'
+
+
+class Gauge:
+    # value is read from a function at scrape time
+    def __init__(self, name, help, fn):
+        self.name, self.help, self.fn = name, help, fn
+        REGISTRY.append(self)
+
+    def render(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} gauge'
+        yield f'{self.name} {self.fn()}'
+
+    def summary(self):
+        return str(self.fn())
+
+
+class Histogram:
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.buckets = name, help, buckets
+        self.values = {}  # sorted label items -> [bucket counts, sum, count]
+        REGISTRY.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        counts, total, n = self.values.get(key) or ([0] * len(self.buckets), 0, 0)
+        i = bisect.bisect_left(self.buckets, value)
+        if i < len(counts):
+            counts[i] += 1
+        self.values[key] = (counts, total + value, n + 1)
+
+    def quantile(self, q, key):
+        # upper bound of the bucket holding the quantile
+        counts, _, n = self.values[key]
+        seen = 0
+        for bound, count in zip(self.buckets, counts):
+            seen += count
+            if seen >= q * n:
+                return bound
+        return float('inf')
+
+    def render(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} histogram'
+        for key, (counts, total, n) in self.values.items():
+            labels = dict(key)
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield f'{self.name}_bucket{_labels(labels | {"le": bound})} {cumulative}'
+            yield f'{self.name}_bucket{_labels(labels | {"le": "+Inf"})} {n}'
+            yield f'{self.name}_sum{_labels(labels)} {total}'
+            yield f'{self.name}_count{_labels(labels)} {n}'
+
+    def summary(self):
+        lines = []
+        for key, (_, total, n) in self.values.items():
+            lines.append(
+                f'{_labels(dict(key)) or "all"} n={n} avg={total/n:.2f} '
+                f'p50<={self.quantile(0.5, key)} p99<={self.quantile(0.99, key)}'
+            )
+        return '; '.join(lines) or 'no data'
+
+
+def render():
+    return '\n'.join(line for metric in REGISTRY for line in metric.render()) + '\n'
+
+def summary():
+    return '\n'.join(f'{metric.name}: {metric.summary()}' for metric in REGISTRY)
+
+
+#### Bot metrics. Gauges are attached in main()
+
+DOWNLOAD_SECONDS = Histogram('tgpdf_download_seconds', 'Image download latency')
+IMAGE_BYTES = Histogram('tgpdf_image_bytes', 'Downloaded image size', SIZE_BUCKETS)
+COMPILE_SECONDS = Histogram('tgpdf_compile_seconds', 'Compile latency by quality and backend, reduced levels include reducing the images')
+UPLOAD_SECONDS = Histogram('tgpdf_upload_seconds', 'Pdf upload latency by result')
+COMPILE_FAILURES = Counter('tgpdf_compile_failures_total', 'Failed compile attempts by reason: timeout, size, error')
+RATE_LIMITED = Counter('tgpdf_rate_limited_total', 'Requests rejected by per-user rate limits, by limit')
+LOOP_LAG_SECONDS = Histogram('tgpdf_event_loop_lag_seconds', 'Event loop scheduling delay', LAG_BUCKETS)
+
+
+#### Background tasks
+
+async def monitor_loop_lag(interval=0.5):
+    loop = asyncio.get_running_loop()
+    while True:
+        t0 = loop.time()
+        await asyncio.sleep(interval)
+        LOOP_LAG_SECONDS.observe(max(0.0, loop.time() - t0 - interval))
+
+async def _handle(reader, writer):
+    try:
+        request_line = await reader.readline()
+        # skip headers
+        while (await reader.readline()).strip():
+            pass
+        parts = request_line.decode('latin-1').split()
+        if len(parts) >= 2 and parts[0] == 'GET' and parts[1] == '/metrics':
+            body, status = render().encode(), b'200 OK'
+        else:
+            body, status = b'not found\n', b'404 Not Found'
+        writer.write(
+            b'HTTP/1.1 ' + status + b'\r\nContent-Type: text/plain; version=0.0.4\r\n'
+            + b'Content-Length: %d\r\nConnection: close\r\n\r\n' % len(body) + body
+        )
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+async def serve(host, port):
+    server = await asyncio.start_server(_handle, host, port)
+    logger.info(f"metrics on http://{host}:{port}/metrics")
+    return server
+
+async def send_summaries(bot, chat_id, interval):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await bot.send_message(chat_id, 'metrics\n' + summary())
+        except Exception:
+            logger.warning("failed to send metrics summary", exc_info=True)
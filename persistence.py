@@ -0,0 +1,108 @@
+import asyncio
+import json
+import pickle
+import sqlite3
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+
+class SqlitePersistence(BasePersistence):
+    """
+    Stores user_data and conversation states in SQLite, one row per user / conversation.
+
+    Only users and conversations changed since the last run of update_persistence
+    are written, unlike PicklePersistence, which rewrites the whole file every time.
+    WAL mode: a crash loses at most one update interval and never corrupts the file.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS user_data (
+        uid INTEGER PRIMARY KEY,
+        data BLOB NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS conversations (
+        name TEXT NOT NULL,
+        key TEXT NOT NULL,
+        state BLOB NOT NULL,
+        PRIMARY KEY (name, key)
+    );
+    """
+
+    def __init__(self, path, update_interval=60):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self._db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(self.SCHEMA)
+        # writes of one update_persistence run come concurrently, keep them in order
+        self._lock = asyncio.Lock()
+
+    async def _execute(self, sql, args):
+        async with self._lock:
+            await asyncio.to_thread(self._db.execute, sql, args)
+
+    #### user_data
+
+    async def get_user_data(self):
+        return {uid: pickle.loads(data) for uid, data in self._db.execute("SELECT uid, data FROM user_data")}
+
+    async def update_user_data(self, user_id, data):
+        if not data:
+            # session ended
+            await self.drop_user_data(user_id)
+            return
+        await self._execute("INSERT OR REPLACE INTO user_data VALUES (?, ?)", (user_id, pickle.dumps(data)))
+
+    async def drop_user_data(self, user_id):
+        await self._execute("DELETE FROM user_data WHERE uid = ?", (user_id,))
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    #### conversations
+
+    async def get_conversations(self, name):
+        rows = self._db.execute("SELECT key, state FROM conversations WHERE name = ?", (name,))
+        return {tuple(json.loads(key)): pickle.loads(state) for key, state in rows}
+
+    async def update_conversation(self, name, key, new_state):
+        if new_state is None:
+            await self._execute("DELETE FROM conversations WHERE name = ? AND key = ?", (name, json.dumps(key)))
+            return
+        await self._execute("INSERT OR REPLACE INTO conversations VALUES (?, ?, ?)", (name, json.dumps(key), pickle.dumps(new_state)))
+
+    #### not stored
+
+    async def get_chat_data(self):
+        return {}
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def get_bot_data(self):
+        return {}
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def flush(self):
+        # called once on shutdown, after the last update_persistence
+        self._db.close()
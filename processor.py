@@ -0,0 +1,47 @@
+import asyncio
+
+from telegram.ext import BaseUpdateProcessor
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Processes updates of different users concurrently, updates of one user in order.
+
+    One user's album photos and commands never race each other,
+    while a slow handler of one user doesn't hold up anybody else.
+    """
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self._locks = {}  # uid -> (lock, number of updates holding or waiting for it)
+
+    async def process_update(self, update, coroutine):
+        # The user's lock first, then a slot of the global limit: updates waiting for
+        # their user's earlier ones don't hold slots other users need
+        user = update.effective_user if hasattr(update, 'effective_user') else None
+        if user is None:
+            async with self._semaphore:
+                await self.do_process_update(update, coroutine)
+            return
+
+        lock, n = self._locks.get(user.id) or (asyncio.Lock(), 0)
+        self._locks[user.id] = (lock, n + 1)
+        try:
+            async with lock:
+                async with self._semaphore:
+                    await self.do_process_update(update, coroutine)
+        finally:
+            lock, n = self._locks[user.id]
+            if n == 1:
+                del self._locks[user.id]
+            else:
+                self._locks[user.id] = (lock, n - 1)
+
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
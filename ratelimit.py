@@ -0,0 +1,101 @@
+import asyncio
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    """
+    Per-user token buckets, one per limit.
+
+    `limits` maps a limit name to (capacity, period): a bucket holds up to `capacity`
+    tokens and refills all of them in `period` seconds, so bursts up to `capacity` pass.
+    Costs known only afterwards (worker CPU seconds) are charged and may take a bucket
+    below zero, the user then waits until it refills.
+    Buckets are [tokens, time] lists in dicts. Full buckets are pruned, idle users cost nothing.
+    """
+
+    def __init__(self, limits):
+        self.limits = limits
+        self._buckets = {name: {} for name in limits}  # name -> uid -> [tokens, monotonic time]
+        self._notified = set()  # (uid, name) already told about the limit
+
+    def _bucket(self, uid, name):
+        capacity, period = self.limits[name]
+        now = time.monotonic()
+        bucket = self._buckets[name].get(uid)
+        if bucket is None:
+            bucket = self._buckets[name][uid] = [capacity, now]
+        else:
+            bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * capacity / period)
+            bucket[1] = now
+        return bucket
+
+    def allow(self, uid, name, cost=1) -> bool:
+        """Take `cost` tokens if there are that many."""
+        bucket = self._bucket(uid, name)
+        if bucket[0] < cost:
+            return False
+        bucket[0] -= cost
+        self._notified.discard((uid, name))
+        return True
+
+    def check(self, uid, name) -> bool:
+        """Any tokens left. Takes nothing, for limits that are charged afterwards."""
+        if self._bucket(uid, name)[0] <= 0:
+            return False
+        self._notified.discard((uid, name))
+        return True
+
+    def charge(self, uid, name, cost):
+        self._bucket(uid, name)[0] -= cost
+
+    def retry_after(self, uid, name, cost=1) -> float:
+        """Seconds until `cost` tokens are there."""
+        capacity, period = self.limits[name]
+        return max(0.0, (cost - self._bucket(uid, name)[0]) * period / capacity)
+
+    def notify_once(self, uid, name) -> bool:
+        # True on the first rejection until the limit allows again: one reply to a burst of rejected images
+        if (uid, name) in self._notified:
+            return False
+        self._notified.add((uid, name))
+        return True
+
+    def prune(self):
+        for name, buckets in self._buckets.items():
+            capacity, _ = self.limits[name]
+            for uid in list(buckets):
+                if self._bucket(uid, name)[0] >= capacity:
+                    del buckets[uid]
+
+    def save(self, path):
+        # monotonic time doesn't survive a restart, save wall time
+        self.prune()
+        offset = time.time() - time.monotonic()
+        state = {name: {str(uid): [tokens, t + offset] for uid, (tokens, t) in buckets.items()} for name, buckets in self._buckets.items()}
+        with open(path, 'w') as f:
+            json.dump(state, f)
+
+    def load(self, path):
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path) as f:
+                state = json.load(f)
+        except (OSError, ValueError) as err:
+            logger.warning(f"rate limits: can't load {path}: {err}")
+            return
+        offset = time.time() - time.monotonic()
+        for name, buckets in state.items():
+            if name in self._buckets:
+                self._buckets[name] = {int(uid): [tokens, t - offset] for uid, (tokens, t) in buckets.items()}
+        logger.info(f"rate limits: loaded {sum(len(b) for b in self._buckets.values())} buckets")
+
+    async def prune_periodically(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            self.prune()
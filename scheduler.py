@@ -0,0 +1,142 @@
+import asyncio
+import logging
+from collections import deque
+from contextlib import asynccontextmanager
+
+from workers import JobCancelled
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    """Too many jobs are waiting. Try again later."""
+
+class UserLimit(Exception):
+    """User already has too many jobs in flight."""
+
+
+class CompileScheduler:
+    """
+    Admission control between compile handlers and the worker pool.
+
+    At most `workers` jobs run at once, at most `max_queued` jobs wait.
+    Waiting jobs are dispatched round-robin across users, so a user with
+    many jobs cannot starve everybody else. Each user has at most
+    `max_per_user` jobs in flight (waiting or running).
+
+    Usage:
+        async with scheduler.slot(uid, on_queued):
+            ... compile ...
+    """
+
+    def __init__(self, workers, max_queued, max_per_user):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.max_per_user = max_per_user
+        self._running = 0
+        self._queues = {}       # uid -> deque of futures waiting for a slot
+        self._ring = deque()    # uids with waiting jobs, in round-robin order
+        self._inflight = {}     # uid -> number of waiting + running jobs
+
+    @property
+    def queued(self):
+        return sum(len(q) for q in self._queues.values())
+
+    @property
+    def running(self):
+        return self._running
+
+    def position(self, uid, waiter) -> int:
+        """1-based position of a waiting job in dispatch order"""
+        k = self._queues[uid].index(waiter)
+        # every user dispatches one job per round: count jobs of earlier rounds,
+        # then users before this one in the current round
+        pos = sum(min(len(q), k) for q in self._queues.values())
+        for other in self._ring:
+            if other == uid:
+                break
+            if len(self._queues[other]) > k:
+                pos += 1
+        return pos + 1
+
+    def _dispatch(self):
+        while self._running < self.workers and self._ring:
+            uid = self._ring.popleft()
+            queue = self._queues[uid]
+            waiter = queue.popleft()
+            if queue:
+                self._ring.append(uid)
+            else:
+                del self._queues[uid]
+            self._running += 1
+            waiter.set_result(None)
+
+    def _forget(self, uid):
+        self._inflight[uid] -= 1
+        if self._inflight[uid] == 0:
+            del self._inflight[uid]
+
+    async def _acquire(self, uid, on_queued=None):
+        if self._inflight.get(uid, 0) >= self.max_per_user:
+            raise UserLimit()
+        if self._running >= self.workers and self.queued >= self.max_queued:
+            raise QueueFull()
+
+        self._inflight[uid] = self._inflight.get(uid, 0) + 1
+        waiter = asyncio.get_running_loop().create_future()
+        if uid not in self._queues:
+            self._queues[uid] = deque()
+            self._ring.append(uid)
+        self._queues[uid].append(waiter)
+        self._dispatch()
+
+        if not waiter.done():
+            pos = self.position(uid, waiter)
+            logger.info(f"u{uid} scheduler: queued at #{pos}, running={self._running}, queued={self.queued}")
+            try:
+                if on_queued is not None:
+                    await on_queued(pos)
+                await waiter
+            except BaseException:
+                if waiter.done() and not waiter.cancelled() and waiter.exception() is None:
+                    # slot was granted meanwhile, give it back
+                    self._running -= 1
+                    self._dispatch()
+                else:
+                    waiter.cancel()
+                    self._drop(uid, waiter)
+                self._forget(uid)
+                raise
+
+    def _drop(self, uid, waiter):
+        queue = self._queues.get(uid)
+        if queue is None or waiter not in queue:
+            return
+        queue.remove(waiter)
+        if not queue:
+            del self._queues[uid]
+            self._ring.remove(uid)
+
+    def cancel(self, uid) -> int:
+        """Fail all waiting jobs of a user with JobCancelled. Returns number of jobs cancelled."""
+        queue = self._queues.pop(uid, None)
+        if queue is None:
+            return 0
+        self._ring.remove(uid)
+        for waiter in queue:
+            if not waiter.done():
+                waiter.set_exception(JobCancelled())
+        return len(queue)
+
+    def _release(self, uid):
+        self._running -= 1
+        self._forget(uid)
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, uid, on_queued=None):
+        await self._acquire(uid, on_queued)
+        try:
+            yield
+        finally:
+            self._release(uid)
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+"""
+Usage statistics.
+
+The bot logs events to an in-memory queue, which is flushed to a SQLite
+database (WAL mode) in batches from a background thread. Every flush is
+one transaction, so a crash loses at most one flush interval of events
+and never leaves a half-written record.
+
+Query CLI:
+    python stats.py daily [--since YYYY-MM-DD]     daily unique users and new pdfs
+    python stats.py success [--since YYYY-MM-DD]   daily success rate
+    python stats.py images [--since YYYY-MM-DD]    images per pdf
+    python stats.py retries [--since YYYY-MM-DD]   compile retries by reason
+    python stats.py import stats.*.txt             import old per-restart csv files
+"""
+
+import argparse
+import asyncio
+import sqlite3
+import time
+from datetime import datetime
+
+from constants import STATS_DB
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    ts REAL NOT NULL,
+    day TEXT NOT NULL,
+    uid INTEGER NOT NULL,
+    username TEXT,
+    event TEXT NOT NULL,
+    value TEXT
+);
+CREATE INDEX IF NOT EXISTS events_day ON events (day, event);
+"""
+
+def connect(path):
+    db = sqlite3.connect(path, check_same_thread=False)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.executescript(SCHEMA)
+    return db
+
+
+class StatsSink:
+    def __init__(self, path, flush_interval):
+        self.flush_interval = flush_interval
+        self._db = connect(path)
+        self._queue = []
+        self._lock = asyncio.Lock()
+
+    def log(self, uid, username, event, value=None):
+        # cheap, called from handlers
+        now = time.time()
+        day = datetime.fromtimestamp(now).strftime("%Y-%m-%d")
+        self._queue.append((now, day, uid, username, event, None if value is None else str(value)))
+
+    def _write(self, batch):
+        with self._db:
+            self._db.executemany("INSERT INTO events VALUES (?, ?, ?, ?, ?, ?)", batch)
+
+    async def flush(self):
+        async with self._lock:
+            batch, self._queue = self._queue, []
+            if batch:
+                await asyncio.to_thread(self._write, batch)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def close(self):
+        batch, self._queue = self._queue, []
+        if batch:
+            self._write(batch)
+        self._db.close()
+
+
+#### Query CLI
+
+QUERIES = {
+    'daily': (
+        ("day", "users", "new pdfs"),
+        """SELECT day, COUNT(DISTINCT uid), SUM(event = 'newpdf') FROM events
+           WHERE day >= ? GROUP BY day ORDER BY day"""
+    ),
+    'success': (
+        ("day", "new pdfs", "success", "success?", "rate"),
+        """SELECT day, SUM(event = 'newpdf'), SUM(event = 'success'), SUM(event = 'success?'),
+                  ROUND(1.0 * SUM(event IN ('success', 'success?')) / MAX(SUM(event = 'newpdf'), 1), 3)
+           FROM events WHERE day >= ? GROUP BY day ORDER BY day"""
+    ),
+    'images': (
+        ("images", "pdfs"),
+        """SELECT CAST(value AS INTEGER) AS n, COUNT(*) FROM events
+           WHERE day >= ? AND event IN ('success', 'success?') GROUP BY n ORDER BY n"""
+    ),
+    'retries': (
+        ("day", "reason", "retries"),
+        """SELECT day, value, COUNT(*) FROM events
+           WHERE day >= ? AND event = 'retry' GROUP BY day, value ORDER BY day, value"""
+    ),
+}
+
+def import_csv(db, filenames):
+    # old format: date,uid,username,event,value - one file per restart
+    n = 0
+    for filename in filenames:
+        rows = []
+        with open(filename) as f:
+            for line in f:
+                parts = line.rstrip('\n').split(',')
+                if len(parts) != 5:
+                    continue
+                day, uid, username, event, value = parts
+                ts = datetime.strptime(day, "%Y-%m-%d").timestamp()
+                rows.append((ts, day, int(uid), None if username == 'None' else username, event, value))
+        with db:
+            db.executemany("INSERT INTO events VALUES (?, ?, ?, ?, ?, ?)", rows)
+        n += len(rows)
+    print(f"imported {n} events")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('query', choices=[*QUERIES, 'import'])
+    parser.add_argument('files', nargs='*', help='csv files to import')
+    parser.add_argument('--since', default='0000-00-00')
+    parser.add_argument('--db', default=STATS_DB)
+    args = parser.parse_args()
+
+    db = connect(args.db)
+    if args.query == 'import':
+        import_csv(db, args.files)
+        return
+
+    header, sql = QUERIES[args.query]
+    print('\t'.join(header))
+    for row in db.execute(sql, (args.since,)):
+        print('\t'.join(str(x) for x in row))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+import asyncio
+import io
+import os
+import sys
+
+import pytest
+from PIL import Image
+
+# modules live in the repository root
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+import loadtest
+
+# bot settings of every test: small and quiet
+BOT_SETTINGS = {
+    'POOL_WORKERS': 1,
+    'RATE_LIMITS_FILE': None,
+    'REQUEST_DONATION': False,
+}
+
+
+def set_constant(monkeypatch, name, value):
+    # constant in every repo module that has it, restored after the test
+    for module in list(sys.modules.values()):
+        path = getattr(module, '__file__', None)
+        if path and os.path.dirname(os.path.abspath(path)) == REPO and hasattr(module, name):
+            monkeypatch.setattr(module, name, value)
+
+@pytest.fixture
+def bot(tmp_path, monkeypatch):
+    # main.py in a temporary directory, start it with loadtest.start_bot
+    monkeypatch.chdir(tmp_path)
+    main = loadtest.import_bot()
+    for name, value in BOT_SETTINGS.items():
+        set_constant(monkeypatch, name, value)
+    # tasks of the previous test's event loop
+    for name in ('album_replies', 'prepare_tasks', 'edit_expiry'):
+        monkeypatch.setattr(main, name, {})
+    return main
+
+def photo(i, size=(64, 48)):
+    # a page for SimUser.page: (name, JPEG bytes, width, height, kind)
+    f = io.BytesIO()
+    Image.new('RGB', size, (i * 40 % 256, 100, 200)).save(f, 'jpeg')
+    return (f'photo{i}', f.getvalue(), *size, 'photo')
+
+async def reply(stub, uid, timeout=30):
+    # next (method, params) the bot sent to chat uid
+    return await asyncio.wait_for(stub.inboxes[uid].get(), timeout)
+
+async def start_session(stub, user, strings):
+    # /newpdf and a name
+    user.text('/newpdf')
+    await reply(stub, user.uid)
+    user.text('test')
+    method, params = await reply(stub, user.uid)
+    assert params['text'].startswith(strings['tg_info_newpdf_name_accepted'].split('{')[0])
+
+async def compiled_pdf(stub, user, timeout=60):
+    # /compile, returns the pdf the bot sent
+    user.text('/compile')
+    while True:
+        method, params = await reply(stub, user.uid, timeout)
+        if method == 'sendDocument':
+            return params['document']
@@ -0,0 +1,54 @@
+import asyncio
+import os
+import random
+import subprocess
+import sys
+
+import pymupdf
+
+import loadtest
+from loadtest import SimUser, make_corpus
+from conftest import REPO, set_constant, reply, start_session, compiled_pdf
+
+
+def test_two_workers_compile_a_pdf(bot, monkeypatch, tmp_path):
+    queue = str(tmp_path / 'jobs.sqlite3')
+    set_constant(monkeypatch, 'JOB_QUEUE', queue)
+    set_constant(monkeypatch, 'POOL_WORKERS', 2)
+    # reduced quality: every page is a reduce job
+    set_constant(monkeypatch, 'MAX_PDFSIZE', 1_000_000)
+    # worker.py processes run elsewhere, job paths are relative to the bot's directory
+    workers = [
+        subprocess.Popen(
+            [sys.executable, os.path.join(REPO, 'worker.py'), '--queue', queue, '--workers', '1', '--dir', str(tmp_path)],
+            cwd=REPO, stderr=subprocess.PIPE, text=True
+        )
+        for _ in range(2)
+    ]
+
+    async def run():
+        stub, stop = await loadtest.start_bot(bot)
+        user = SimUser(stub, 7, bot.STRINGS)
+        try:
+            await start_session(stub, user, bot.STRINGS)
+            photos = [image for image in make_corpus(4, random.Random(1)) if image[4] == 'photo']
+            for i in range(8):
+                user.page(photos[i % len(photos)], b'%d' % i, None)
+            for _ in range(8):
+                method, params = await reply(stub, 7)
+                assert params['text'].startswith(bot.STRINGS['tg_info_img_ok'].split('{')[0])
+            return await compiled_pdf(stub, user)
+        finally:
+            await stop()
+
+    try:
+        pdf = asyncio.run(run())
+    finally:
+        for worker in workers:
+            worker.terminate()
+        logs = [worker.communicate(timeout=10)[1] for worker in workers]
+    with pymupdf.open(stream=pdf) as doc:
+        assert doc.page_count == 8
+    # both workers ran jobs
+    for log in logs:
+        assert ' done, t=' in log
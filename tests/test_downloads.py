@@ -0,0 +1,159 @@
+import asyncio
+import os
+
+import pymupdf
+
+import loadtest
+from loadtest import SimUser, StubBotApi, unique_copy
+from conftest import photo, set_constant, reply, start_session, compiled_pdf
+
+
+class SlowFileServer(StubBotApi):
+    # file downloads take delays[file_id] seconds, concurrent downloads are counted
+    def __init__(self):
+        super().__init__()
+        self.delays = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def file(self, file_id):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.delays.get(file_id, 0))
+            return await super().file(file_id)
+        finally:
+            self.in_flight -= 1
+
+class MissingFiles(StubBotApi):
+    # downloads of files in `missing` fail with 404
+    def __init__(self, missing):
+        super().__init__()
+        self.missing = missing
+
+    async def file(self, file_id):
+        return None if file_id in self.missing else await super().file(file_id)
+
+def embedded_images(pdf):
+    with pymupdf.open(stream=pdf) as doc:
+        return [doc.extract_image(page.get_images()[0][0])['image'] for page in doc]
+
+
+def test_album_downloads_concurrently_in_message_order(bot, monkeypatch):
+    set_constant(monkeypatch, 'ALBUM_REPLY_DELAY', 0.2)
+    set_constant(monkeypatch, 'MAX_CONCURRENT_DOWNLOADS', 3)
+
+    async def run():
+        stub, stop = await loadtest.start_bot(bot, SlowFileServer())
+        user = SimUser(stub, 7, bot.STRINGS)
+        try:
+            await start_session(stub, user, bot.STRINGS)
+            pages = [photo(i) for i in range(8)]
+            for i, page in enumerate(pages):
+                # earlier pages download longer: downloads complete out of order
+                stub.delays[f'u7-{i}'] = 0.05 * (8 - i)
+                user.page(page, b'%d' % i, 'album')
+            # one reply for the whole album
+            method, params = await reply(stub, 7)
+            assert params['text'].startswith(bot.STRINGS['tg_info_imgs_ok'].format(8))
+            assert stub.max_in_flight == 3
+            pdf = await compiled_pdf(stub, user)
+        finally:
+            await stop()
+        # pages in message order, JPEGs embedded as they were sent
+        assert embedded_images(pdf) == [unique_copy(page[1], b'%d' % i) for i, page in enumerate(pages)]
+
+    asyncio.run(run())
+
+def test_failed_download_keeps_other_pages(bot):
+    async def run():
+        stub, stop = await loadtest.start_bot(bot, MissingFiles({'u7-1'}))
+        user = SimUser(stub, 7, bot.STRINGS)
+        try:
+            await start_session(stub, user, bot.STRINGS)
+            pages = [photo(i) for i in range(3)]
+            for i, page in enumerate(pages):
+                user.page(page, b'%d' % i, None)
+            texts = [(await reply(stub, 7))[1]['text'] for _ in pages]
+            assert texts.count(bot.STRINGS['tg_err_img_error']) == 1
+            pdf = await compiled_pdf(stub, user)
+        finally:
+            await stop()
+        assert embedded_images(pdf) == [unique_copy(pages[i][1], b'%d' % i) for i in (0, 2)]
+
+    asyncio.run(run())
+
+def test_cancel_while_downloading_sends_nothing(bot):
+    async def run():
+        stub, stop = await loadtest.start_bot(bot, SlowFileServer())
+        user = SimUser(stub, 7, bot.STRINGS)
+        try:
+            await start_session(stub, user, bot.STRINGS)
+            stub.delays['u7-0'] = 1
+            user.page(photo(0), b'0', None)
+            user.text('/compile')
+            await asyncio.sleep(0.3)
+            # compile handler is waiting for the download
+            user.text('/cancel')
+            sent = []
+            while True:
+                try:
+                    sent.append(await reply(stub, 7, timeout=3))
+                except asyncio.TimeoutError:
+                    break
+        finally:
+            await stop()
+        assert bot.STRINGS['tg_info_cancel'] in [params.get('text') for _, params in sent]
+        assert 'sendDocument' not in [method for method, _ in sent]
+
+    asyncio.run(run())
+
+def test_cancel_before_filename_ends_session(bot):
+    # quick mode: photo first, /compile asks for a name once the download is done
+    async def run():
+        stub, stop = await loadtest.start_bot(bot, SlowFileServer())
+        user = SimUser(stub, 7, bot.STRINGS)
+        try:
+            stub.delays['u7-0'] = 1
+            user.page(photo(0), b'0', None)
+            await asyncio.sleep(0.1)
+            user.text('/compile')
+            await asyncio.sleep(0.3)
+            user.text('/cancel')
+            sent = []
+            while True:
+                try:
+                    sent.append(await reply(stub, 7, timeout=2))
+                except asyncio.TimeoutError:
+                    break
+            # session ended, its files are gone
+            assert not os.path.exists('cache/7')
+        finally:
+            await stop()
+        texts = [params.get('text') for _, params in sent]
+        assert bot.STRINGS['tg_info_cancel'] in texts
+        assert bot.STRINGS['tg_info_enter_name'] not in texts
+
+    asyncio.run(run())
+
+def test_size_limit_counts_downloads_in_progress(bot, monkeypatch):
+    page_size = len(photo(0)[1])
+    set_constant(monkeypatch, 'MAX_TOTAL_IMG_SIZE', int(2.5 * page_size))
+    set_constant(monkeypatch, 'ALBUM_REPLY_DELAY', 0.2)
+
+    async def run():
+        stub, stop = await loadtest.start_bot(bot, SlowFileServer())
+        user = SimUser(stub, 7, bot.STRINGS)
+        try:
+            await start_session(stub, user, bot.STRINGS)
+            for i in range(5):
+                stub.delays[f'u7-{i}'] = 0.5
+                user.page(photo(i), b'%d' % i, 'album')
+            texts = [(await reply(stub, 7))[1]['text'] for _ in range(3)]
+            # the third page goes over the limit, like with one download at a time
+            assert texts.count(bot.STRINGS['tg_info_max_total_size']) == 2
+            assert texts[-1].startswith(bot.STRINGS['tg_info_imgs_ok'].format(3))
+        finally:
+            await stop()
+
+    asyncio.run(run())
@@ -0,0 +1,33 @@
+import asyncio
+
+import loadtest
+from loadtest import SimUser
+from conftest import photo, reply, start_session, compiled_pdf
+
+
+def test_rejected_compile_keeps_edit(bot, monkeypatch):
+    async def run():
+        stub, stop = await loadtest.start_bot(bot)
+        user = SimUser(stub, 7, bot.STRINGS)
+        try:
+            await start_session(stub, user, bot.STRINGS)
+            user.page(photo(0), b'0', None)
+            await reply(stub, 7)
+            await compiled_pdf(stub, user)
+            method, params = await reply(stub, 7)
+            assert params['text'] == bot.STRINGS['tg_info_edit']
+            expiry = bot.edit_expiry[7]
+
+            # out of disk space: the sent pdf stays editable
+            monkeypatch.setattr(bot.budget, 'admit', lambda uid, size: False)
+            user.text('/compile')
+            method, params = await reply(stub, 7)
+            assert params['text'] == bot.STRINGS['tg_err_disk_full_compile']
+            assert bot.edit_expiry.get(7) is expiry and not expiry.done()
+            user.text('/done')
+            method, params = await reply(stub, 7)
+            assert params['text'] == bot.STRINGS['tg_info_edit_done']
+        finally:
+            await stop()
+
+    asyncio.run(run())
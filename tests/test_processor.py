@@ -0,0 +1,42 @@
+import asyncio
+from types import SimpleNamespace
+
+from processor import PerUserUpdateProcessor
+
+
+def update(uid):
+    return SimpleNamespace(effective_user=SimpleNamespace(id=uid))
+
+async def handler(log, name, event=None):
+    if event is not None:
+        await event.wait()
+    log.append(name)
+
+
+def test_one_users_backlog_does_not_stall_others():
+    async def run():
+        processor = PerUserUpdateProcessor(2)
+        log, blocked = [], asyncio.Event()
+        # more pending updates of user 1 than slots, the first one is slow
+        tasks = [asyncio.create_task(processor.process_update(update(1), handler(log, f'1-{i}', blocked if i == 0 else None))) for i in range(4)]
+        await asyncio.sleep(0)
+        other = asyncio.create_task(processor.process_update(update(2), handler(log, '2')))
+        await asyncio.wait_for(other, 1)
+        blocked.set()
+        await asyncio.gather(*tasks)
+        return log
+    # user 1's updates stay in order
+    assert asyncio.run(run()) == ['2', '1-0', '1-1', '1-2', '1-3']
+
+def test_updates_without_user_are_limited_too():
+    async def run():
+        processor = PerUserUpdateProcessor(1)
+        log, blocked = [], asyncio.Event()
+        first = asyncio.create_task(processor.process_update(object(), handler(log, 'a', blocked)))
+        second = asyncio.create_task(processor.process_update(object(), handler(log, 'b')))
+        await asyncio.sleep(0.05)
+        assert log == []
+        blocked.set()
+        await asyncio.gather(first, second)
+        return log
+    assert asyncio.run(run()) == ['a', 'b']
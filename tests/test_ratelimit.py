@@ -0,0 +1,31 @@
+import asyncio
+
+import loadtest
+from loadtest import SimUser
+from conftest import photo, set_constant, reply
+
+
+def test_quick_mode_pdf_takes_one_compile(bot, monkeypatch):
+    set_constant(monkeypatch, 'RATE_LIMITS', bot.RATE_LIMITS | {'compiles': (1, 3600)})
+
+    async def run():
+        stub, stop = await loadtest.start_bot(bot)
+        user = SimUser(stub, 7, bot.STRINGS)
+        try:
+            # quick mode: images first, /compile asks for the name, the name compiles
+            user.page(photo(0), b'0', None)
+            user.text('/compile')
+            while True:
+                method, params = await reply(stub, 7)
+                if params.get('text') == bot.STRINGS['tg_info_enter_name']:
+                    break
+            user.text('test')
+            while True:
+                method, params = await reply(stub, 7)
+                assert params.get('text') != bot.STRINGS['tg_err_rate_limited'].format(60)
+                if method == 'sendDocument':
+                    break
+        finally:
+            await stop()
+
+    asyncio.run(run())
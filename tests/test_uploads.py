@@ -0,0 +1,89 @@
+import asyncio
+import os
+import time
+
+from telegram import Bot, Message
+
+from loadtest import ApiError, StubBotApi, TOKEN
+from uploads import Uploader, SUCCESS, FAILURE
+
+BAD_GATEWAY = ApiError(502, 'Bad Gateway')
+
+
+class FlakyBotApi(StubBotApi):
+    # sendDocument fails with errors[i] on the i-th call, None for success
+    def __init__(self, errors=()):
+        super().__init__()
+        self.errors = list(errors)
+        self.documents = []  # document of every sendDocument: bytes or file_id
+
+    async def call(self, method, params):
+        if method == 'sendDocument':
+            self.documents.append(params['document'])
+            error = self.errors.pop(0) if self.errors else None
+            if error is not None:
+                raise error
+        return await super().call(method, params)
+
+async def send(stub, uploader, pdfname, times=1):
+    # upload pdfname as a reply to a message of user 7, `times` times. Returns the results
+    server = await asyncio.start_server(stub.handle, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    bot = Bot(TOKEN, base_url=f'http://127.0.0.1:{port}/bot')
+    await bot.initialize()
+    chat = {'id': 7, 'type': 'private'}
+    message = Message.de_json({'message_id': 1, 'date': int(time.time()), 'chat': chat, 'from': {'id': 7, 'is_bot': False, 'first_name': 'test'}}, bot)
+    try:
+        return [await uploader.send(message, pdfname, 'test.pdf') for _ in range(times)]
+    finally:
+        await bot.shutdown()
+        stub.close()
+        server.close()
+
+def make_pdf(tmp_path):
+    pdfname = str(tmp_path / 'out.pdf')
+    with open(pdfname, 'wb') as f:
+        f.write(b'%PDF-1.4\n' + os.urandom(1000))
+    return pdfname
+
+def open_files():
+    return {os.path.realpath(f'/proc/self/fd/{fd}') for fd in os.listdir('/proc/self/fd')}
+
+
+def test_network_errors_are_retried_and_file_is_closed(tmp_path):
+    pdfname = make_pdf(tmp_path)
+    stub = FlakyBotApi([BAD_GATEWAY, BAD_GATEWAY])
+    assert asyncio.run(send(stub, Uploader(2, 5, 60, backoff=0.01), pdfname)) == [SUCCESS]
+    assert len(stub.documents) == 3
+    assert pdfname not in open_files()
+
+def test_no_backoff_after_the_last_attempt(tmp_path):
+    pdfname = make_pdf(tmp_path)
+    stub = FlakyBotApi([BAD_GATEWAY] * 3)
+    t0 = time.perf_counter()
+    # backoff 0.3 + 0.6 s between attempts, another 1.2 s if it slept after the last one
+    assert asyncio.run(send(stub, Uploader(2, 5, 60, backoff=0.3), pdfname)) == [FAILURE]
+    assert time.perf_counter() - t0 < 1.8
+    assert len(stub.documents) == 3
+
+def test_bad_request_is_not_retried(tmp_path):
+    pdfname = make_pdf(tmp_path)
+    stub = FlakyBotApi([ApiError(400, 'Bad Request: file is too big')])
+    assert asyncio.run(send(stub, Uploader(2, 5, 60, backoff=0.01), pdfname)) == [FAILURE]
+    assert len(stub.documents) == 1
+
+def test_same_pdf_is_resent_by_file_id(tmp_path):
+    pdfname = make_pdf(tmp_path)
+    stub = FlakyBotApi()
+    assert asyncio.run(send(stub, Uploader(2, 5, 60, backoff=0.01), pdfname, times=2)) == [SUCCESS, SUCCESS]
+    uploaded, resent = stub.documents
+    assert uploaded == open(pdfname, 'rb').read()
+    assert resent == 'doc1'
+
+def test_rejected_file_id_falls_back_to_upload(tmp_path):
+    pdfname = make_pdf(tmp_path)
+    stub = FlakyBotApi([None, ApiError(400, 'Bad Request: wrong file identifier')])
+    assert asyncio.run(send(stub, Uploader(2, 5, 60, backoff=0.01), pdfname, times=2)) == [SUCCESS, SUCCESS]
+    uploaded, rejected, uploaded_again = stub.documents
+    assert rejected == 'doc1'
+    assert uploaded_again == uploaded
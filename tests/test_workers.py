@@ -0,0 +1,119 @@
+import asyncio
+import multiprocessing
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from workers import WorkerPool, JobCancelled, KILL_GRACE
+
+
+def slow_convert(images, filename):
+    # a converter stuck on a pathological image
+    time.sleep(60)
+
+async def started_pool(workers):
+    pool = WorkerPool(workers, ctx=multiprocessing.get_context('fork'))
+    await pool.start()
+    return pool
+
+async def next_job_seconds(pool):
+    # how long until the slot takes the next job
+    t0 = time.perf_counter()
+    assert await asyncio.wait_for(pool.run(abs, -3), 10) == 3
+    return time.perf_counter() - t0
+
+
+def test_timed_out_job_frees_slot():
+    async def run():
+        pool = await started_pool(1)
+        try:
+            with pytest.raises(asyncio.TimeoutError):
+                await asyncio.wait_for(pool.run(slow_convert, [], 'out.pdf'), 0.3)
+            assert await next_job_seconds(pool) < KILL_GRACE + 2
+        finally:
+            pool.close()
+    asyncio.run(run())
+
+def test_cancelled_job_frees_slot():
+    async def run():
+        pool = await started_pool(1)
+        try:
+            job = asyncio.create_task(pool.run(slow_convert, [], 'out.pdf', key=1))
+            await asyncio.sleep(0.3)
+            assert pool.cancel(1) == 1
+            with pytest.raises(JobCancelled):
+                await job
+            assert await next_job_seconds(pool) < KILL_GRACE + 2
+        finally:
+            pool.close()
+    asyncio.run(run())
+
+def test_running_jobs_hold_no_executor_threads():
+    async def run():
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(1))
+        pool = await started_pool(2)
+        jobs = [asyncio.create_task(pool.run(slow_convert, [], 'out.pdf', key=1)) for _ in range(2)]
+        try:
+            await asyncio.sleep(0.3)
+            assert pool.busy == 2
+            assert await asyncio.wait_for(asyncio.to_thread(int, '1'), 2) == 1
+        finally:
+            pool.cancel(1)
+            await asyncio.gather(*jobs, return_exceptions=True)
+            pool.close()
+    asyncio.run(run())
+
+def test_keys_take_turns():
+    async def run():
+        pool = await started_pool(1)
+        done = []
+        async def job(key):
+            await pool.run(time.sleep, 0.05, key=key)
+            done.append(key)
+        try:
+            # user 1 queued many jobs first, user 2's job doesn't wait for all of them
+            await asyncio.gather(*(job(1) for _ in range(5)), job(2))
+            assert done.index(2) <= 2
+        finally:
+            pool.close()
+    asyncio.run(run())
+
+def test_timeout_starts_when_worker_takes_job():
+    async def run():
+        pool = await started_pool(1)
+        try:
+            busy = asyncio.create_task(pool.run(time.sleep, 0.5, key=1))
+            await asyncio.sleep(0.1)
+            # waits 0.4s for the worker, runs 0.1s
+            await pool.run(time.sleep, 0.1, timeout=0.3, key=2)
+            await busy
+        finally:
+            pool.close()
+    asyncio.run(run())
+
+@pytest.mark.parametrize('promote, order', [
+    (False, ['busy', 'compile0', 'compile1', 'prepare0', 'prepare1', 'prepare2']),
+    # promoted jobs take turns with other users' jobs
+    (True, ['busy', 'compile0', 'prepare0', 'compile1', 'prepare1', 'prepare2']),
+])
+def test_background_jobs_go_last(promote, order):
+    async def run():
+        pool = await started_pool(1)
+        done = []
+        async def job(name, key, background):
+            await pool.run(time.sleep, 0.05, key=key, background=background)
+            done.append(name)
+        try:
+            busy = asyncio.create_task(job('busy', 1, False))
+            await asyncio.sleep(0.01)
+            jobs = [asyncio.create_task(job(f'prepare{i}', 1, True)) for i in range(3)]
+            jobs += [asyncio.create_task(job(f'compile{i}', 2, False)) for i in range(2)]
+            await asyncio.sleep(0.01)
+            if promote:
+                pool.promote(1)
+            await asyncio.gather(busy, *jobs)
+            assert done == order
+        finally:
+            pool.close()
+    asyncio.run(run())
@@ -0,0 +1,95 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+from telegram.constants import ChatAction
+from telegram.error import TimedOut, NetworkError, BadRequest
+
+from imgcache import file_hash
+
+logger = logging.getLogger(__name__)
+
+SUCCESS, MAYBE_SUCCESS, FAILURE = 'success', 'success?', 'failure'
+
+
+class Uploader:
+    """
+    Upload stage: sends compiled pdfs.
+
+    - the pdf file is closed as soon as the request is built, so the cache can be deleted right away
+    - user sees 'sending a file...' while the upload is in progress
+    - network errors are retried with backoff, errors in the request (BadRequest) are not.
+      file_id of every uploaded pdf is remembered, so sending the same pdf with the same
+      name again (retry, recompile of the same images) is a file_id resend without re-upload.
+      A file_id telegram doesn't accept anymore is dropped and the pdf uploaded.
+    """
+
+    def __init__(self, retries, timeout, ttl, max_file_ids=10_000, backoff=1.0):
+        self.retries = retries
+        self.timeout = timeout
+        self.backoff = backoff  # seconds before the first retry, doubled for every next one
+        self.ttl = ttl
+        self.max_file_ids = max_file_ids
+        self._file_ids = OrderedDict()  # (pdf hash, filename) -> (file_id, time), oldest first
+
+    def _expire(self):
+        deadline = time.monotonic() - self.ttl
+        while self._file_ids:
+            key, (_, t) = next(iter(self._file_ids.items()))
+            if t > deadline and len(self._file_ids) <= self.max_file_ids:
+                break
+            del self._file_ids[key]
+
+    async def _show_progress(self, message):
+        # chat action lasts 5 seconds or until a message is sent
+        while True:
+            try:
+                await message.chat.send_action(ChatAction.UPLOAD_DOCUMENT)
+            except NetworkError:
+                pass
+            await asyncio.sleep(4)
+
+    async def _send(self, message, pdfname, filename, key):
+        file_id = self._file_ids.get(key, (None,))[0]
+        if file_id is not None:
+            logger.info(f"u{message.from_user.id} upload: resending file_id")
+            try:
+                await message.reply_document(document=file_id)
+                return
+            except BadRequest as e:
+                logger.warning(f"u{message.from_user.id} upload: file_id rejected, uploading: {e}")
+                del self._file_ids[key]
+        with open(pdfname, 'rb') as f:
+            sent = await message.reply_document(
+                document=f,
+                filename=filename,
+                write_timeout=self.timeout,
+                connect_timeout=self.timeout,
+            )
+        self._file_ids[key] = (sent.document.file_id, time.monotonic())
+
+    async def send(self, message, pdfname, filename) -> str:
+        """Send pdf as a reply. Returns SUCCESS, MAYBE_SUCCESS (timeout, telegram may still deliver it) or FAILURE."""
+        self._expire()
+        key = (await asyncio.to_thread(file_hash, pdfname), filename)
+        progress = asyncio.create_task(self._show_progress(message))
+        try:
+            for attempt in range(self.retries + 1):
+                try:
+                    await self._send(message, pdfname, filename, key)
+                    return SUCCESS
+                except TimedOut:
+                    # request may have reached telegram, don't risk a duplicate
+                    return MAYBE_SUCCESS
+                except BadRequest:
+                    # a subclass of NetworkError, but the same request fails again
+                    logger.error(f"u{message.from_user.id} upload: bad request", exc_info=True)
+                    return FAILURE
+                except NetworkError:
+                    logger.warning(f"u{message.from_user.id} upload: network error, attempt {attempt+1}", exc_info=True)
+                    if attempt < self.retries:
+                        await asyncio.sleep(self.backoff * 2 ** attempt)
+            return FAILURE
+        finally:
+            progress.cancel()
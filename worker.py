@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+"""
+Standalone compile worker for distributed mode.
+
+Takes jobs from the job queue, runs them in local worker processes and
+reports results. Run any number of these, on any machine that sees the
+job queue and the bot's cache directory. Job paths are relative to the bot's
+working directory (cache/<uid>/...): --dir is a directory where cache/ is the
+bot's cache directory, the current one by default.
+
+    python worker.py --queue jobs.sqlite3 --workers 4 --dir /srv/tgpdf_bot
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import socket
+import time
+
+from compiler import JOBS
+from constants import WORKER_PRELOAD, WORKER_MAX_JOBS
+from jobqueue import SqliteJobQueue
+from workers import WorkerPool, JobCancelled
+
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = 0.05  # seconds between queue polls when idle
+HEARTBEAT_INTERVAL = 1.0  # seconds
+
+
+async def run_job(queue, pool, job_id, name, args):
+    t0 = time.perf_counter()
+    try:
+        result = await pool.run(JOBS[name], *args, key=job_id)
+        ok = True
+        logger.info(f"job {job_id}: {name} done, t={time.perf_counter() - t0:.2f}s")
+    except JobCancelled:
+        logger.info(f"job {job_id}: cancelled")
+        return
+    except Exception as e:
+        logger.info(f"job {job_id}: {name} failed: {e!r}")
+        ok, result = False, repr(e)
+    await asyncio.to_thread(queue.finish, job_id, ok, result)
+
+async def watch(queue, pool, running):
+    # keep leases of running jobs, kill jobs cancelled by the bot
+    while True:
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+        job_ids = list(running)
+        await asyncio.to_thread(queue.heartbeat, job_ids)
+        for job_id in await asyncio.to_thread(queue.cancelled, job_ids):
+            pool.cancel(job_id)
+
+async def serve(queue, workers):
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    pool = WorkerPool(workers, preload=WORKER_PRELOAD, max_jobs=WORKER_MAX_JOBS)
+    await pool.start()
+    running = {}  # job id -> task
+    slots = asyncio.Semaphore(workers)
+    watcher = asyncio.create_task(watch(queue, pool, running))
+    logger.info(f"worker {worker_id}: {workers} processes, waiting for jobs")
+    try:
+        while True:
+            await slots.acquire()
+            job = await asyncio.to_thread(queue.claim, worker_id)
+            if job is None:
+                slots.release()
+                await asyncio.sleep(POLL_INTERVAL)
+                continue
+            job_id, name, args = job
+            task = asyncio.create_task(run_job(queue, pool, job_id, name, args))
+            running[job_id] = task
+
+            def done(task, job_id=job_id):
+                running.pop(job_id, None)
+                slots.release()
+
+            task.add_done_callback(done)
+    finally:
+        watcher.cancel()
+        pool.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--queue', required=True, help='sqlite job queue file')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--dir', default='.', help="bot's working directory, job paths are relative to it")
+    args = parser.parse_args()
+    queue = os.path.abspath(args.queue)
+    os.chdir(args.dir)
+    asyncio.run(serve(SqliteJobQueue(queue), args.workers))
+
+
+if __name__ == '__main__':
+    main()
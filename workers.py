@@ -0,0 +1,270 @@
+import asyncio
+import collections
+import importlib
+import logging
+import multiprocessing
+import time
+
+logger = logging.getLogger(__name__)
+
+KILL_GRACE = 1.0  # seconds between SIGTERM and SIGKILL
+
+
+class JobCancelled(Exception):
+    """Job was cancelled before or while running."""
+
+class WorkerCrashed(Exception):
+    """Worker process died while running a job."""
+
+
+def _worker_main(conn, preload):
+    # Runs in the worker process: execute (fn, args) requests until told to stop.
+    # Replies (ok, result or exception, CPU seconds of the job).
+    # Preloaded modules are imported already under forkserver, imported here under spawn.
+    for name in preload:
+        if name != '__main__':
+            importlib.import_module(name)
+    while True:
+        try:
+            msg = conn.recv()
+        except (EOFError, OSError):
+            break
+        if msg is None:
+            break
+        fn, args = msg
+        t0 = time.process_time()
+        try:
+            res = (True, fn(*args))
+        except Exception as e:
+            res = (False, e)
+        cpu = time.process_time() - t0
+        try:
+            conn.send((*res, cpu))
+        except Exception as e:
+            # result or exception is not picklable
+            conn.send((False, RuntimeError(repr(e)), cpu))
+
+
+class _Worker:
+    def __init__(self, ctx, preload):
+        self.jobs = 0
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_main, args=(child_conn, preload), daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def kill(self):
+        self.process.terminate()
+        self.process.join(KILL_GRACE)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(KILL_GRACE)
+        if self.process.is_alive():
+            self.kill()
+
+
+class _Job:
+    def __init__(self, key, background):
+        self.key = key
+        self.background = background
+        self.worker = None
+        self.waiter = None  # future of an idle worker while the job waits for one
+        self.cancelled = False
+
+
+class WorkerPool:
+    """
+    Pool of worker processes where every job can be killed.
+
+    Unlike multiprocessing.Pool, a job that times out or gets cancelled
+    does not keep running: its worker process is terminated and replaced
+    by a fresh one, so the slot is free again right away.
+    Jobs are tagged with a key (user id) to cancel all jobs of a user.
+    Idle workers go to waiting jobs round-robin by key: a user with many
+    jobs queued doesn't hold back the jobs of other users. Background jobs
+    only get a worker when no other job waits, promote(key) moves a key's
+    background jobs up once something waits for them.
+
+    Workers are forked from a forkserver that has imported `preload` modules
+    once, so new and replaced workers start warm in milliseconds.
+    multiprocessing imports the main module again in every worker, unless
+    the forkserver could preload it (Python 3.13+). Preload the main module's
+    heavy imports to keep that cheap.
+    A worker is replaced after `max_jobs` jobs, memory leaked or fragmented by
+    image libraries goes away with it.
+    account(key, seconds) is called after every job with its CPU time, or its
+    run time if the job was killed.
+    """
+
+    def __init__(self, workers, ctx=None, preload=(), max_jobs=None, account=None):
+        self.workers = workers
+        self.max_jobs = max_jobs
+        self.account = account
+        self._ctx = ctx or multiprocessing.get_context('forkserver')
+        self._preload = ['__main__', *preload]
+        if self._ctx.get_start_method() == 'forkserver':
+            self._ctx.set_forkserver_preload(self._preload)
+        self._idle = []
+        # background -> key -> deque of jobs waiting for a worker, keys in turn order
+        self._waiting = {False: collections.OrderedDict(), True: collections.OrderedDict()}
+        self._jobs = set()
+        self._recycling = set()  # tasks replacing workers that reached max_jobs
+
+    async def start(self):
+        # Workers come up in the background, jobs wait for the first idle one
+        for _ in range(self.workers):
+            self._release(await asyncio.to_thread(_Worker, self._ctx, self._preload))
+
+    @property
+    def busy(self):
+        return self.workers - len(self._idle)
+
+    def _dispatch(self):
+        # idle workers go to waiting jobs, one job of every key in turn, background jobs last
+        while self._idle:
+            waiting = self._waiting[False] or self._waiting[True]
+            if not waiting:
+                break
+            key, jobs = next(iter(waiting.items()))
+            job = jobs.popleft()
+            if jobs:
+                waiting.move_to_end(key)
+            else:
+                del waiting[key]
+            if not job.waiter.done():
+                job.waiter.set_result(self._idle.pop())
+
+    def _release(self, worker):
+        self._idle.append(worker)
+        self._dispatch()
+
+    async def _acquire(self, job):
+        job.waiter = asyncio.get_running_loop().create_future()
+        self._waiting[job.background].setdefault(job.key, collections.deque()).append(job)
+        self._dispatch()
+        try:
+            return await job.waiter
+        except BaseException:
+            if job.waiter.done() and not job.waiter.cancelled() and job.waiter.exception() is None:
+                # got a worker, but the task was cancelled before it resumed
+                self._release(job.waiter.result())
+            raise
+
+    @staticmethod
+    async def _recv(worker):
+        # wait for the result on the event loop: a thread per running job could use up
+        # the default executor, which _replace and file hashing need too
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+        fd = worker.conn.fileno()
+        loop.add_reader(fd, lambda: ready.done() or ready.set_result(None))
+        try:
+            await ready
+        finally:
+            loop.remove_reader(fd)
+        # readable: a whole result follows, or EOF of a dead worker
+        return worker.conn.recv()
+
+    def _charge(self, key, seconds):
+        if self.account is not None and key is not None:
+            self.account(key, seconds)
+
+    async def _replace(self, worker, kill=True):
+        # kill may take up to KILL_GRACE, don't block the event loop
+        await asyncio.to_thread(worker.kill if kill else worker.stop)
+        self._release(await asyncio.to_thread(_Worker, self._ctx, self._preload))
+
+    async def run(self, fn, *args, timeout=None, key=None, background=False):
+        """
+        Run fn(*args) in a worker process and return its result.
+        Background jobs wait until no other job does.
+        Raises asyncio.TimeoutError on timeout, JobCancelled if cancelled by key,
+        and re-raises exceptions from fn.
+        The timeout starts once a worker takes the job, waiting for one doesn't count.
+        """
+        job = _Job(key, background)
+        self._jobs.add(job)
+        try:
+            worker = await self._acquire(job)
+            if job.cancelled:
+                self._release(worker)
+                raise JobCancelled()
+            job.worker = worker
+            t0 = time.monotonic()
+            try:
+                worker.conn.send((fn, args))
+                ok, res, cpu = await asyncio.wait_for(self._recv(worker), timeout)
+            except asyncio.TimeoutError:
+                # worker is still busy, kill it. (TimeoutError is an OSError, handle it first)
+                self._charge(key, time.monotonic() - t0)
+                await asyncio.shield(self._replace(worker))
+                raise
+            except (EOFError, OSError):
+                # worker died: killed by cancel() or crashed
+                self._charge(key, time.monotonic() - t0)
+                await self._replace(worker)
+                if job.cancelled:
+                    raise JobCancelled()
+                raise WorkerCrashed(f"exitcode {worker.process.exitcode}")
+            except BaseException:
+                # the awaiting task itself was cancelled. Worker is still busy, kill it.
+                self._charge(key, time.monotonic() - t0)
+                await asyncio.shield(self._replace(worker))
+                raise
+            self._charge(key, cpu)
+            if job.cancelled:
+                # finished just before it was killed, worker may be dead already
+                await self._replace(worker)
+                raise JobCancelled()
+            worker.jobs += 1
+            if self.max_jobs is not None and worker.jobs >= self.max_jobs:
+                # recycle in the background, the result is ready now
+                task = asyncio.create_task(self._replace(worker, kill=False))
+                self._recycling.add(task)
+                task.add_done_callback(self._recycling.discard)
+            else:
+                self._release(worker)
+        finally:
+            self._jobs.discard(job)
+
+        if not ok:
+            raise res
+        return res
+
+    def promote(self, key):
+        """Waiting background jobs with given key take their turn with other jobs."""
+        jobs = self._waiting[True].pop(key, None)
+        if jobs:
+            self._waiting[False].setdefault(key, collections.deque()).extend(jobs)
+            self._dispatch()
+
+    def cancel(self, key) -> int:
+        """Cancel all waiting and running jobs with given key. Returns number of jobs cancelled."""
+        n = 0
+        for job in self._jobs:
+            if job.key != key or job.cancelled:
+                continue
+            job.cancelled = True
+            n += 1
+            if job.waiter is not None and not job.waiter.done():
+                job.waiter.set_exception(JobCancelled())
+            if job.worker is not None:
+                # run() notices the dead worker and replaces it
+                job.worker.process.terminate()
+        if n:
+            logger.info(f"u{key} workers: cancelled {n} job(s)")
+        return n
+
+    def close(self):
+        while self._idle:
+            self._idle.pop().stop()
+        for job in self._jobs:
+            if job.worker is not None:
+                job.worker.kill()